@@ -0,0 +1,284 @@
+from nmigen import *
+from nmigen.back.pysim import *
+from nmigen_soc.wishbone import *
+from nmigen_soc.memory import *
+
+from isa import *
+
+import sys
+
+###############################################################
+# Custom instruction accelerator interface.                   #
+# Accelerators execute the 'custom-0' and 'custom-1' opcodes, #
+# which use the R-type instruction format:                    #
+# * 'a' / 'b' hold the rs1 / rs2 register values.             #
+# * 'f' / 'ff' hold the 'funct3' / 'funct7' bits.             #
+# * 'op' is 0 for 'custom-0', and 1 for 'custom-1'.           #
+# The CPU sets 'valid' while an instruction executes, and     #
+# holds the inputs until the accelerator sets 'ready'. The    #
+# value in 'y' is written to rd on the cycle that both flags  #
+# are set, and the CPU moves on to the next instruction. So   #
+# 'ready' can be set on the same cycle that 'valid' rises for #
+# single-cycle operations, and 'valid' can stay set if the    #
+# next instruction also uses the accelerator.                 #
+# Accelerators should set 'ready' for operations which they   #
+# do not recognize, so that the CPU does not wait forever.    #
+###############################################################
+
+class Accelerator( Elaboratable ):
+  def __init__( self ):
+    # 'A' and 'B' data inputs.
+    self.a     = Signal( 32, reset = 0x00000000 )
+    self.b     = Signal( 32, reset = 0x00000000 )
+    # 'F' and 'FF' function select inputs, and opcode select input.
+    self.f     = Signal( 3,  reset = 0b000 )
+    self.ff    = Signal( 7,  reset = 0b0000000 )
+    self.op    = Signal( 1,  reset = 0b0 )
+    # Handshake signals.
+    self.valid = Signal( 1,  reset = 0b0 )
+    self.ready = Signal( 1,  reset = 0b0 )
+    # 'Y' data output.
+    self.y     = Signal( 32, reset = 0x00000000 )
+
+  # Accelerators implement their own 'elaborate' methods.
+  def elaborate( self, platform ):
+    raise NotImplementedError
+
+#############################################################
+# Reference accelerator: a few operations which take many   #
+# RV32I instructions each. They all use 'custom-0' with the #
+# 'funct7' bits set to 0; 'CRC32.B' takes 9 extra cycles,   #
+# and the others finish on the cycle that they start.       #
+#############################################################
+
+# 'funct3' bits for the reference accelerator's operations:
+# * 'SADD':    rd = rs1 + rs2, saturated to a signed 32-bit value.
+# * 'SADDU':   rd = rs1 + rs2, saturated to an unsigned value.
+# * 'PACK565': rd = RGB888 pixel in rs1, packed into RGB565 format.
+# * 'CRC32.B': rd = CRC-32 value in rs1, updated with the byte in
+#              rs2. (Reflected polynomial 0xEDB88320, with no
+#              initial or final inversion)
+F_SADD    = 0b000
+F_SADDU   = 0b001
+F_PACK565 = 0b010
+F_CRC32B  = 0b011
+CRC32_POLY = 0xEDB88320
+
+# Functions to assemble the reference accelerator's instructions.
+def SADD( c, a, b ):
+  return CUSTOM0( F_SADD, 0, c, a, b )
+def SADDU( c, a, b ):
+  return CUSTOM0( F_SADDU, 0, c, a, b )
+def PACK565( c, a ):
+  return CUSTOM0( F_PACK565, 0, c, a, 0 )
+def CRC32_B( c, a, b ):
+  return CUSTOM0( F_CRC32B, 0, c, a, b )
+
+class RefAccel( Accelerator ):
+  def elaborate( self, platform ):
+    m = Module()
+
+    # 33-bit sum for the saturating additions.
+    sum = Signal( 33, reset = 0 )
+    # CRC-32 unit: value being updated, remaining bits, and a flag
+    # which is set while an update is in progress.
+    crc = Signal( 32, reset = 0x00000000 )
+    cnt = Signal( range( 9 ), reset = 0 )
+    crun = Signal( 1, reset = 0b0 )
+
+    m.d.comb += sum.eq( self.a + self.b )
+
+    # Unrecognized operations return 0.
+    with m.If( ( self.op == 0 ) & ( self.ff == 0 ) ):
+      with m.Switch( self.f ):
+        # Signed overflow happens when both inputs have the same sign
+        # and the result's sign is different.
+        with m.Case( F_SADD ):
+          with m.If( ( self.a[ 31 ] == self.b[ 31 ] ) &
+                     ( sum[ 31 ] != self.a[ 31 ] ) ):
+            m.d.comb += self.y.eq( Mux( self.a[ 31 ],
+                                        0x80000000, 0x7FFFFFFF ) )
+          with m.Else():
+            m.d.comb += self.y.eq( sum[ :32 ] )
+        # Unsigned overflow sets the carry bit.
+        with m.Case( F_SADDU ):
+          m.d.comb += self.y.eq( Mux( sum[ 32 ], 0xFFFFFFFF,
+                                      sum[ :32 ] ) )
+        # Keep the 5 / 6 / 5 MSbits of the red / green / blue bytes.
+        with m.Case( F_PACK565 ):
+          m.d.comb += self.y.eq( Cat( self.a[ 3 : 8 ],
+                                      self.a[ 10 : 16 ],
+                                      self.a[ 19 : 24 ] ) )
+        # CRC-32 update: XOR the byte into the CRC, then shift one
+        # bit out per cycle, XOR-ing in the polynomial if it is set.
+        with m.Case( F_CRC32B ):
+          with m.If( self.valid & ~crun ):
+            m.d.sync += [
+              crc.eq( self.a ^ self.b[ :8 ] ),
+              cnt.eq( 8 ),
+              crun.eq( 1 )
+            ]
+          with m.Elif( cnt != 0 ):
+            m.d.sync += [
+              crc.eq( Cat( crc[ 1: ], 0 ) ^
+                      Mux( crc[ 0 ], CRC32_POLY, 0 ) ),
+              cnt.eq( cnt - 1 )
+            ]
+          with m.Elif( crun ):
+            m.d.sync += crun.eq( 0 )
+            m.d.comb += self.y.eq( crc )
+    # Every operation except for 'CRC32.B' is ready right away.
+    m.d.comb += self.ready.eq( ~( ( self.op == 0 ) & ( self.ff == 0 ) &
+                                  ( self.f == F_CRC32B ) ) |
+                               ( crun & ( cnt == 0 ) ) )
+
+    # End of reference accelerator module definition.
+    return m
+
+#################################################################
+# Memory-mapped accelerator peripheral: lets an accelerator be  #
+# used with loads and stores, for CPUs without an accelerator   #
+# port. Registers (word-aligned offsets):                       #
+# * 0x00: 'A' input.                                            #
+# * 0x04: 'B' input.                                            #
+# * 0x20-0x3C: result of 'custom-0' operation ( offset - 32 ) / #
+#              4 with the 'funct7' bits set to 0. Reads wait    #
+#              until the accelerator is ready.                  #
+#################################################################
+
+# Peripheral register offsets.
+ACCEL_A = 0x00
+ACCEL_B = 0x04
+ACCEL_Y = 0x20
+
+class AccelPeriph( Elaboratable, Interface ):
+  def __init__( self, accel ):
+    # Initialize wishbone bus interface for peripheral registers.
+    # (Bus addresses are in words, so 'ACCEL_Y' is word 8)
+    Interface.__init__( self, addr_width = 4, data_width = 32,
+                        granularity = 8 )
+    self.memory_map = MemoryMap( addr_width = self.addr_width + 2,
+                                 data_width = self.granularity,
+                                 alignment = 0 )
+    # Accelerator submodule.
+    self.accel = accel
+    # Latched result of the last operation.
+    self.y = Signal( 32, reset = 0x00000000 )
+
+  def elaborate( self, platform ):
+    m = Module()
+    m.submodules.accel = self.accel
+
+    # Peripheral bus signals follow 'cyc', except for result reads.
+    m.d.comb += [
+      self.stb.eq( self.cyc ),
+      self.accel.f.eq( self.adr[ :3 ] ),
+      self.accel.valid.eq( self.cyc & ~self.we & self.adr[ 3 ] &
+                           ~self.ack )
+    ]
+    m.d.sync += self.ack.eq( self.cyc & ~self.ack &
+      ( self.we | ~self.adr[ 3 ] | self.accel.ready ) )
+
+    # Select the addressed register.
+    with m.If( self.adr[ 3 ] ):
+      m.d.comb += self.dat_r.eq( self.y )
+      with m.If( self.accel.valid & self.accel.ready ):
+        m.d.sync += self.y.eq( self.accel.y )
+    with m.Elif( self.adr[ 0 ] == 0 ):
+      m.d.comb += self.dat_r.eq( self.accel.a )
+      with m.If( self.we & self.cyc ):
+        m.d.sync += self.accel.a.eq( self.dat_w )
+    with m.Else():
+      m.d.comb += self.dat_r.eq( self.accel.b )
+      with m.If( self.we & self.cyc ):
+        m.d.sync += self.accel.b.eq( self.dat_w )
+
+    # (End of memory-mapped accelerator peripheral definition)
+    return m
+
+##################################
+# Reference accelerator tests:   #
+##################################
+# Keep track of test pass / fail rates.
+p = 0
+f = 0
+# Perform an individual accelerator unit test, and check how many
+# cycles it took.
+def accel_ut( ac, name, a, b, fn, expected, cycles ):
+  global p, f
+  # Set A, B, F, and request the operation.
+  yield ac.a.eq( a )
+  yield ac.b.eq( b )
+  yield ac.f.eq( fn )
+  yield ac.valid.eq( 1 )
+  nc = 1
+  # Wait for the result.
+  yield Settle()
+  while ( yield ac.ready ) == 0:
+    yield Tick()
+    nc += 1
+    yield Settle()
+  # Done. Check the result, and finish the handshake.
+  actual = yield ac.y
+  yield Tick()
+  yield ac.valid.eq( 0 )
+  if ( hexs( expected ) != hexs( actual ) ) or ( nc != cycles ):
+    f += 1
+    print( "\033[31mFAIL:\033[0m %s( %s, %s ) = %s in %d cycles "
+           "(got: %s in %d cycles)"
+           %( name, hexs( a ), hexs( b ), hexs( expected ), cycles,
+              hexs( actual ), nc ) )
+  else:
+    p += 1
+    print( "\033[32mPASS:\033[0m %s( %s, %s ) = %s"
+           %( name, hexs( a ), hexs( b ), hexs( expected ) ) )
+
+# Top-level reference accelerator test method.
+def accel_test( ac ):
+  # Let signals settle after reset.
+  yield Settle()
+
+  # Print a test header.
+  print( "--- Reference Accelerator Tests ---" )
+
+  # Test the saturating addition operations.
+  print( "SADD / SADDU tests:" )
+  yield from accel_ut( ac, 'SADD', 1, 2, F_SADD, 3, 1 )
+  yield from accel_ut( ac, 'SADD', -5, 2, F_SADD, -3, 1 )
+  yield from accel_ut( ac, 'SADD', 0x7FFFFFFF, 1, F_SADD, 0x7FFFFFFF, 1 )
+  yield from accel_ut( ac, 'SADD', 0x80000000, -1, F_SADD, 0x80000000, 1 )
+  yield from accel_ut( ac, 'SADD', 0x80000000, 0x7FFFFFFF, F_SADD, -1, 1 )
+  yield from accel_ut( ac, 'SADDU', 1, 2, F_SADDU, 3, 1 )
+  yield from accel_ut( ac, 'SADDU', 0xFFFFFFFF, 1, F_SADDU, 0xFFFFFFFF, 1 )
+  yield from accel_ut( ac, 'SADDU', 0x80000000, 0x80000000,
+                       F_SADDU, 0xFFFFFFFF, 1 )
+
+  # Test the pixel packing operation.
+  print( "PACK565 tests:" )
+  yield from accel_ut( ac, 'PACK565', 0x00FF8040, 0, F_PACK565, 0xFC08, 1 )
+  yield from accel_ut( ac, 'PACK565', 0xFFFFFFFF, 0, F_PACK565, 0xFFFF, 1 )
+
+  # Test the CRC-32 operation, including back-to-back updates.
+  print( "CRC32.B tests:" )
+  yield from accel_ut( ac, 'CRC32.B', 0xFFFFFFFF, 0x00, F_CRC32B,
+                       0x2DFD1072, 10 )
+  yield from accel_ut( ac, 'CRC32.B', 0x2DFD1072, 0x31, F_CRC32B,
+                       0xEFF8ED3A, 10 )
+  yield from accel_ut( ac, 'CRC32.B', 0x00000000, 0x1FF, F_CRC32B,
+                       0x2D02EF8D, 10 )
+
+  # Done.
+  yield Tick()
+  print( "Reference Accelerator Tests: %d Passed, %d Failed"%( p, f ) )
+
+# 'main' method to run a basic testbench.
+if __name__ == "__main__":
+  # Instantiate a reference accelerator module.
+  dut = RefAccel()
+  # Run the tests.
+  with Simulator( dut, vcd_file = open( 'accel.vcd', 'w' ) ) as sim:
+    def proc():
+      yield from accel_test( dut )
+    sim.add_clock( 1e-6 )
+    sim.add_sync_process( proc )
+    sim.run()
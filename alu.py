@@ -5,19 +5,31 @@ from isa import *
 
 import sys
 
-###############
-# ALU module: #
-###############
+#################################################################
+# ALU module:                                                   #
+# 'ADD', 'SUB', 'SLT', and 'SLTU' all use one 33-bit adder,     #
+# which maps onto an FPGA's carry chain. Subtraction adds the   #
+# inverted 'B' input with a carry in, and the comparisons use   #
+# its carry out and sign bit. The 'CMP' output is the branch    #
+# condition for the current function: A == B for 'SUB', (the    #
+# difference is zero) or A < B for 'SLT' / 'SLTU'.              #
+# (It doesn't wait for the 'Y' mux)                             #
+#################################################################
 
 class ALU( Elaboratable ):
-  def __init__( self ):
+  def __init__( self, bitmanip = False ):
+    # Include the 'Zbb' bit-manipulation operations?
+    self.bitmanip = bitmanip
     # 'A' and 'B' data inputs.
     self.a = Signal( 32, reset = 0x00000000 )
     self.b = Signal( 32, reset = 0x00000000 )
-    # 'F' function select input.
-    self.f = Signal( 4,  reset = 0b0000 )
+    # 'F' function select input. (The MSbit selects the
+    #  bit-manipulation operations, if they are included)
+    self.f = Signal( 5,  reset = 0b00000 )
     # 'Y' data output.
     self.y = Signal( 32, reset = 0x00000000 )
+    # 'CMP' comparison flag output.
+    self.cmp = Signal( 1, reset = 0b0 )
 
   def elaborate( self, platform ):
     # Core ALU module.
@@ -28,6 +40,29 @@ class ALU( Elaboratable ):
       ta = Signal()
       m.d.sync += ta.eq( ~ta )
 
+    # Shared adder. Operations which subtract 'B' are 'SUB', 'SLT',
+    # 'SLTU', and the 'MIN' / 'MAX' comparisons. Both operands get
+    # an extra LSbit which is set when subtracting, so that the
+    # carry in is part of the same addition.
+    sub = Signal( 1, reset = 0b0 )
+    s   = Signal( 34, reset = 0 )
+    lt  = Signal( 1, reset = 0b0 )
+    m.d.comb += sub.eq( self.f[ 3 ] | ( self.f[ 1 : 3 ] == 0b01 ) )
+    if self.bitmanip:
+      with m.If( self.f[ 4 ] & ( self.f[ 2 : 4 ] == 0b01 ) ):
+        m.d.comb += sub.eq( 1 )
+    m.d.comb += [
+      s.eq( Cat( sub, self.a ) +
+            Cat( sub, self.b ^ Repl( sub, 32 ) ) ),
+      # A < B: unsigned if there was no carry out, and signed if the
+      # difference is negative or if the signs differ and A's is set.
+      # (The function LSbit selects unsigned comparisons.)
+      lt.eq( Mux( self.f[ 0 ], ~s[ 33 ],
+                  Mux( self.a[ 31 ] ^ self.b[ 31 ],
+                       self.a[ 31 ], s[ 32 ] ) ) ),
+      self.cmp.eq( Mux( self.f[ 1 ], lt, s[ 1 : 33 ] == 0 ) )
+    ]
+
     # Perform ALU computations based on the 'function' bits.
     with m.Switch( self.f[ :3 ] ):
       # Y = A AND B
@@ -40,18 +75,11 @@ class ALU( Elaboratable ):
       with m.Case( ALU_XOR & 0b111 ):
         m.d.comb += self.y.eq( self.a ^ self.b )
       # Y = A +/- B
-      # Subtraction is implemented as A + (-B).
       with m.Case( ALU_ADD & 0b111 ):
-        m.d.comb += self.y.eq(
-          self.a.as_signed() + Mux( self.f[ 3 ],
-            ( ~self.b + 1 ).as_signed(),
-            self.b.as_signed() ) )
-      # Y = ( A < B ) (signed)
-      with m.Case( ALU_SLT & 0b111 ):
-        m.d.comb += self.y.eq( self.a.as_signed() < self.b.as_signed() )
-      # Y = ( A <  B ) (unsigned)
-      with m.Case( ALU_SLTU & 0b111 ):
-        m.d.comb += self.y.eq( self.a < self.b )
+        m.d.comb += self.y.eq( s[ 1 : 33 ] )
+      # Y = ( A < B ) (signed / unsigned)
+      with m.Case( ALU_SLT & 0b111, ALU_SLTU & 0b111 ):
+        m.d.comb += self.y.eq( lt )
       # Note: Shift operations cannot shift more than XLEN (32) bits.
       # Also, left shifts are implemented by flipping the inputs
       # and outputs of a right shift operation in the CPU logic.
@@ -61,6 +89,41 @@ class ALU( Elaboratable ):
           self.a.as_signed() >> ( self.b[ :5 ] ),
           self.a >> ( self.b[ :5 ] ) ) )
 
+    # Optional bit-manipulation operations. These are selected by the
+    # function select MSbit, and they override the result above.
+    if self.bitmanip:
+      with m.If( self.f[ 4 ] ):
+        with m.Switch( self.f[ :4 ] ):
+          # Y = number of leading zero bits in A.
+          # ('CTZ' flips the input in the CPU logic)
+          with m.Case( ALU_CLZ & 0b1111 ):
+            m.d.comb += self.y.eq( 32 )
+            for i in range( 32 ):
+              with m.If( self.a[ i ] ):
+                m.d.comb += self.y.eq( 31 - i )
+          # Y = number of set bits in A.
+          with m.Case( ALU_CPOP & 0b1111 ):
+            m.d.comb += self.y.eq( sum( self.a[ i ] for i in range( 32 ) ) )
+          # Y = A sign-extended from 8 or 16 bits.
+          with m.Case( ALU_SEXTB & 0b1111 ):
+            m.d.comb += self.y.eq( Cat( self.a[ :8 ], Repl( self.a[ 7 ], 24 ) ) )
+          with m.Case( ALU_SEXTH & 0b1111 ):
+            m.d.comb += self.y.eq( Cat( self.a[ :16 ], Repl( self.a[ 15 ], 16 ) ) )
+          # Y = the lesser of A and B (signed / unsigned)
+          with m.Case( ALU_MIN & 0b1111, ALU_MINU & 0b1111 ):
+            m.d.comb += self.y.eq( Mux( lt, self.a, self.b ) )
+          # Y = the greater of A and B (signed / unsigned)
+          with m.Case( ALU_MAX & 0b1111, ALU_MAXU & 0b1111 ):
+            m.d.comb += self.y.eq( Mux( lt, self.b, self.a ) )
+          # Y = A rotated right by B bits.
+          # ('ROL' flips the inputs and outputs in the CPU logic)
+          with m.Case( ALU_ROR & 0b1111 ):
+            m.d.comb += self.y.eq(
+              ( Cat( self.a, self.a ) >> self.b[ :5 ] )[ :32 ] )
+          # Y = A with its bytes reversed.
+          with m.Case( ALU_REV8 & 0b1111 ):
+            m.d.comb += self.y.eq( LITTLE_END_L( self.a ) )
+
     # End of ALU module definition.
     return m
 
@@ -93,6 +156,24 @@ def alu_ut( alu, a, b, fn, expected ):
            %( hexs( a ), ALU_STRS[ fn ],
               hexs( b ), hexs( expected ) ) )
 
+# Perform an individual test of the ALU's comparison flag.
+def alu_cmp_ut( alu, a, b, fn, expected ):
+  global p, f
+  yield alu.a.eq( a )
+  yield alu.b.eq( b )
+  yield alu.f.eq( fn )
+  yield Tick()
+  yield Settle()
+  actual = yield alu.cmp
+  if expected != actual:
+    f += 1
+    print( "\033[31mFAIL:\033[0m CMP( %s %s %s ) = %d (got: %d)"
+           %( hexs( a ), ALU_STRS[ fn ], hexs( b ), expected, actual ) )
+  else:
+    p += 1
+    print( "\033[32mPASS:\033[0m CMP( %s %s %s ) = %d"
+           %( hexs( a ), ALU_STRS[ fn ], hexs( b ), expected ) )
+
 # Top-level ALU test method.
 def alu_test( alu ):
   # Let signals settle after reset.
@@ -165,6 +246,21 @@ def alu_test( alu ):
   yield from alu_ut( alu, -10, -42, ALU_SLTU, 0 )
   yield from alu_ut( alu, -42, 42, ALU_SLTU, 0 )
 
+  # Test the comparison flag, which branches use.
+  print( "CMP (branch condition) tests:" )
+  yield from alu_cmp_ut( alu, 42, 42, ALU_SUB, 1 )
+  yield from alu_cmp_ut( alu, 42, -42, ALU_SUB, 0 )
+  yield from alu_cmp_ut( alu, 0x80000000, 0, ALU_SUB, 0 )
+  yield from alu_cmp_ut( alu, 0, 0, ALU_SUB, 1 )
+  yield from alu_cmp_ut( alu, 0xFFFFFFFF, 0xFFFFFFFF, ALU_SUB, 1 )
+  yield from alu_cmp_ut( alu, 0xFFFFFFFF, 0x00000000, ALU_SUB, 0 )
+  yield from alu_cmp_ut( alu, 0x00000001, 0x80000001, ALU_SUB, 0 )
+  yield from alu_cmp_ut( alu, -42, 42, ALU_SLT, 1 )
+  yield from alu_cmp_ut( alu, -42, 42, ALU_SLTU, 0 )
+  yield from alu_cmp_ut( alu, 0x7FFFFFFF, 0x80000000, ALU_SLT, 0 )
+  yield from alu_cmp_ut( alu, 0x7FFFFFFF, 0x80000000, ALU_SLTU, 1 )
+  yield from alu_cmp_ut( alu, 42, 42, ALU_SLTU, 0 )
+
   # Test the shift right operation.
   print ( "SRL (>>) tests:" )
   yield from alu_ut( alu, 0x00000001, 0, ALU_SRL, 0x00000001 )
@@ -183,14 +279,46 @@ def alu_test( alu ):
   yield from alu_ut( alu, 0x80000000, 1, ALU_SRA, 0xC0000000 )
   yield from alu_ut( alu, 0x80000000, 4, ALU_SRA, 0xF8000000 )
 
+  # Test the optional bit-manipulation operations.
+  if alu.bitmanip:
+    print( "CLZ tests:" )
+    yield from alu_ut( alu, 0x00000000, 0, ALU_CLZ, 32 )
+    yield from alu_ut( alu, 0x00000001, 0, ALU_CLZ, 31 )
+    yield from alu_ut( alu, 0x00010000, 0, ALU_CLZ, 15 )
+    yield from alu_ut( alu, 0x80000001, 0, ALU_CLZ, 0 )
+    print( "CPOP tests:" )
+    yield from alu_ut( alu, 0x00000000, 0, ALU_CPOP, 0 )
+    yield from alu_ut( alu, 0xFFFFFFFF, 0, ALU_CPOP, 32 )
+    yield from alu_ut( alu, 0x80F00001, 0, ALU_CPOP, 6 )
+    print( "SEXT.B / SEXT.H tests:" )
+    yield from alu_ut( alu, 0x0000007F, 0, ALU_SEXTB, 0x0000007F )
+    yield from alu_ut( alu, 0x12345680, 0, ALU_SEXTB, 0xFFFFFF80 )
+    yield from alu_ut( alu, 0x00007FFF, 0, ALU_SEXTH, 0x00007FFF )
+    yield from alu_ut( alu, 0x12348000, 0, ALU_SEXTH, 0xFFFF8000 )
+    print( "MIN / MAX tests:" )
+    yield from alu_ut( alu, -1, 1, ALU_MIN, -1 )
+    yield from alu_ut( alu, -1, 1, ALU_MINU, 1 )
+    yield from alu_ut( alu, -1, 1, ALU_MAX, 1 )
+    yield from alu_ut( alu, -1, 1, ALU_MAXU, -1 )
+    yield from alu_ut( alu, 42, 42, ALU_MIN, 42 )
+    yield from alu_ut( alu, 0x80000000, 0x7FFFFFFF, ALU_MAX, 0x7FFFFFFF )
+    print( "ROR tests:" )
+    yield from alu_ut( alu, 0x12345678, 0, ALU_ROR, 0x12345678 )
+    yield from alu_ut( alu, 0x12345678, 4, ALU_ROR, 0x81234567 )
+    yield from alu_ut( alu, 0x00000001, 1, ALU_ROR, 0x80000000 )
+    yield from alu_ut( alu, 0x00000001, 33, ALU_ROR, 0x80000000 )
+    print( "REV8 tests:" )
+    yield from alu_ut( alu, 0x12345678, 0, ALU_REV8, 0x78563412 )
+    yield from alu_ut( alu, 0xFF000000, 0, ALU_REV8, 0x000000FF )
+
   # Done.
   yield Tick()
   print( "ALU Tests: %d Passed, %d Failed"%( p, f ) )
 
 # 'main' method to run a basic testbench.
 if __name__ == "__main__":
-  # Instantiate an ALU module.
-  dut = ALU()
+  # Instantiate an ALU module, with the bit-manipulation operations.
+  dut = ALU( bitmanip = True )
   # Run the tests.
   with Simulator( dut, vcd_file = open( 'alu.vcd', 'w' ) ) as sim:
     def proc():
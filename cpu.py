@@ -1,9 +1,13 @@
 from nmigen import *
 from nmigen.back.pysim import *
 
+from accel import *
 from alu import *
+from salu import *
 from csr import *
 from isa import *
+from muldiv import *
+from rvc import *
 from spi_rom import *
 from rom import *
 from rvmem import *
@@ -17,53 +21,321 @@ import warnings
 
 # CPU module.
 class CPU( Elaboratable ):
-  def __init__( self, rom_module ):
+  def __init__( self, rom_module, fast = False, pipeline = False,
+                predict = False, prefetch = 0, icache = None,
+                stbuf = 0, nbload = False, fuse = False,
+                predecode = False, rv32m = False, bitmanip = False,
+                compressed = False, accel = None, misaligned = False,
+                fetch64 = False, itcm = 0, hartid = 0, mem = None,
+                atomic = False, serial = 0, shadow = False,
+                wfi = False, csrreg = False ):
+    # 'Pipeline' mode fetches whole words into its 'decode' stage, so
+    # it does not support compressed instructions. Cores with the 'C'
+    # extension should use 'fast' mode instead.
+    if compressed and pipeline:
+      raise ValueError( "'Pipeline' mode does not support the 'C' "
+                        "extension; use 'fast' mode instead" )
+    # 64-bit fetches are only used by the 'base' and 'fast' cores'
+    # fetch logic. 'Pipeline' mode already streams one word per cycle
+    # from memories which can return them, and the 'C' extension,
+    # prefetch queue, and instruction cache keep their own buffers.
+    # (Program memories without a 64-bit bus, like 'SPI_ROM', still
+    #  fall back to 32-bit fetches)
+    if fetch64 and ( pipeline or compressed or prefetch or icache ):
+      raise ValueError( "64-bit fetches are not supported in "
+                        "'pipeline' mode, with the 'C' extension, or "
+                        "with a prefetch queue or instruction cache" )
+    # Serial ALU cores use the 'base' core's execution logic, which
+    # waits for ALU results. The other cores and options expect them
+    # to be ready on the same cycle. ('predict' and 'fuse' are parts
+    # of 'pipeline' mode)
+    if serial and ( fast or pipeline or predict or fuse or
+                    bitmanip or atomic ):
+      raise ValueError( "Serial ALU cores do not support 'fast' or "
+                        "'pipeline' mode, or the bit-manipulation "
+                        "and atomic extensions" )
+    # 'Fast' mode: start fetching the next instruction during the
+    # current instruction's execution cycle, so that simple
+    # instructions retire every two cycles instead of every three.
+    self.fast = fast
+    # 'Pipeline' mode: overlap the fetch, decode, and execute stages
+    # of consecutive instructions, so that simple instructions can
+    # retire once per cycle. This supersedes 'fast' mode.
+    self.pipeline = pipeline
+    # Static branch prediction: in 'pipeline' mode, start fetching
+    # from the targets of JAL instructions and backwards branches
+    # as soon as they are fetched. (Loops branch backwards.)
+    self.predict = predict
+    # Instruction prefetch queue depth, in words. If it is not zero,
+    # sequential instructions are fetched into a small FIFO while
+    # the CPU is busy. This helps most with slow program memories.
+    self.prefetch = prefetch
+    # Instruction cache geometry: ( number of lines, words per line ).
+    # If it is set, ROM fetches go through a direct-mapped cache.
+    self.icache = icache
+    # Store buffer depth, in stores. If it is not zero, stores are
+    # accepted in a single cycle and written to memory later on.
+    self.stbuf = stbuf
+    # Non-blocking loads: let later instructions execute while a load
+    # waits for the data bus, unless they use its destination register.
+    self.nbload = nbload
+    # Macro-op fusion: in 'pipeline' mode, execute 'LUI' + 'ADDI' and
+    # 'AUIPC' + 'JALR' pairs which build a 32-bit value or far jump
+    # target in the same register as a single operation.
+    self.fuse = fuse
+    # Predecoded instructions: latch each instruction's immediate
+    # value, class, and 'writes rd' flag along with it, and use them
+    # instead of decoding the instruction word while it executes.
+    # They are read from the ROM if it stores them, and decoded
+    # when the instruction is fetched otherwise.
+    self.predecode = predecode
+    # 'M' extension: execute multiply and divide instructions using
+    # a separate unit. The core waits for it to finish; multiplies
+    # take one extra cycle, and divides take 33.
+    self.rv32m = rv32m
+    # 'Zba' / 'Zbb' extensions: execute bit-manipulation instructions
+    # in the ALU. Most of them need extra ALU operations, but some
+    # re-use the existing ones with modified inputs and outputs.
+    self.bitmanip = bitmanip
+    # 'C' extension: expand 16-bit compressed instructions into their
+    # 32-bit equivalents after they are fetched. Instructions only
+    # need to be aligned to 16 bits, so they can straddle two words.
+    # The upper half of the last word that was fetched is kept, so
+    # that sequential compressed instructions only fetch each word
+    # once.
+    self.compressed = compressed
+    # Custom instruction accelerator: an 'Accelerator' subclass which
+    # executes 'custom-0' / 'custom-1' instructions. The core waits
+    # for it to be ready, like with multiply / divide instructions.
+    # The same kind of accelerator is also added to the peripherals,
+    # so that programs can compare it with memory-mapped access.
+    self.accel = accel
+    # Mis-aligned loads and stores: instead of trapping, split
+    # accesses which span two words into two bus transactions, and
+    # merge the loaded bytes. This costs a few extra cycles.
+    self.misaligned = misaligned
+    # Tightly-coupled instruction memory size, in words. If it is not
+    # zero, code which is copied to 0x10000000 is fetched from a
+    # dedicated RAM which returns a word on the cycle after it is
+    # requested, without going through the instruction bus
+    # multiplexer. (Stores to it need a 'FENCE.I' before they run)
+    self.itcm = itcm
+    # Hart ID, which is returned by the 'MHARTID' CSR. Cores in a
+    # multi-hart system share one memory module, which is passed in
+    # as 'mem' and has a port for each hart. (The memory options
+    # above are set when it is created, and the ROM is ignored)
+    self.hartid = hartid
+    self.shared = mem is not None
+    # 'A' extension: 'LR.W' / 'SC.W' with a reservation register, and
+    # atomic memory operations. AMOs read a word and write the result
+    # back without releasing the data bus in between, so no other bus
+    # master can access memory until they finish. Reservations are
+    # cancelled by any write to the reserved word.
+    self.atomic = atomic
+    # Serial ALU width: if it is not zero, ALU operations process
+    # this many bits per cycle ( 1 = bit-serial, 4 = nibble-serial )
+    # instead of using the parallel 32-bit ALU, and the core waits
+    # for them. This takes much less logic, but each register /
+    # immediate or branch instruction takes 32 / 'serial' extra
+    # cycles. (Shifts take one cycle per 'serial' bits shifted)
+    self.serial = serial
+    # Shadow register bank: a second set of 32 CPU registers, which
+    # the core switches to when it enters a trap handler and back
+    # from on 'MRET'. Handlers can use any register without saving
+    # it first, and the shadow bank keeps its values between traps.
+    # (Both banks share one memory; the bank is the address MSbit.
+    #  Handlers which can trap again must still save registers.)
+    self.shadow = shadow
+    # 'WFI' clock gating: 'WFI' waits until an enabled interrupt is
+    # pending, and once the instruction and data buses are idle, the
+    # core's clock enable is turned off until then. (Without it, 'WFI'
+    # does nothing.) The memory module is not gated, so peripherals
+    # keep running, but nothing fetches from ROM / SPI Flash.
+    self.wfi = wfi
+    # Registered CSR reads: generate the CSR module with a compact
+    # address decode and a register on its read data, which takes
+    # the CSR read mux off of the path to the CPU registers. CSR
+    # instructions take one extra cycle.
+    self.csrreg = csrreg
     # CPU signals:
     # 'Reset' signal for clock domains.
     self.clk_rst = Signal( reset = 0b0, reset_less = True )
     # Program Counter register.
     self.pc = Signal( 32, reset = 0x00000000 )
-    # The main 32 CPU registers.
-    self.r      = Memory( width = 32, depth = 32,
+    # 'Next PC' value, which gets applied at the end of each cycle.
+    self.npc = Signal( 32, reset = 0x00000000 )
+    # Instruction register: holds the current instruction word,
+    # which is latched when the instruction bus acknowledges a fetch.
+    self.ir = Signal( 32, reset = 0x00000000 )
+    # Predecoded fields for the current instruction, which are
+    # latched along with it. (Only used with 'predecode')
+    self.pd = Signal( PD_W, reset = 0 )
+    # Flag which is set if the current instruction was compressed.
+    # (Only used with the 'C' extension)
+    self.cir = Signal( 1, reset = 0b0 )
+    # Flag which is set when the current instruction jumps, branches,
+    # or traps. In 'pipeline' mode, this discards any instructions
+    # which were fetched after it.
+    self.redirect = Signal( 1, reset = 0b0 )
+    # Flag which is set when the current instruction has to wait for
+    # the store buffer to drain before it can finish.
+    self.sbwait = Signal( 1, reset = 0b0 )
+    # Performance monitoring events which happen on this cycle, with
+    # one bit for each 'HPM_*' event code. The 'MHPMEVENT' CSRs select
+    # which ones the 'MHPMCOUNTER' CSRs count.
+    self.hpe = Signal( HPM_EVENTS, reset = 0 )
+    # 'Busy' flags for CPU registers which are waiting for a
+    # non-blocking load to finish.
+    self.busy = Signal( 32, reset = 0 )
+    # Register bank which is in use: 1 while a trap is handled.
+    # (Only used with 'shadow')
+    self.bank = Signal( 1, reset = 0 )
+    # External interrupt request input.
+    self.irq = Signal( 1, reset = 0 )
+    # Flag which is set while the core's clock is gated by 'WFI', and
+    # how many cycles it has been gated for. (Only used with 'wfi')
+    self.sleep = Signal( 1, reset = 0 )
+    self.gcycles = Signal( 32, reset = 0 )
+    # The main 32 CPU registers, and the shadow bank if it is used.
+    self.r      = Memory( width = 32, depth = 64 if shadow else 32,
                           init = ( 0x00000000 for i in range( 32 ) ) )
 
     # CPU submodules:
     # Memory access ports for rs1 (ra), rs2 (rb), and rd (rc).
-    self.ra     = self.r.read_port()
-    self.rb     = self.r.read_port()
+    # (In 'pipeline' mode, registers which are read on the same cycle
+    #  that they are written get forwarded instead, so the read ports
+    #  do not need to be transparent.)
+    self.ra     = self.r.read_port( transparent = not pipeline )
+    self.rb     = self.r.read_port( transparent = not pipeline )
     self.rc     = self.r.write_port()
     # The ALU submodule which performs logical operations.
-    self.alu    = ALU()
+    self.alu    = SerialALU( serial ) if serial else ALU( bitmanip )
     # CSR 'system registers'.
-    self.csr    = CSR()
+    self.csr    = CSR( hartid, csrreg, compressed )
+    # Multiply / divide unit, if the 'M' extension is enabled.
+    if rv32m:
+      self.md   = MulDiv()
+    # Compressed instruction expander, if the 'C' extension is enabled.
+    if compressed:
+      self.rvc  = RVC()
+    # Custom instruction accelerator, if one is used.
+    if accel is not None:
+      self.acc  = accel()
     # Memory module to hold peripherals and ROM / RAM module(s)
     # (4KB of RAM = 1024 words)
-    self.mem    = RV_Memory( rom_module, 1024 )
+    if mem is None:
+      self.mem  = RV_Memory( rom_module, 1024, prefetch, icache,
+                             stbuf, accel, fetch64, itcm )
+    else:
+      self.mem  = mem.ports[ hartid ]
+    # 64-bit instruction fetches: read two instructions per instruction
+    # bus transaction, and keep the second one so that the next
+    # sequential instruction doesn't need to use the bus. (The memory
+    # module only enables them if its ROM and configuration allow it)
+    self.fetch64 = self.mem.fetch64
 
   # Helper method to enter a trap handler: jump to the appropriate
-  # address, and set the MCAUSE / MEPC CSRs.
+  # address, and set the MCAUSE / MEPC CSRs. If a store buffer is
+  # used, wait for it to drain first so that the handler sees
+  # every store which came before the trap.
   def trigger_trap( self, m, trap_num, return_pc ):
+    if self.mem.sb is not None:
+      with m.If( ~self.mem.sb.empty ):
+        m.d.comb += self.sbwait.eq( 1 )
+      with m.Else():
+        self.enter_trap( m, trap_num, return_pc )
+    else:
+      self.enter_trap( m, trap_num, return_pc )
+
+  # Helper method to enter a trap handler immediately.
+  def enter_trap( self, m, trap_num, return_pc ):
+    m.d.comb += self.hpe[ HPM_TRAP ].eq( 1 )
     m.d.sync += [
       # Set mcause, mepc, interrupt context flag.
       self.csr.mcause_interrupt.eq( 0 ),
       self.csr.mcause_ecode.eq( trap_num ),
-      self.csr.mepc_mepc.eq( return_pc.bit_select( 2, 30 ) ),
+      self.csr.mepc_mepc.eq( return_pc[ 1 : ] ),
       # Disable interrupts globally until MRET or CSR write.
       self.csr.mstatus_mie.eq( 0 ),
-      # Set the program counter to the interrupt handler address.
-      self.pc.eq( Cat( Repl( 0, 2 ),
-                     ( self.csr.mtvec_base +
-                       Mux( self.csr.mtvec_mode, trap_num, 0 ) ) ) )
     ]
+    # Switch to the shadow register bank.
+    if self.shadow:
+      m.d.sync += self.bank.eq( 1 )
+    # Set the program counter to the interrupt handler address.
+    m.d.comb += [
+      self.npc.eq( Cat( Repl( 0, 2 ),
+                   ( self.csr.mtvec_base +
+                     Mux( self.csr.mtvec_mode, trap_num, 0 ) ) ) ),
+      self.redirect.eq( 1 )
+    ]
+
+  # Helper method to sign- or zero-extend a loaded value, depending
+  # on a load instruction's 'funct3' field.
+  def ld_ext( self, f3, dat ):
+    return Mux( f3[ 0 ],
+                Cat( dat[ :16 ], Repl( ( f3[ 2 ] == 0 ) & dat[ 15 ], 16 ) ),
+           Mux( f3[ 1 ],
+                dat,
+                Cat( dat[ :8 ], Repl( ( f3[ 2 ] == 0 ) & dat[ 7 ], 24 ) ) ) )
+
+  # Helper methods to decode the current instruction's class. 'opc'
+  # returns the value to switch on, and 'ops' converts opcode patterns
+  # into matching patterns for it. Predecoded classes are one-hot, so
+  # each matching class only needs to check a single bit.
+  def opc( self ):
+    return self.pd[ PD_CLS ] if self.predecode else self.ir[ 0 : 7 ]
+  def ops( self, *pats ):
+    if not self.predecode:
+      return pats
+    cls = []
+    for i in range( len( PD_OPS ) ):
+      # Opcode patterns are strings of 7 bits or '-'s, MSbit first.
+      op = format( PD_OPS[ i ], '07b' )
+      for pat in pats:
+        if type( pat ) == int:
+          pat = format( pat, '07b' )
+        if all( ( c == '-' ) or ( c == b ) for c, b in zip( pat, op ) ):
+          cls.append( '-' * ( len( PD_OPS ) - i - 1 ) + '1' + '-' * i )
+          break
+    return cls
+
+  # Helper method to get the current instruction's immediate value
+  # in a given format. ('U', 'J', 'B', 'S', or 'I')
+  def imm( self, fmt ):
+    return self.pd[ PD_IMM ] if self.predecode else IMM_L( self.ir, fmt )
+
+  # Helper method to get the length of the current instruction
+  # in bytes.
+  def ilen( self ):
+    return Mux( self.cir, 2, 4 ) if self.compressed else 4
+
+  # Helper method to get the address that 'MRET' returns to. Bit 1
+  # of the MEPC CSR is ignored unless the 'C' extension is enabled.
+  def mepc( self ):
+    if self.compressed:
+      return Cat( Repl( 0, 1 ), self.csr.mepc_mepc )
+    return Cat( Repl( 0, 2 ), self.csr.mepc_mepc[ 1 : ] )
+
+  # Helper method to check whether the current instruction writes
+  # to a CPU register other than r0, if its class writes one.
+  def wr( self ):
+    return self.pd[ PD_WR ] if self.predecode else \
+           ( self.rc.addr[ :5 ] != 0 )
 
   # CPU object's 'elaborate' method to generate the hardware logic.
   def elaborate( self, platform ):
     # Core CPU module.
     m = Module()
-    # Register the ALU, CSR, and memory submodules.
+    # Register the ALU submodule. (The memory and CSR modules are
+    # registered with the top-level module below, outside of the
+    # clock-gated core logic)
     m.submodules.alu = self.alu
-    m.submodules.csr = self.csr
-    m.submodules.mem = self.mem
+    if self.rv32m:
+      m.submodules.md = self.md
+    if self.compressed:
+      m.submodules.rvc = self.rvc
+    if self.accel is not None:
+      m.submodules.acc = self.acc
     # Register the CPU register read/write ports.
     m.submodules.ra  = self.ra
     m.submodules.rb  = self.rb
@@ -71,153 +343,630 @@ class CPU( Elaboratable ):
 
     # Wait-state counter to let internal memories load.
     iws = Signal( 2, reset = 0 )
+    # Flag which is set while an instruction waits on the data bus.
+    dstall = Signal( 1, reset = 0 )
+    # Flag which is set while a 'WFI' instruction waits for an
+    # interrupt, and flag which is set if an enabled one is pending.
+    wfi  = Signal( 1, reset = 0 )
+    wake = Signal( 1, reset = 0 )
+    # Flag which is set when an instruction finishes executing.
+    iret = Signal( 1, reset = 0 )
+    # Source register values for the current instruction.
+    rs1 = Signal( 32, reset = 0x00000000 )
+    rs2 = Signal( 32, reset = 0x00000000 )
+    # Flag which is set if the current instruction was predicted to
+    # jump or branch when it was fetched. (Only used in 'pipeline'
+    # mode with branch prediction enabled)
+    ptk = Signal( 1, reset = 0 )
+    # Flag which is set if a branch's prediction was wrong.
+    mispred = Signal( 1, reset = 0 )
+    # The instruction after the current one, and a flag which is set
+    # if the two are executed together as a fused pair. (Only used
+    # in 'pipeline' mode with macro-op fusion enabled)
+    f_ir = Signal( 32, reset = 0x00000000 )
+    fuse = Signal( 1, reset = 0 )
+    # Non-blocking load unit: the load which is in progress.
+    # ('lpend' is set while the load waits for the data bus, and
+    #  'lvalid' is set while its data waits to be written.)
+    busy   = self.busy
+    lpend  = Signal( 1, reset = 0 )
+    lvalid = Signal( 1, reset = 0 )
+    ladr   = Signal( 32, reset = 0x00000000 )
+    lrd    = Signal( 5, reset = 0 )
+    lf3    = Signal( 3, reset = 0 )
+    ldat   = Signal( 32, reset = 0x00000000 )
+    # Register bank of the load's destination register, and the bank
+    # which the CPU register write port uses. (Only used with 'shadow')
+    lbank  = Signal( 1, reset = 0 )
+    wbank  = Signal( 1, reset = 0 )
+    # Flag which is set if the current instruction has to wait for
+    # the load unit, and flag which is set if it writes a register.
+    ldstall = Signal( 1, reset = 0 )
+    xwr     = Signal( 1, reset = 0 )
+    # Flag which is set while a multiply / divide operation is in
+    # progress. (Only used with the 'M' extension)
+    mpend   = Signal( 1, reset = 0 )
+    # Flag which is set if the current instruction uses the serial
+    # ALU, flag which is set while its operation is in progress, and
+    # flag which is set until its result is ready. (Only used with
+    # 'serial')
+    aop     = Signal( 1, reset = 0 )
+    apend   = Signal( 1, reset = 0 )
+    aluw  = Signal( 1, reset = 0 )
+    # Data bus access: byte address, width ( 'funct3' LSbits ), byte
+    # lanes, store data, and load data. The bus uses word addresses,
+    # so byte lanes and store data are shifted into place by the
+    # address' 2 LSbits, and load data is shifted back down. Lanes
+    # and data which are shifted past the end of the word belong to
+    # the next word. (Only mis-aligned accesses can use those)
+    dadr    = Signal( 32, reset = 0x00000000 )
+    dwid    = Signal( 2, reset = 0 )
+    dsel    = Signal( 8, reset = 0 )
+    dstw    = Signal( 64, reset = 0 )
+    drd     = Signal( 32, reset = 0x00000000 )
+    # Mis-aligned load / store unit: a flag which is set if an access
+    # spans two words, a flag which is set while the second word is
+    # accessed, and the word loaded from the first.
+    # (Only used with 'misaligned')
+    cross   = Signal( 1, reset = 0 )
+    lsh     = Signal( 1, reset = 0 )
+    ldlo    = Signal( 32, reset = 0x00000000 )
+    # Flag which is set if a load / store should trigger a
+    # 'mis-aligned access' trap.
+    mtrap   = Signal( 1, reset = 0 )
+    # 'JALR' target address, which is calculated with the return
+    # address so that the jump logic only has to select it.
+    jalr    = Signal( 32, reset = 0x00000000 )
+    # Atomic operation unit: the 'LR.W' reservation's valid flag and
+    # word address, a flag which is set if the reservation matches
+    # the current address, the AMO phase ( 0 = read, 1 / 2 = write ),
+    # the word that it read, and the value that it writes.
+    # (Only used with the 'A' extension)
+    rsv     = Signal( 1, reset = 0 )
+    rsva    = Signal( 30, reset = 0 )
+    scok    = Signal( 1, reset = 0 )
+    aph     = Signal( 2, reset = 0 )
+    amov    = Signal( 32, reset = 0x00000000 )
+    amoy    = Signal( 32, reset = 0x00000000 )
+    # Instruction which is being fetched, and a flag which is set
+    # when all of it has arrived. (Outside of 'pipeline' mode)
+    fdat    = self.mem.ibus.dat_r
+    fack    = self.mem.ibus.ack
+    # 'C' extension fetch logic: the upper half of the last word that
+    # was fetched, its word address, and a flag which is set if it is
+    # valid. 'hit' is set if the instruction at the fetch address
+    # starts in that halfword, and 'fc' is set if it is compressed.
+    hb      = Signal( 16, reset = 0x0000 )
+    hba     = Signal( 30, reset = 0 )
+    hbv     = Signal( 1, reset = 0 )
+    fa      = Signal( 32, reset = 0x00000000 )
+    hit     = Signal( 1, reset = 0 )
+    fw      = Signal( 32, reset = 0x00000000 )
+    fc      = Signal( 1, reset = 0 )
+    # 64-bit fetch logic: the second word of the last doubleword that
+    # was fetched, its doubleword address, and a flag which is set if
+    # it is valid. (Only used with 'fetch64')
+    wb      = Signal( 32, reset = 0x00000000 )
+    wba     = Signal( 29, reset = 0 )
+    wbv     = Signal( 1, reset = 0 )
+    # Flag which is set if the instruction at the fetch address can
+    # be taken from one of those buffers, without using the bus.
+    bhit    = Signal( 1, reset = 0 )
+    if self.compressed or self.fetch64:
+      fdat  = Signal( 32, reset = 0x00000000 )
+      fack  = Signal( 1, reset = 0 )
 
     # Top-level combinatorial logic.
     m.d.comb += [
-      # Set CPU register access addresses.
-      self.ra.addr.eq( self.mem.imux.bus.dat_r[ 15 : 20 ] ),
-      self.rb.addr.eq( self.mem.imux.bus.dat_r[ 20 : 25 ] ),
-      self.rc.addr.eq( self.mem.imux.bus.dat_r[ 7  : 12 ] ),
-      # Instruction bus address is always set to the program counter.
-      self.mem.imux.bus.adr.eq( self.pc ),
+      # The PC stays the same unless otherwise specified.
+      self.npc.eq( self.pc ),
+      # Set the CPU register write address and bank.
+      self.rc.addr.eq( self.ir[ 7  : 12 ] ),
+      wbank.eq( self.bank ),
       # The CSR inputs are always wired the same.
       self.csr.dat_w.eq(
-        Mux( self.mem.imux.bus.dat_r[ 14 ] == 0,
-             self.ra.data,
-             Cat( self.ra.addr,
-                  Repl( self.ra.addr[ 4 ], 27 ) ) ) ),
-      self.csr.f.eq( self.mem.imux.bus.dat_r[ 12 : 15 ] ),
-      self.csr.adr.eq( self.mem.imux.bus.dat_r[ 20 : 32 ] ),
-      # Store data and width are always wired the same.
-      self.mem.ram.dw.eq( self.mem.imux.bus.dat_r[ 12 : 15 ] ),
-      self.mem.dmux.bus.dat_w.eq( self.rb.data ),
+        Mux( self.ir[ 14 ] == 0,
+             rs1,
+             Cat( self.ir[ 15 : 20 ],
+                  Repl( self.ir[ 19 ], 27 ) ) ) ),
+      self.csr.f.eq( self.ir[ 12 : 15 ] ),
+      self.csr.adr.eq( self.ir[ 20 : 32 ] ),
+      # The data bus is always wired the same; only its address
+      # and width are set by individual instructions.
+      dwid.eq( self.ir[ 12 : 14 ] ),
+      dsel.eq( Mux( dwid[ 1 ], 0b1111,
+                    Mux( dwid[ 0 ], 0b0011, 0b0001 ) ) << dadr[ :2 ] ),
+      dstw.eq( rs2 << Cat( Repl( 0, 3 ), dadr[ :2 ] ) ),
+      drd.eq( self.mem.dbus.dat_r >> Cat( Repl( 0, 3 ), dadr[ :2 ] ) ),
+      self.mem.dbus.adr.eq( dadr[ 2 : ] + lsh ),
+      self.mem.dbus.sel.eq( Mux( lsh, dsel[ 4 : ], dsel[ :4 ] ) ),
+      self.mem.dbus.dat_w.eq( Mux( lsh, dstw[ 32 : ], dstw[ :32 ] ) ),
+      # Instruction fetches always read whole words.
+      self.mem.ibus.sel.eq( Repl( 1, len( self.mem.ibus.sel ) ) )
     ]
+    m.d.sync += self.pc.eq( self.npc )
+    # The multiply / divide unit's inputs are also always wired
+    # the same. (It latches them when an operation starts.)
+    if self.rv32m:
+      m.d.comb += [
+        self.md.a.eq( rs1 ),
+        self.md.b.eq( rs2 ),
+        self.md.f.eq( self.ir[ 12 : 15 ] )
+      ]
+    # Mis-aligned accesses span two words if halfwords start in the
+    # last byte of a word, or words don't start at the first one.
+    if self.misaligned:
+      m.d.comb += cross.eq( Mux( self.ir[ 13 ], dadr[ :2 ] != 0,
+                                 self.ir[ 12 ] & ( dadr[ :2 ] == 0b11 ) ) )
+    # So are the accelerator's inputs. (They are held while the
+    # instruction waits for it to be ready.)
+    if self.accel is not None:
+      m.d.comb += [
+        self.acc.a.eq( rs1 ),
+        self.acc.b.eq( rs2 ),
+        self.acc.f.eq( self.ir[ 12 : 15 ] ),
+        self.acc.ff.eq( self.ir[ 25 : 32 ] ),
+        self.acc.op.eq( self.ir[ 5 ] )
+      ]
+
+    if self.pipeline:
+      # Forward the value which is being written to the CPU registers
+      # if the same register is read on the same cycle.
+      fwa = Signal( 1, reset = 0 )
+      fwb = Signal( 1, reset = 0 )
+      fwd = Signal( 32, reset = 0x00000000 )
+      m.d.sync += [
+        fwa.eq( self.rc.en & ( self.rc.addr == self.ra.addr ) ),
+        fwb.eq( self.rc.en & ( self.rc.addr == self.rb.addr ) ),
+        fwd.eq( self.rc.data )
+      ]
+      m.d.comb += [
+        rs1.eq( Mux( fwa, fwd, self.ra.data ) ),
+        rs2.eq( Mux( fwb, fwd, self.rb.data ) )
+      ]
+    else:
+      m.d.comb += [
+        rs1.eq( self.ra.data ),
+        rs2.eq( self.rb.data )
+      ]
+
+      # Set CPU register read addresses: take them from the
+      # instruction bus while a fetch is in progress, so that the
+      # register values are ready when the instruction executes.
+      with m.If( iws == 0 ):
+        m.d.comb += [
+          self.ra.addr.eq( fdat[ 15 : 20 ] ),
+          self.rb.addr.eq( fdat[ 20 : 25 ] ),
+        ]
+      with m.Else():
+        m.d.comb += [
+          self.ra.addr.eq( self.ir[ 15 : 20 ] ),
+          self.rb.addr.eq( self.ir[ 20 : 25 ] ),
+        ]
+
+      # Instruction bus address is normally set to the program
+      # counter. In 'fast' mode, the next instruction's address is
+      # put on the bus while the current instruction executes.
+      if self.fast:
+        m.d.comb += fa.eq( Mux( iws == 0, self.pc, self.npc ) )
+      else:
+        m.d.comb += fa.eq( self.pc )
+      # 'C' extension: instructions which start in the upper half of
+      # a word can be taken from the kept halfword if it holds that
+      # word; 32-bit ones then need the next word for their upper
+      # half. Otherwise, the word at the fetch address is requested,
+      # and instructions which don't fit in it fetch the next one
+      # after it arrives. ('FENCE.I' discards the kept halfword.)
+      if self.compressed:
+        m.d.comb += [
+          hit.eq( fa[ 1 ] & hbv & ( hba == fa[ 2 : ] ) &
+                  ~self.mem.fencei ),
+          bhit.eq( hit & fc ),
+          self.mem.ibus.adr.eq( fa[ 2 : ] + hit ),
+          fw.eq( Mux( hit,
+                      Cat( hb, self.mem.ibus.dat_r[ :16 ] ),
+                      Mux( fa[ 1 ],
+                           Cat( self.mem.ibus.dat_r[ 16 : ],
+                                self.mem.ibus.dat_r[ 16 : ] ),
+                           self.mem.ibus.dat_r ) ) ),
+          fc.eq( fw[ 0 : 2 ] != 0b11 ),
+          self.rvc.i.eq( fw[ :16 ] ),
+          fdat.eq( Mux( fc, self.rvc.o, fw ) ),
+          fack.eq( ( iws == 0 ) & ( bhit |
+            ( self.mem.ibus.ack & ( hit | ~fa[ 1 ] | fc ) ) ) )
+        ]
+        with m.If( self.mem.fencei ):
+          m.d.sync += hbv.eq( 0 )
+        with m.Elif( ( iws == 0 ) & self.mem.ibus.ack ):
+          m.d.sync += [
+            hb.eq( self.mem.ibus.dat_r[ 16 : ] ),
+            hba.eq( self.mem.ibus.adr ),
+            hbv.eq( 1 )
+          ]
+      # 64-bit fetches: instructions in the second word of the kept
+      # doubleword are taken from it. Otherwise, the doubleword which
+      # holds the fetch address is requested, and its second word
+      # is kept. ('FENCE.I' discards the kept word.)
+      elif self.fetch64:
+        m.d.comb += [
+          bhit.eq( fa[ 2 ] & wbv & ( wba == fa[ 3 : ] ) &
+                   ~self.mem.fencei ),
+          self.mem.ibus.adr.eq( fa[ 3 : ] ),
+          fdat.eq( Mux( bhit, wb,
+                        Mux( fa[ 2 ], self.mem.ibus.dat_r[ 32 : ],
+                                      self.mem.ibus.dat_r[ :32 ] ) ) ),
+          fack.eq( ( iws == 0 ) & ( bhit | self.mem.ibus.ack ) )
+        ]
+        with m.If( self.mem.fencei ):
+          m.d.sync += wbv.eq( 0 )
+        with m.Elif( ( iws == 0 ) & self.mem.ibus.ack ):
+          m.d.sync += [
+            wb.eq( self.mem.ibus.dat_r[ 32 : ] ),
+            wba.eq( self.mem.ibus.adr ),
+            wbv.eq( 1 )
+          ]
+      else:
+        m.d.comb += self.mem.ibus.adr.eq( fa[ 2 : ] )
 
     # Trigger an 'instruction mis-aligned' trap if necessary. 
-    with m.If( self.pc[ :2 ] != 0 ):
+    # (The PC only changes when an instruction retires, so on the
+    #  first cycle with a mis-aligned PC, its value from the previous
+    #  cycle is the address of the jump or branch which set it. That
+    #  is the return PC, in every mode. This doesn't wait for the
+    #  store buffer; loads in the trap handler still see any buffered
+    #  stores, since they are forwarded.
+    #  With the 'C' extension, only odd addresses are mis-aligned.)
+    with m.If( self.pc[ : ( 1 if self.compressed else 2 ) ] != 0 ):
       m.d.sync += self.csr.mtval_einfo.eq( self.pc )
-      self.trigger_trap( m, TRAP_IMIS, Past( self.pc ) )
-    with m.Else():
-      # I-bus is active until it completes a transaction.
-      m.d.comb += self.mem.imux.bus.cyc.eq( iws == 0 )
-
-    # Wait a cycle after 'ack' to load the appropriate CPU registers.
-    with m.If( self.mem.imux.bus.ack ):
-      # Increment the wait-state counter.
-      # (This also lets the instruction bus' 'cyc' signal fall.)
-      m.d.sync += iws.eq( 1 )
-      with m.If( iws == 0 ):
-        # Increment pared-down 32-bit MINSTRET counter.
-        # I'd remove the whole MINSTRET CSR to save space, but the
-        # test harnesses depend on it to count instructions.
-        # TODO: This is OBO; it'll be 1 before the first retire.
-        m.d.sync += self.csr.minstret_instrs.eq(
-          self.csr.minstret_instrs + 1 )
+      m.d.comb += iret.eq( 1 )
+      self.enter_trap( m, TRAP_IMIS, Past( self.pc ) )
+    # ('pipeline' mode fetches instructions separately, below.)
+    if not self.pipeline:
+      with m.Else():
+        # I-bus is active until it completes a transaction. 'cyc' is
+        # released as soon as 'ack' arrives, so that a new transaction
+        # can start on the next cycle.
+        # (Instructions which are taken from the kept halfword or
+        #  word don't need to use the bus.)
+        m.d.comb += self.mem.ibus.cyc.eq(
+          ( iws == 0 ) & ~self.mem.ibus.ack & ~bhit )
 
+        # Latch the instruction and wait for the CPU registers to load
+        # once the instruction bus acknowledges a fetch.
+        with m.If( fack ):
+          # Increment the wait-state counter.
+          m.d.sync += iws.eq( 1 )
+          with m.If( iws == 0 ):
+            m.d.sync += self.ir.eq( fdat )
+            # (Expanded instructions and ones from 64-bit fetches are
+            #  predecoded after they are fetched, rather than reading
+            #  their fields from the ROM.)
+            if self.predecode and ( self.compressed or self.fetch64 ):
+              m.d.sync += self.pd.eq( PREDECODE_L( fdat ) )
+            elif self.predecode:
+              m.d.sync += self.pd.eq( self.mem.ipd( self.pc ) )
+            if self.compressed:
+              m.d.sync += self.cir.eq( fc )
+
+    # Non-blocking loads: check whether the current instruction reads
+    # or writes a register which is waiting for a load, or accesses
+    # memory while the load unit is busy.
+    if self.nbload:
+      rs1u = Signal( 1, reset = 0 )
+      rs2u = Signal( 1, reset = 0 )
+      with m.Switch( self.opc() ):
+        # LUI / AUIPC / R-type / I-type / JAL / JALR instructions.
+        with m.Case( *self.ops( '0-10-11', '110-111' ) ):
+          m.d.comb += [
+            xwr.eq( 1 ),
+            rs1u.eq( self.ir[ 0 : 7 ] != OP_JAL ),
+            rs2u.eq( self.ir[ 0 : 7 ] == OP_REG )
+          ]
+        with m.Case( *self.ops( OP_LOAD ) ):
+          m.d.comb += rs1u.eq( 1 )
+        with m.Case( *self.ops( OP_STORE, OP_BRANCH ) ):
+          m.d.comb += [
+            rs1u.eq( 1 ),
+            rs2u.eq( 1 )
+          ]
+        # Atomic memory operations.
+        if self.atomic:
+          with m.Case( *self.ops( OP_AMO ) ):
+            m.d.comb += [
+              xwr.eq( 1 ),
+              rs1u.eq( 1 ),
+              rs2u.eq( 1 )
+            ]
+        # Custom instructions, if there is an accelerator.
+        if self.accel is not None:
+          with m.Case( *self.ops( '0-01011' ) ):
+            m.d.comb += [
+              xwr.eq( 1 ),
+              rs1u.eq( 1 ),
+              rs2u.eq( 1 )
+            ]
+        # CSR instructions. ('CSRR[WSC]I' use the rs1 field as an
+        #  immediate value, but checking it anyway does no harm.)
+        with m.Case( *self.ops( OP_SYSTEM ) ):
+          m.d.comb += [
+            xwr.eq( self.ir[ 12 : 15 ] != F_TRAPS ),
+            rs1u.eq( 1 )
+          ]
+      m.d.comb += ldstall.eq(
+        ( rs1u & busy.bit_select( self.ir[ 15 : 20 ], 1 ) ) |
+        ( rs2u & busy.bit_select( self.ir[ 20 : 25 ], 1 ) ) |
+        ( xwr & busy.bit_select( self.ir[ 7 : 12 ], 1 ) ) |
+        ( ( self.ir[ 0 : 7 ].matches( '0-00011' ) |
+            ( self.ir[ 0 : 7 ] == OP_AMO ) ) &
+          ( lpend | lvalid ) ) )
+
+    # Serial ALU: start an operation once a register / immediate or
+    # branch instruction is ready to execute, and wait for its result.
+    # (Multiply / divide instructions use their own unit instead.)
+    if self.serial:
+      with m.Switch( self.opc() ):
+        with m.Case( *self.ops( OP_IMM, OP_REG, OP_BRANCH ) ):
+          m.d.comb += aop.eq( 1 )
+      if self.rv32m:
+        with m.If( ( self.ir[ 0 : 7 ] == OP_REG ) &
+                   ( self.ir[ 25 : 32 ] == FF_MULDIV ) ):
+          m.d.comb += aop.eq( 0 )
+      m.d.comb += [
+        self.alu.start.eq( ( iws != 0 ) & aop & ~apend & ~ldstall ),
+        aluw.eq( aop & ~self.alu.done )
+      ]
+      m.d.sync += apend.eq( ( apend | self.alu.start ) & ~self.alu.done )
+
+    # Wait for the load unit or the serial ALU if necessary.
+    with m.If( ( iws != 0 ) & ( ldstall | aluw ) ):
+      m.d.comb += dstall.eq( 1 )
+      m.d.sync += iws.eq( 2 )
     # Execute the current instruction, once it loads.
-    with m.If( iws != 0 ):
+    with m.Elif( iws != 0 ):
       # Increment the PC and reset the wait-state unless
       # otherwise specified.
-      m.d.sync += [
-        self.pc.eq( self.pc + 4 ),
-        iws.eq( 0 )
-      ]
+      m.d.comb += self.npc.eq( self.pc + self.ilen() )
+      m.d.sync += iws.eq( 0 )
 
       # Decoder switch case:
-      with m.Switch( self.mem.imux.bus.dat_r[ 0 : 7 ] ):
+      with m.Switch( self.opc() ):
         # LUI / AUIPC / R-type / I-type instructions: apply
         # pending CPU register write.
-        with m.Case( '0-10-11' ):
-          m.d.comb += self.rc.en.eq( self.rc.addr != 0 )
+        with m.Case( *self.ops( '0-10-11' ) ):
+          m.d.comb += self.rc.en.eq( self.wr() )
+          # 'M' extension instructions: start the multiply / divide
+          # unit, and don't proceed until it has a result.
+          if self.rv32m:
+            with m.If( ( self.ir[ 0 : 7 ] == OP_REG ) &
+                       ( self.ir[ 25 : 32 ] == FF_MULDIV ) ):
+              m.d.comb += self.md.start.eq( ~mpend )
+              m.d.sync += mpend.eq( ~self.md.done )
+              with m.If( ~self.md.done ):
+                m.d.comb += [
+                  self.rc.en.eq( 0 ),
+                  self.npc.eq( self.pc ),
+                  dstall.eq( 1 )
+                ]
+                m.d.sync += iws.eq( 2 )
 
         # JAL / JALR instructions: jump to a new address and place
         # the 'return PC' in the destination register (rc).
-        with m.Case( '110-111' ):
-          m.d.sync += self.pc.eq(
-            Mux( self.mem.imux.bus.dat_r[ 3 ],
-                 self.pc + Cat(
-                   Repl( 0, 1 ),
-                   self.mem.imux.bus.dat_r[ 21: 31 ],
-                   self.mem.imux.bus.dat_r[ 20 ],
-                   self.mem.imux.bus.dat_r[ 12 : 20 ],
-                   Repl( self.mem.imux.bus.dat_r[ 31 ], 12 ) ),
-                 self.ra.data + Cat(
-                   self.mem.imux.bus.dat_r[ 20 : 32 ],
-                   Repl( self.mem.imux.bus.dat_r[ 31 ], 20 ) ) ),
+        with m.Case( *self.ops( '110-111' ) ):
+          m.d.comb += self.npc.eq(
+            Mux( self.ir[ 3 ],
+                 self.pc + self.imm( 'J' ),
+                 jalr ),
           )
-          m.d.comb += self.rc.en.eq( self.rc.addr != 0 )
+          # (JAL doesn't need to redirect if it was predicted.)
+          m.d.comb += [
+            self.rc.en.eq( self.wr() ),
+            self.redirect.eq( ~( self.ir[ 3 ] & ptk ) )
+          ]
 
         # Conditional branch instructions: similar to JAL / JALR,
         # but only take the branch if the condition is met.
-        with m.Case( OP_BRANCH ):
-          # Check the ALU result. If it is zero, then:
-          # a == b for BEQ/BNE, or a >= b for BLT[U]/BGE[U].
-          with m.If( ( ( self.alu.y == 0 ) ^
-                         self.mem.imux.bus.dat_r[ 12 ] ) !=
-                       self.mem.imux.bus.dat_r[ 14 ] ):
+        with m.Case( *self.ops( OP_BRANCH ) ):
+          # Check the ALU's comparison flag: a == b for BEQ/BNE,
+          # or a < b for BLT[U]/BGE[U]. (funct3's LSbit inverts it)
+          with m.If( self.alu.cmp ^ self.ir[ 12 ] ):
             # Branch only if the condition is met.
-            m.d.sync += self.pc.eq( self.pc + Cat(
-              Repl( 0, 1 ),
-              self.mem.imux.bus.dat_r[ 8 : 12 ],
-              self.mem.imux.bus.dat_r[ 25 : 31 ],
-              self.mem.imux.bus.dat_r[ 7 ],
-              Repl( self.mem.imux.bus.dat_r[ 31 ], 20 ) ) )
+            m.d.comb += [
+              self.hpe[ HPM_BRANCH ].eq( 1 ),
+              self.npc.eq( self.pc + self.imm( 'B' ) ),
+              self.redirect.eq( ~ptk ),
+              mispred.eq( ~ptk )
+            ]
+          # If a branch was predicted to be taken but it wasn't,
+          # go back to the next instruction.
+          with m.Else():
+            m.d.comb += [
+              self.redirect.eq( ptk ),
+              mispred.eq( ptk )
+            ]
+          # Count mis-predicted branches.
+          m.d.comb += self.hpe[ HPM_MISPRED ].eq( mispred )
 
         # Load / Store instructions: perform memory access
         # through the data bus.
-        with m.Case( '0-00011' ):
+        with m.Case( *self.ops( '0-00011' ) ):
           # Trigger a trap if the address is mis-aligned.
           # * Byte accesses are never mis-aligned.
           # * Word-aligned accesses are never mis-aligned.
           # * Halfword accesses are only mis-aligned when both of
           #   the address' LSbits are 1s.
-          with m.If( ( ( self.mem.dmux.bus.adr[ :2 ] == 0 ) |
-                       ( self.mem.imux.bus.dat_r[ 12 : 14 ] == 0 ) |
-                       ( ~( self.mem.dmux.bus.adr[ 0 ] &
-                            self.mem.dmux.bus.adr[ 1 ] &
-                            self.mem.imux.bus.dat_r[ 12 ] ) ) ) == 0 ):
+          # (Mis-aligned accesses are split instead if 'misaligned'
+          #  is set, so they never trap.)
+          if not self.misaligned:
+            m.d.comb += mtrap.eq(
+              ( ( dadr[ :2 ] == 0 ) |
+                ( self.ir[ 12 : 14 ] == 0 ) |
+                ( ~( dadr[ 0 ] &
+                     dadr[ 1 ] &
+                     self.ir[ 12 ] ) ) ) == 0 )
+          with m.If( mtrap ):
             self.trigger_trap( m,
               Cat( Repl( 0, 1 ),
-                   self.mem.imux.bus.dat_r[ 5 ],
+                   self.ir[ 5 ],
                    Repl( 1, 1 ) ),
-              Past( self.pc ) )
+              self.pc )
           with m.Else():
-            # Activate the data bus.
-            m.d.comb += [
-              self.mem.dmux.bus.cyc.eq( 1 ),
-              # Stores only: set the 'write enable' bit.
-              self.mem.dmux.bus.we.eq( self.mem.imux.bus.dat_r[ 5 ] )
-            ]
+            # Activate the data bus until the transaction completes.
+            # If a store buffer is used, stores are handed to it
+            # instead, which takes one cycle unless it is full.
+            done = Signal( 1, reset = 0 )
+            if self.mem.sb is not None:
+              m.d.comb += [
+                self.mem.dbus.cyc.eq( ~self.ir[ 5 ] &
+                                      ~self.mem.dbus.ack ),
+                self.mem.sb.push.eq( self.ir[ 5 ] & self.mem.sb.rdy ),
+                done.eq( Mux( self.ir[ 5 ], self.mem.sb.rdy,
+                              self.mem.dbus.ack ) )
+              ]
+            else:
+              m.d.comb += [
+                self.mem.dbus.cyc.eq( ~self.mem.dbus.ack ),
+                done.eq( self.mem.dbus.ack )
+              ]
+            # Stores only: set the 'write enable' bit.
+            m.d.comb += self.mem.dbus.we.eq( self.ir[ 5 ] )
+            # Non-blocking loads: start the load, and hand it to the
+            # load unit. Its destination register is marked as busy
+            # until the load unit writes to it.
+            # (Loads which span two words are not handed to it.)
+            if self.nbload:
+              with m.If( ( self.ir[ 5 ] == 0 ) & ~cross ):
+                m.d.comb += [
+                  self.mem.dbus.cyc.eq( 1 ),
+                  done.eq( 1 )
+                ]
+                m.d.sync += [
+                  lpend.eq( 1 ),
+                  ladr.eq( dadr ),
+                  lrd.eq( self.ir[ 7 : 12 ] ),
+                  lf3.eq( self.ir[ 12 : 15 ] ),
+                  lbank.eq( self.bank )
+                ]
+                with m.If( self.ir[ 7 : 12 ] != 0 ):
+                  m.d.sync += busy.bit_select(
+                    self.ir[ 7 : 12 ], 1 ).eq( 1 )
+            # Accesses which span two words: move on to the second
+            # word once the first one finishes, and keep its bytes.
+            if self.misaligned:
+              with m.If( cross & done ):
+                m.d.sync += lsh.eq( ~lsh )
+                with m.If( ~lsh ):
+                  m.d.sync += ldlo.eq( self.mem.dbus.dat_r )
             # Don't proceed until the memory access finishes.
-            with m.If( self.mem.dmux.bus.ack == 0 ):
-              m.d.sync += [
-                self.pc.eq( self.pc ),
-                iws.eq( 2 )
+            with m.If( ( done == 0 ) | ( cross & ~lsh ) ):
+              m.d.comb += [
+                self.npc.eq( self.pc ),
+                dstall.eq( 1 )
               ]
+              m.d.sync += iws.eq( 2 )
             # Loads only: write to the CPU register.
-            with m.Elif( self.mem.imux.bus.dat_r[ 5 ] == 0 ):
-              m.d.comb += self.rc.en.eq( self.rc.addr != 0 )
+            if not self.nbload:
+              with m.Elif( self.ir[ 5 ] == 0 ):
+                m.d.comb += self.rc.en.eq( self.wr() )
+            elif self.misaligned:
+              with m.Elif( ( self.ir[ 5 ] == 0 ) & cross ):
+                m.d.comb += self.rc.en.eq( self.wr() )
+
+        # Atomic memory operations. They wait for the store buffer to
+        # drain, and trap if their address is not word-aligned.
+        if self.atomic:
+          with m.Case( *self.ops( OP_AMO ) ):
+            done = Signal( 1, reset = 0 )
+            if self.mem.sb is not None:
+              m.d.comb += self.sbwait.eq( ~self.mem.sb.empty )
+            with m.If( dadr[ :2 ] != 0 ):
+              with m.If( self.ir[ 27 : 32 ] == FF_LR ):
+                self.trigger_trap( m, TRAP_LMIS, self.pc )
+              with m.Else():
+                self.trigger_trap( m, TRAP_SMIS, self.pc )
+            with m.Elif( ~self.sbwait ):
+              # 'LR.W': load the word, and reserve its address.
+              with m.If( self.ir[ 27 : 32 ] == FF_LR ):
+                m.d.comb += [
+                  self.mem.dbus.cyc.eq( ~self.mem.dbus.ack ),
+                  done.eq( self.mem.dbus.ack )
+                ]
+                with m.If( done ):
+                  m.d.sync += [
+                    rsv.eq( 1 ),
+                    rsva.eq( dadr[ 2 : ] )
+                  ]
+              # 'SC.W' and AMOs: read the word, then write the result
+              # back without releasing the bus. 'SC.W' only writes if
+              # the reservation is still valid once the bus is held,
+              # and it cancels the reservation either way.
+              # The write starts on the cycle after the read's 'ack',
+              # which may still be set then, so it waits for a new one.
+              with m.Else():
+                m.d.comb += [
+                  self.mem.dbus.cyc.eq( ( aph == 1 ) | ~done ),
+                  self.mem.dbus.we.eq( aph != 0 ),
+                  done.eq( self.mem.dbus.ack &
+                           ( ( aph == 2 ) |
+                             ( ( aph == 0 ) &
+                               ( self.ir[ 27 : 32 ] == FF_SC ) &
+                               ~scok ) ) )
+                ]
+                with m.If( ( aph == 0 ) & ~done & self.mem.dbus.ack ):
+                  m.d.sync += [
+                    aph.eq( 1 ),
+                    amov.eq( self.mem.dbus.dat_r )
+                  ]
+                with m.If( aph == 1 ):
+                  m.d.sync += aph.eq( 2 )
+                with m.If( done ):
+                  m.d.sync += aph.eq( 0 )
+                  with m.If( self.ir[ 27 : 32 ] == FF_SC ):
+                    m.d.sync += rsv.eq( 0 )
+              # Don't proceed until the operation finishes.
+              with m.If( ~done ):
+                m.d.comb += [
+                  self.npc.eq( self.pc ),
+                  dstall.eq( 1 )
+                ]
+                m.d.sync += iws.eq( 2 )
+              with m.Else():
+                m.d.comb += self.rc.en.eq( self.wr() )
 
         # System call instruction: ECALL, EBREAK, MRET,
         # and atomic CSR operations.
-        with m.Case( OP_SYSTEM ):
-          with m.If( self.mem.imux.bus.dat_r[ 12 : 15 ] == F_TRAPS ):
-            with m.Switch( self.mem.imux.bus.dat_r[ 20 : 22 ] ):
+        with m.Case( *self.ops( OP_SYSTEM ) ):
+          with m.If( self.ir[ 12 : 15 ] == F_TRAPS ):
+            with m.Switch( self.ir[ 20 : 22 ] ):
               # An 'empty' ECALL instruction should raise an
               # 'environment-call-from-M-mode" exception.
               with m.Case( 0 ):
-                self.trigger_trap( m, TRAP_ECALL, Past( self.pc ) )
+                self.trigger_trap( m, TRAP_ECALL, self.pc )
               # "EBREAK" instruction: enter the interrupt context
               # with 'breakpoint' as the cause of the exception.
+              # 'WFI' shares its 2 LSbits; it waits until an enabled
+              # interrupt is pending, even if 'MSTATUS.MIE' is clear.
               with m.Case( 1 ):
-                self.trigger_trap( m, TRAP_BREAK, Past( self.pc ) )
+                with m.If( self.ir[ 20 : 32 ] == IMM_WFI ):
+                  if self.wfi:
+                    with m.If( ~wake ):
+                      m.d.comb += [
+                        self.npc.eq( self.pc ),
+                        dstall.eq( 1 ),
+                        wfi.eq( 1 )
+                      ]
+                      m.d.sync += iws.eq( 2 )
+                with m.Else():
+                  self.trigger_trap( m, TRAP_BREAK, self.pc )
               # 'MRET' jumps to the stored 'pre-trap' PC in the
               # 30 MSbits of the MEPC CSR.
+              # (It also switches back to the main register bank.)
               with m.Case( 2 ):
-                m.d.sync += [
-                  self.csr.mstatus_mie.eq( 1 ),
-                  self.pc.eq( Cat( Repl( 0, 2 ),
-                                   self.csr.mepc_mepc ) )
+                m.d.sync += self.csr.mstatus_mie.eq( 1 )
+                if self.shadow:
+                  m.d.sync += self.bank.eq( 0 )
+                m.d.comb += [
+                  self.npc.eq( self.mepc() ),
+                  self.redirect.eq( 1 )
                 ]
           # Defer to the CSR module for atomic CSR reads/writes.
           # 'CSRR[WSC]': Write/Set/Clear CSR value from a register.
@@ -225,130 +974,608 @@ class CPU( Elaboratable ):
           with m.Else():
             m.d.comb += [
               self.rc.data.eq( self.csr.dat_r ),
-              self.rc.en.eq( self.rc.addr != 0 ),
+              self.rc.en.eq( self.wr() ),
               self.csr.we.eq( 1 )
             ]
+            # Registered CSR reads are ready on the next cycle.
+            if self.csrreg:
+              m.d.comb += [
+                self.csr.cyc.eq( 1 ),
+                self.csr.stb.eq( 1 )
+              ]
+              with m.If( ~self.csr.ack ):
+                m.d.comb += [
+                  self.rc.en.eq( 0 ),
+                  self.csr.we.eq( 0 ),
+                  self.npc.eq( self.pc ),
+                  dstall.eq( 1 )
+                ]
+                m.d.sync += iws.eq( 2 )
 
-        # FENCE instruction: clear any I-caches and ensure all
-        # memory operations are applied. There is no I-cache,
-        # and there is no caching of memory operations.
-        # There is also no pipelining. So...this is a nop.
-        with m.Case( OP_FENCE ):
-          pass
+        # Custom instructions: request the operation from the
+        # accelerator, and don't proceed until it is ready. (If there
+        # is no accelerator, they do nothing.)
+        if self.accel is not None:
+          with m.Case( *self.ops( '0-01011' ) ):
+            m.d.comb += [
+              self.acc.valid.eq( 1 ),
+              self.rc.en.eq( self.wr() )
+            ]
+            with m.If( ~self.acc.ready ):
+              m.d.comb += [
+                self.rc.en.eq( 0 ),
+                self.npc.eq( self.pc ),
+                dstall.eq( 1 )
+              ]
+              m.d.sync += iws.eq( 2 )
+
+        # FENCE instructions: memory operations are not cached, and
+        # only the store buffer re-orders them (if it is used), so
+        # 'FENCE' just waits for the store buffer to drain.
+        # 'FENCE.I' also invalidates the instruction cache and
+        # prefetch queue, if they are used.
+        # ('pipeline' mode may have already fetched the next two
+        #  instructions, so it re-fetches the next instruction.)
+        with m.Case( *self.ops( OP_FENCE ) ):
+          fenced = Signal( 1, reset = 1 )
+          if self.mem.sb is not None:
+            m.d.comb += [
+              fenced.eq( self.mem.sb.empty ),
+              self.sbwait.eq( ~self.mem.sb.empty )
+            ]
+          with m.If( fenced & ( self.ir[ 12 : 15 ] == F_FENCEI ) ):
+            m.d.comb += [
+              self.mem.fencei.eq( 1 ),
+              self.redirect.eq( 1 )
+            ]
+
+      # Fused pairs skip the second instruction. 'AUIPC' + 'JALR'
+      # jumps to the address that the ALU calculates.
+      with m.If( fuse ):
+        m.d.comb += self.hpe[ HPM_FUSED ].eq( 1 )
+        with m.If( self.ir[ 5 ] ):
+          m.d.comb += self.npc.eq( self.pc + 8 )
+        with m.Else():
+          m.d.comb += [
+            self.npc.eq( Cat( Repl( 0, 1 ), self.alu.y[ 1 : ] ) ),
+            self.redirect.eq( 1 )
+          ]
+
+      # Wait for the store buffer to drain if necessary.
+      with m.If( self.sbwait ):
+        m.d.comb += [
+          self.npc.eq( self.pc ),
+          dstall.eq( 1 )
+        ]
+        m.d.sync += iws.eq( 2 )
+
+      # 'Fast' mode: start fetching the next instruction as soon as
+      # its address is known, unless the current instruction is still
+      # waiting on the data bus. Mis-aligned addresses are left for
+      # the next cycle's 'instruction mis-aligned' trap.
+      if self.fast and not self.pipeline:
+        m.d.comb += self.mem.ibus.cyc.eq( ~dstall & ~bhit &
+          ( self.npc[ : ( 1 if self.compressed else 2 ) ] == 0 ) )
+
+    # Performance monitoring events: instruction cache hits and
+    # misses, if it is enabled, cycles spent waiting for the buses,
+    # and loads / stores which finish on this cycle.
+    if self.mem.ic is not None:
+      m.d.comb += [
+        self.hpe[ HPM_ICHIT ].eq( self.mem.ic.hit ),
+        self.hpe[ HPM_ICMISS ].eq( self.mem.ic.miss )
+      ]
+    m.d.comb += [
+      self.hpe[ HPM_IWAIT ].eq( self.mem.ibus.cyc & ~self.mem.ibus.ack ),
+      self.hpe[ HPM_DWAIT ].eq( self.mem.dbus.cyc & ~self.mem.dbus.ack ),
+      self.hpe[ HPM_LOAD ].eq( ( iws != 0 ) & ~dstall &
+                               ( self.ir[ 0 : 7 ] == OP_LOAD ) ),
+      self.hpe[ HPM_STORE ].eq( ( iws != 0 ) & ~dstall &
+                                ( self.ir[ 0 : 7 ] == OP_STORE ) )
+    ]
+
+    # Instructions retire once they finish executing. (Jumps to
+    # mis-aligned addresses retire once their trap is taken)
+    # The performance counters which count them are at the end.
+    with m.If( ( iws != 0 ) & ~dstall &
+               ( self.npc[ : ( 1 if self.compressed else 2 ) ] == 0 ) ):
+      m.d.comb += iret.eq( 1 )
+
+    # 'Pipeline' mode: fetch and decode upcoming instructions while
+    # the current instruction executes.
+    if self.pipeline:
+      # 'Decode' stage: holds an instruction which was fetched while
+      # the 'execute' stage was busy, and its branch prediction.
+      d_ir    = Signal( 32, reset = 0x00000000 )
+      d_ptk   = Signal( 1, reset = 0 )
+      d_valid = Signal( 1, reset = 0 )
+      # 'Fetch' stage: address of the instruction being requested,
+      # and the address to request next.
+      fpc     = Signal( 32, reset = 0x00000000 )
+      fadr    = Signal( 32, reset = 0x00000000 )
+      # Word returned by the memory that 'fpc' points to. This is
+      # taken from the memory's own bus rather than the multiplexer,
+      # which selects its read data using the current bus address.
+      fdat    = Signal( 32, reset = 0x00000000 )
+      # Predecoded fields for the instructions in the 'decode' stage
+      # and from the 'fetch' stage. (Only used with 'predecode')
+      d_pd    = Signal( PD_W, reset = 0 )
+      fpd     = Signal( PD_W, reset = 0 )
+      # Flag which is set if the 'execute' stage will take a new
+      # instruction at the end of this cycle.
+      adv     = Signal( 1, reset = 0 )
+      # Flag which is set if a fetched instruction arrives this cycle,
+      # and it should not be discarded.
+      fack    = Signal( 1, reset = 0 )
+      # Flag which is set if the fetched instruction is predicted to
+      # jump or branch, and the address that it will go to.
+      fpred   = Signal( 1, reset = 0 )
+      ftgt    = Signal( 32, reset = 0x00000000 )
+      # The next instruction to execute, if there is one.
+      n_ir    = Signal( 32, reset = 0x00000000 )
+      n_ptk   = Signal( 1, reset = 0 )
+      n_valid = Signal( 1, reset = 0 )
+      # Flag which is set if the 'decode' stage will be occupied on
+      # the next cycle, so no new fetch can be started.
+      d_full  = Signal( 1, reset = 0 )
+      m.d.comb += [
+        adv.eq( ( iws == 0 ) | ~dstall ),
+        fdat.eq( self.mem.idat( fpc ) ),
+        fack.eq( self.mem.ibus.ack & ~self.redirect ),
+        n_ir.eq( Mux( d_valid, d_ir, fdat ) ),
+        n_ptk.eq( Mux( d_valid, d_ptk, fpred ) ),
+        n_valid.eq( d_valid | fack ),
+        d_full.eq( Mux( adv,
+                        d_valid & fack & ~self.redirect & ~fuse,
+                        d_valid | fack ) ),
+        # Read the next instruction's source registers if it moves
+        # into the 'execute' stage, so that they are ready on the
+        # next cycle. Otherwise, keep reading the current ones.
+        # (Fused pairs skip the instruction in the 'decode' stage.)
+        self.ra.addr.eq( Mux( adv, Mux( fuse, fdat, n_ir )[ 15 : 20 ],
+                                   self.ir[ 15 : 20 ] ) ),
+        self.rb.addr.eq( Mux( adv, Mux( fuse, fdat, n_ir )[ 20 : 25 ],
+                                   self.ir[ 20 : 25 ] ) ),
+        # Fetch from the new PC if the current instruction redirects
+        # execution, from the predicted target if a jump or branch
+        # was just fetched, or the next word if the last fetch
+        # finished. Fetches are always word-aligned, so the bus
+        # address' 2 LSbits are left at zero.
+        fadr.eq( Mux( self.redirect, self.npc,
+                 Mux( fpred, ftgt,
+                 Mux( self.mem.ibus.ack, fpc + 4, fpc ) ) ) ),
+        self.mem.ibus.adr.eq( fadr[ 2 : ] )
+      ]
+      m.d.sync += fpc.eq( fadr )
+      if self.predecode:
+        m.d.comb += fpd.eq( self.mem.ipd( fpc ) )
+
+      # Static branch prediction: JAL always jumps, and conditional
+      # branches are predicted to be taken if they go backwards.
+      # Start fetching from the target address right away, since it
+      # only depends on the instruction and its address.
+      if self.predict:
+        with m.If( fack ):
+          with m.Switch( fdat[ 0 : 7 ] ):
+            with m.Case( OP_JAL ):
+              m.d.comb += [
+                fpred.eq( 1 ),
+                ftgt.eq( fpc + Cat(
+                  Repl( 0, 1 ),
+                  fdat[ 21: 31 ],
+                  fdat[ 20 ],
+                  fdat[ 12 : 20 ],
+                  Repl( fdat[ 31 ], 12 ) ) )
+              ]
+            with m.Case( OP_BRANCH ):
+              m.d.comb += [
+                fpred.eq( fdat[ 31 ] ),
+                ftgt.eq( fpc + Cat(
+                  Repl( 0, 1 ),
+                  fdat[ 8 : 12 ],
+                  fdat[ 25 : 31 ],
+                  fdat[ 7 ],
+                  Repl( fdat[ 31 ], 20 ) ) )
+              ]
+
+      # Keep fetching as long as there is room for the results.
+      # Memories which can return one word per cycle keep 'cyc'
+      # asserted between transactions; others need it to fall after
+      # each 'ack'. Mis-aligned addresses are not fetched; the
+      # 'instruction mis-aligned' trap triggers once the PC reaches
+      # them instead.
+      m.d.comb += self.mem.ibus.cyc.eq(
+        ~d_full & ( fadr[ :2 ] == 0 ) &
+        ~( self.mem.ibus.ack & ~self.mem.ipipe( fpc ) ) )
+
+      # Macro-op fusion: check whether the current instruction is a
+      # 'LUI' or 'AUIPC', and the next one is an 'ADDI' or 'JALR' which
+      # only uses its destination register. The next instruction can
+      # come from the 'decode' stage, or arrive from the 'fetch' stage.
+      # (Fused jumps to mis-aligned addresses are not allowed, so that
+      #  the 'instruction mis-aligned' trap reports the right address.)
+      if self.fuse:
+        m.d.comb += f_ir.eq( Mux( d_valid, d_ir, fdat ) )
+        with m.If( ( iws != 0 ) & ~dstall &
+                   ( d_valid | ( self.mem.ibus.ack &
+                                 ( fpc == ( self.pc + 4 ) ) ) ) &
+                   ( f_ir[ 7 : 12 ] == self.ir[ 7 : 12 ] ) &
+                   ( f_ir[ 15 : 20 ] == self.ir[ 7 : 12 ] ) &
+                   ( f_ir[ 12 : 15 ] == 0b000 ) ):
+          with m.If( ( self.ir[ 0 : 7 ] == OP_LUI ) &
+                     ( f_ir[ 0 : 7 ] == OP_IMM ) ):
+            m.d.comb += fuse.eq( 1 )
+          with m.If( ( self.ir[ 0 : 7 ] == OP_AUIPC ) &
+                     ( f_ir[ 0 : 7 ] == OP_JALR ) &
+                     ( self.alu.y[ 1 ] == 0 ) ):
+            m.d.comb += fuse.eq( 1 )
+
+      # Flush the pipeline if the current instruction jumps,
+      # branches, or traps.
+      with m.If( self.redirect ):
+        m.d.sync += [
+          iws.eq( 0 ),
+          d_valid.eq( 0 )
+        ]
+      # Fused pairs: skip the second instruction, and move the one
+      # after it into the 'execute' stage if it has been fetched.
+      with m.Elif( fuse ):
+        m.d.sync += [
+          iws.eq( d_valid & fack ),
+          self.ir.eq( fdat ),
+          self.pd.eq( fpd ),
+          ptk.eq( fpred ),
+          d_valid.eq( 0 )
+        ]
+      # Move the next instruction into the 'execute' stage. If it
+      # came from the 'decode' stage, a newly-fetched instruction
+      # can take its place.
+      with m.Elif( adv ):
+        m.d.sync += [
+          iws.eq( n_valid ),
+          self.ir.eq( n_ir ),
+          self.pd.eq( Mux( d_valid, d_pd, fpd ) ),
+          ptk.eq( n_ptk ),
+          d_valid.eq( d_valid & fack ),
+          d_ir.eq( fdat ),
+          d_pd.eq( fpd ),
+          d_ptk.eq( fpred )
+        ]
+      # Hold newly-fetched instructions in the 'decode' stage if the
+      # current instruction is still waiting on the data bus.
+      with m.Elif( fack ):
+        m.d.sync += [
+          d_valid.eq( 1 ),
+          d_ir.eq( fdat ),
+          d_pd.eq( fpd ),
+          d_ptk.eq( fpred )
+        ]
 
     # 'Always-on' decode/execute logic:
-    with m.Switch( self.mem.imux.bus.dat_r[ 0 : 7 ] ):
+    with m.Switch( self.opc() ):
       # LUI / AUIPC instructions: set destination register to
       # 20 upper bits, +pc for AUIPC.
-      with m.Case( '0-10111' ):
+      with m.Case( *self.ops( '0-10111' ) ):
         m.d.comb += self.rc.data.eq(
-          Mux( self.mem.imux.bus.dat_r[ 5 ], 0, self.pc ) +
-          Cat( Repl( 0, 12 ),
-               self.mem.imux.bus.dat_r[ 12 : 32 ] ) )
+          Mux( self.ir[ 5 ], 0, self.pc ) + self.imm( 'U' ) )
+        # Fused pairs: add the next instruction's immediate value
+        # using the ALU. 'AUIPC' + 'JALR' writes the return address.
+        if self.pipeline and self.fuse:
+          m.d.comb += [
+            self.alu.a.eq( Mux( self.ir[ 5 ], 0, self.pc ) +
+                           self.imm( 'U' ) ),
+            self.alu.b.eq( Cat( f_ir[ 20 : 32 ],
+                                Repl( f_ir[ 31 ], 20 ) ) ),
+            self.alu.f.eq( ALU_ADD )
+          ]
+          with m.If( fuse ):
+            m.d.comb += self.rc.data.eq(
+              Mux( self.ir[ 5 ], self.alu.y, self.pc + 8 ) )
 
       # JAL / JALR instructions: set destination register to
-      # the 'return PC' value.
-      with m.Case( '110-111' ):
-        m.d.comb += self.rc.data.eq( self.pc + 4 )
+      # the 'return PC' value, and calculate JALR's target.
+      with m.Case( *self.ops( '110-111' ) ):
+        m.d.comb += [
+          self.rc.data.eq( self.pc + self.ilen() ),
+          jalr.eq( rs1 + self.imm( 'I' ) )
+        ]
 
       # Conditional branch instructions:
       # set us up the ALU for the condition check.
-      with m.Case( OP_BRANCH ):
+      with m.Case( *self.ops( OP_BRANCH ) ):
         # BEQ / BNE: use SUB ALU operation to check equality.
         # BLT / BGE / BLTU / BGEU: use SLT or SLTU ALU operation.
         m.d.comb += [
-          self.alu.a.eq( self.ra.data ),
-          self.alu.b.eq( self.rb.data ),
+          self.alu.a.eq( rs1 ),
+          self.alu.b.eq( rs2 ),
           self.alu.f.eq( Mux(
-            self.mem.imux.bus.dat_r[ 14 ],
-            Cat( self.mem.imux.bus.dat_r[ 13 ], 0b001 ),
+            self.ir[ 14 ],
+            Cat( self.ir[ 13 ], 0b001 ),
             0b1000 ) )
         ]
 
       # Load instructions: Set the memory address and data register.
-      with m.Case( OP_LOAD ):
+      with m.Case( *self.ops( OP_LOAD ) ):
         m.d.comb += [
-          self.mem.dmux.bus.adr.eq( self.ra.data +
-            Cat( self.mem.imux.bus.dat_r[ 20 : 32 ],
-                 Repl( self.mem.imux.bus.dat_r[ 31 ], 20 ) ) ),
-          self.rc.data.bit_select( 0, 8 ).eq(
-            self.mem.dmux.bus.dat_r[ :8 ] )
+          dadr.eq( rs1 + self.imm( 'I' ) ),
+          self.rc.data.eq( self.ld_ext( self.ir[ 12 : 15 ], drd ) )
         ]
-        with m.If( self.mem.imux.bus.dat_r[ 12 ] ):
+        # Loads which span two words: read the next word, and combine
+        # its LSbytes with the first word's MSbytes.
+        if self.misaligned:
+          with m.If( cross & lsh ):
+            m.d.comb += self.rc.data.eq( self.ld_ext( self.ir[ 12 : 15 ],
+              ( Cat( ldlo, self.mem.dbus.dat_r ) >>
+                Cat( Repl( 0, 3 ), dadr[ :2 ] ) )[ :32 ] ) )
+
+      # Store instructions: Set the memory address. (Stores which
+      # span two words write the byte lanes up to the end of the
+      # first word, then the rest at the start of the next one.)
+      with m.Case( *self.ops( OP_STORE ) ):
+        m.d.comb += dadr.eq( rs1 + self.imm( 'S' ) )
+
+      # Atomic memory operations: the address is rs1. 'LR.W' returns
+      # the loaded word, 'SC.W' writes rs2 and returns 0 if it
+      # succeeds or 1 if it fails, and AMOs return the word that
+      # they read and write the result of an ALU operation on it and
+      # rs2. ('MIN' / 'MAX' use the 'SLT' / 'SLTU' comparison flag
+      #  to pick one of them)
+      if self.atomic:
+        with m.Case( *self.ops( OP_AMO ) ):
           m.d.comb += [
-            self.rc.data.bit_select( 8, 8 ).eq(
-              self.mem.dmux.bus.dat_r[ 8 : 16 ] ),
-            self.rc.data.bit_select( 16, 16 ).eq(
-              Repl( ( self.mem.imux.bus.dat_r[ 14 ] == 0 ) &
-                    self.mem.dmux.bus.dat_r[ 15 ], 16 ) )
+            dadr.eq( rs1 ),
+            scok.eq( rsv & ( rsva == dadr[ 2 : ] ) ),
+            self.rc.data.eq( amov ),
+            self.alu.a.eq( amov ),
+            self.alu.b.eq( rs2 ),
+            amoy.eq( self.alu.y ),
+            dstw.eq( amoy )
           ]
-        with m.Elif( self.mem.imux.bus.dat_r[ 13 ] ):
-          m.d.comb += self.rc.data.bit_select( 8, 24 ).eq(
-            self.mem.dmux.bus.dat_r[ 8 : 32 ] )
-        with m.Else():
-          m.d.comb += self.rc.data.bit_select( 8, 24 ).eq(
-            Repl( ( self.mem.imux.bus.dat_r[ 14 ] == 0 ) &
-                  self.mem.dmux.bus.dat_r[ 7 ], 24 ) )
-
-      # Store instructions: Set the memory address.
-      with m.Case( OP_STORE ):
-        m.d.comb += self.mem.dmux.bus.adr.eq( self.ra.data +
-          Cat( self.mem.imux.bus.dat_r[ 7 : 12 ],
-               self.mem.imux.bus.dat_r[ 25 : 32 ],
-               Repl( self.mem.imux.bus.dat_r[ 31 ], 20 ) ) )
+          with m.Switch( self.ir[ 27 : 32 ] ):
+            with m.Case( FF_LR ):
+              m.d.comb += self.rc.data.eq( drd )
+            with m.Case( FF_SC ):
+              m.d.comb += [
+                self.rc.data.eq( aph == 0 ),
+                amoy.eq( rs2 )
+              ]
+            with m.Case( FF_AMOSWAP ):
+              m.d.comb += amoy.eq( rs2 )
+            with m.Case( FF_AMOADD ):
+              m.d.comb += self.alu.f.eq( ALU_ADD )
+            with m.Case( FF_AMOXOR ):
+              m.d.comb += self.alu.f.eq( ALU_XOR )
+            with m.Case( FF_AMOOR ):
+              m.d.comb += self.alu.f.eq( ALU_OR )
+            with m.Case( FF_AMOAND ):
+              m.d.comb += self.alu.f.eq( ALU_AND )
+            with m.Default():
+              m.d.comb += [
+                self.alu.f.eq( Mux( self.ir[ 30 ], ALU_SLTU, ALU_SLT ) ),
+                amoy.eq( Mux( self.alu.cmp ^ self.ir[ 29 ],
+                              amov, rs2 ) )
+              ]
 
       # R-type ALU operation: set inputs for rc = ra ? rb
-      with m.Case( OP_REG ):
+      with m.Case( *self.ops( OP_REG ) ):
         # Implement left shifts using the right shift ALU operation.
-        with m.If( self.mem.imux.bus.dat_r[ 12 : 15 ] == 0b001 ):
+        with m.If( self.ir[ 12 : 15 ] == 0b001 ):
           m.d.comb += [
-            self.alu.a.eq( FLIP( self.ra.data ) ),
+            self.alu.a.eq( FLIP( rs1 ) ),
             self.alu.f.eq( 0b0101 ),
             self.rc.data.eq( FLIP( self.alu.y ) )
           ]
         with m.Else():
           m.d.comb += [
-            self.alu.a.eq( self.ra.data ),
+            self.alu.a.eq( rs1 ),
             self.alu.f.eq( Cat(
-              self.mem.imux.bus.dat_r[ 12 : 15 ],
-              self.mem.imux.bus.dat_r[ 30 ] ) ),
+              self.ir[ 12 : 15 ],
+              self.ir[ 30 ] ) ),
             self.rc.data.eq( self.alu.y ),
           ]
-        m.d.comb += self.alu.b.eq( self.rb.data )
+        m.d.comb += self.alu.b.eq( rs2 )
+        # 'M' extension instructions: use the multiply / divide
+        # unit's result instead.
+        if self.rv32m:
+          with m.If( self.ir[ 25 : 32 ] == FF_MULDIV ):
+            m.d.comb += self.rc.data.eq( self.md.y )
+        # Bit-manipulation instructions: modify the ALU inputs and
+        # function select bits. ('ROL' uses the left shift logic)
+        if self.bitmanip:
+          with m.Switch( self.ir[ 25 : 32 ] ):
+            # 'ANDN' / 'ORN' / 'XNOR': invert the 'B' input.
+            # ('SUB' and 'SRA' use the same 'funct7' bits)
+            with m.Case( FF_ANDN ):
+              with m.If( self.ir[ 14 ] & ( self.ir[ 12 : 14 ] != 0b01 ) ):
+                m.d.comb += self.alu.b.eq( ~rs2 )
+            # 'SH1ADD' / 'SH2ADD' / 'SH3ADD': shift the 'A' input.
+            with m.Case( FF_SHADD ):
+              m.d.comb += [
+                self.alu.a.eq( rs1 << self.ir[ 13 : 15 ] ),
+                self.alu.f.eq( ALU_ADD )
+              ]
+            # 'MIN' / 'MINU' / 'MAX' / 'MAXU'
+            with m.Case( FF_MINMAX ):
+              m.d.comb += self.alu.f.eq( Cat( self.ir[ 12 : 14 ], 0b101 ) )
+            # 'ROL' / 'ROR'
+            with m.Case( FF_ROT ):
+              m.d.comb += self.alu.f.eq( ALU_ROR )
+
+      # Custom instructions: set destination register to the
+      # accelerator's result.
+      if self.accel is not None:
+        with m.Case( *self.ops( '0-01011' ) ):
+          m.d.comb += self.rc.data.eq( self.acc.y )
 
       # I-type ALU operation: set inputs for rc = ra ? immediate
-      with m.Case( OP_IMM ):
+      with m.Case( *self.ops( OP_IMM ) ):
         # Shift operations are a bit different from normal I-types.
         # They use 'funct7' bits like R-type operations, and the
         # left shift can be implemented as a right shift to avoid
         # having two barrel shifters in the ALU.
-        with m.If( self.mem.imux.bus.dat_r[ 12 : 14 ] == 0b01 ):
-          with m.If( self.mem.imux.bus.dat_r[ 14 ] == 0 ):
+        with m.If( self.ir[ 12 : 14 ] == 0b01 ):
+          with m.If( self.ir[ 14 ] == 0 ):
             m.d.comb += [
-              self.alu.a.eq( FLIP( self.ra.data ) ),
+              self.alu.a.eq( FLIP( rs1 ) ),
               self.alu.f.eq( 0b0101 ),
               self.rc.data.eq( FLIP( self.alu.y ) ),
             ]
           with m.Else():
             m.d.comb += [
-              self.alu.a.eq( self.ra.data ),
-              self.alu.f.eq( Cat( 0b101, self.mem.imux.bus.dat_r[ 30 ] ) ),
+              self.alu.a.eq( rs1 ),
+              self.alu.f.eq( Cat( 0b101, self.ir[ 30 ] ) ),
               self.rc.data.eq( self.alu.y ),
             ]
         # Normal I-type operation:
         with m.Else():
           m.d.comb += [
-            self.alu.a.eq( self.ra.data ),
-            self.alu.f.eq( self.mem.imux.bus.dat_r[ 12 : 15 ] ),
+            self.alu.a.eq( rs1 ),
+            self.alu.f.eq( self.ir[ 12 : 15 ] ),
             self.rc.data.eq( self.alu.y ),
           ]
         # Shared I-type logic:
-        m.d.comb += self.alu.b.eq( Cat(
-          self.mem.imux.bus.dat_r[ 20 : 32 ],
-          Repl( self.mem.imux.bus.dat_r[ 31 ], 20 ) ) )
+        m.d.comb += self.alu.b.eq( self.imm( 'I' ) )
+        # Bit-manipulation instructions: these are also encoded like
+        # shift operations. 'CTZ' counts leading zeros in the flipped
+        # input, and 'RORI' / 'REV8' replace the right shift.
+        if self.bitmanip:
+          with m.If( ( self.ir[ 12 : 15 ] == F_UNARY ) &
+                     ( self.ir[ 25 : 32 ] == FF_ROT ) ):
+            m.d.comb += [
+              self.alu.a.eq( rs1 ),
+              self.rc.data.eq( self.alu.y )
+            ]
+            with m.Switch( self.ir[ 20 : 25 ] ):
+              with m.Case( IMM_CLZ & 0x1F ):
+                m.d.comb += self.alu.f.eq( ALU_CLZ )
+              with m.Case( IMM_CTZ & 0x1F ):
+                m.d.comb += [
+                  self.alu.a.eq( FLIP( rs1 ) ),
+                  self.alu.f.eq( ALU_CLZ )
+                ]
+              with m.Case( IMM_CPOP & 0x1F ):
+                m.d.comb += self.alu.f.eq( ALU_CPOP )
+              with m.Case( IMM_SEXTB & 0x1F ):
+                m.d.comb += self.alu.f.eq( ALU_SEXTB )
+              with m.Case( IMM_SEXTH & 0x1F ):
+                m.d.comb += self.alu.f.eq( ALU_SEXTH )
+          with m.If( ( self.ir[ 12 : 15 ] == F_RORI ) &
+                     ( self.ir[ 25 : 32 ] == FF_ROT ) ):
+            m.d.comb += self.alu.f.eq( ALU_ROR )
+          with m.If( ( self.ir[ 12 : 15 ] == F_REV8 ) &
+                     ( self.ir[ 20 : 32 ] == IMM_REV8 ) ):
+            m.d.comb += self.alu.f.eq( ALU_REV8 )
+
+    # Non-blocking load unit: keep the load on the data bus until it
+    # finishes, then write the result to its destination register.
+    # The current instruction's register write takes priority, so the
+    # result is held until the write port is free if necessary.
+    if self.nbload:
+      lack = Signal( 1, reset = 0 )
+      lwb  = Signal( 1, reset = 0 )
+      m.d.comb += [
+        lack.eq( lpend & self.mem.dbus.ack ),
+        lwb.eq( ( lack | lvalid ) &
+                ~( ( iws != 0 ) & ~ldstall & xwr &
+                   ( self.ir[ 7 : 12 ] != 0 ) ) )
+      ]
+      with m.If( lpend ):
+        m.d.comb += [
+          dadr.eq( ladr ),
+          dwid.eq( lf3[ :2 ] ),
+          self.mem.dbus.cyc.eq( ~self.mem.dbus.ack ),
+          self.mem.dbus.we.eq( 0 )
+        ]
+        with m.If( self.mem.dbus.ack ):
+          m.d.sync += lpend.eq( 0 )
+      with m.If( lwb ):
+        m.d.comb += [
+          self.rc.addr.eq( lrd ),
+          wbank.eq( lbank ),
+          self.rc.data.eq( Mux( lvalid, ldat,
+                                self.ld_ext( lf3, drd ) ) ),
+          self.rc.en.eq( lrd != 0 )
+        ]
+        m.d.sync += [
+          lvalid.eq( 0 ),
+          busy.bit_select( lrd, 1 ).eq( 0 )
+        ]
+      with m.Elif( lack ):
+        m.d.sync += [
+          lvalid.eq( 1 ),
+          ldat.eq( self.ld_ext( lf3, drd ) )
+        ]
+
+    # Shadow register bank: the bank selects which half of the CPU
+    # register memory is read and written. (A pending non-blocking
+    # load writes to the bank that it was started in.)
+    if self.shadow:
+      m.d.comb += [
+        self.ra.addr[ 5 ].eq( self.bank ),
+        self.rb.addr[ 5 ].eq( self.bank ),
+        self.rc.addr[ 5 ].eq( wbank )
+      ]
+
+    # Cancel the 'LR.W' reservation if its word is written, by this
+    # hart or by any other bus master.
+    if self.atomic:
+      with m.If( self.mem.snoop.cyc & self.mem.snoop.we &
+                 ( self.mem.snoop.adr == rsva ) ):
+        m.d.sync += rsv.eq( 0 )
+
+    # Top-level module: the memory and CSR modules, interrupt inputs,
+    # and the core logic, which is clock-gated while 'WFI' waits. The clock is
+    # only gated once the buses are idle, so no transaction is left
+    # half-finished, and it is re-enabled on the same cycle that an
+    # enabled interrupt arrives.
+    top = Module()
+    if not self.shared:
+      top.submodules.mem = self.mem
+    top.d.comb += [
+      self.csr.mip_meip.eq( self.irq ),
+      wake.eq( self.csr.mie_meie & self.csr.mip_meip )
+    ]
+    # (Only the core logic is gated: the fetch-side memories and the
+    #  instruction cache are idle while it sleeps, but they are not
+    #  clock-gated themselves)
+    cen = Signal( 1, reset = 1 )
+    if self.wfi:
+      top.submodules.core = EnableInserter( cen )( m )
+      top.d.comb += cen.eq( ~self.sleep | wake )
+      top.d.sync += self.sleep.eq( wfi & ~wake &
+        ~( self.mem.ibus.cyc | self.mem.ibus.ack |
+           self.mem.dbus.cyc | self.mem.dbus.ack ) )
+      with top.If( self.sleep & ~wake ):
+        top.d.sync += self.gcycles.eq( self.gcycles + 1 )
+    else:
+      top.submodules.core = m
+    # The CSRs are not gated, so that the counters keep counting.
+    # (The core only writes to them while it is clocked)
+    top.submodules.csr = self.csr
+
+    # Performance counters: 'MCYCLE' counts every cycle, including
+    # cycles where the core's clock is gated, 'MINSTRET' counts
+    # retired instructions, (fused pairs count as 2) and each
+    # 'MHPMCOUNTER' counts the event that its 'MHPMEVENT' CSR selects.
+    # Each counter stops while its 'MCOUNTINHIBIT' bit is set. They
+    # are outside of the gated core logic, so instructions and events
+    # are only counted while the core is clocked.
+    mcycle = Cat( self.csr.mcycle_cycles, self.csr.mcycleh_cycles )
+    minstret = Cat( self.csr.minstret_instrs, self.csr.minstreth_instrs )
+    with top.If( ~self.csr.mcountinhibit_cy ):
+      top.d.sync += mcycle.eq( mcycle + 1 )
+    with top.If( cen & ~self.csr.mcountinhibit_ir & iret ):
+      top.d.sync += minstret.eq( minstret + 1 + fuse )
+    for i in range( 3, 7 ):
+      hpmc = Cat( getattr( self.csr, "mhpmcounter%d_count"%i ),
+                  getattr( self.csr, "mhpmcounter%dh_count"%i ) )
+      with top.If( cen & ~self.csr.mcountinhibit_hpm[ i - 3 ] &
+                   self.hpe.bit_select(
+                     getattr( self.csr, "mhpmevent%d_event"%i ), 1 ) ):
+        top.d.sync += hpmc.eq( hpmc + 1 )
 
     # End of CPU module definition.
-    return m
+    return top
 
 ##################
 # CPU testbench: #
@@ -356,13 +1583,19 @@ class CPU( Elaboratable ):
 # Keep track of test pass / fail rates.
 p = 0
 f = 0
+# Keep track of simulated cycles and retired instructions for each
+# core configuration, to report 'cycles per instruction' figures.
+cpi = {}
+# Average trap handler entry-to-exit cycles, for each core
+# configuration and handler program.
+trap_cycles = {}
 
 # Import test programs and expected runtime register values.
 from programs import *
 
 # Helper method to check expected CPU register / memory values
 # at a specific point during a test program.
-def check_vals( expected, ni, cpu ):
+def check_vals( expected, ni, cpu, deferred = None ):
   global p, f
   if ni in expected:
     for j in range( len( expected[ ni ] ) ):
@@ -390,6 +1623,19 @@ def check_vals( expected, ni, cpu ):
                  %( hexs( ex[ 'e' ] ), rama, ni ) )
         else:
           cpd = yield cpu.mem.ram.data[ rama // 4 ]
+          # (Stores which are still in the store buffer are applied
+          #  on top, since loads would see them too)
+          if cpu.mem.sb is not None:
+            sbn = yield cpu.mem.sb.count
+            for k in range( sbn ):
+              sba = yield cpu.mem.sb.adr[ k ]
+              sbd = yield cpu.mem.sb.dat[ k ]
+              sbs = yield cpu.mem.sb.sel[ k ]
+              if sba == ( ( 0x20000000 + rama ) >> 2 ):
+                for b in range( 4 ):
+                  if ( sbs >> b ) & 1:
+                    lane = 0xFF << ( b * 8 )
+                    cpd = ( cpd & ~lane ) | ( sbd & lane )
           if hexs( cpd ) == hexs( ex[ 'e' ] ):
             p += 1
             print( "  \033[32mPASS:\033[0m RAM == %s @ 0x%08X"
@@ -401,7 +1647,14 @@ def check_vals( expected, ni, cpu ):
                    " after %d operations (got: %s)"
                    %( hexs( ex[ 'e' ] ), rama, ni, hexs( cpd ) ) )
       # Numbered general-purpose registers.
-      elif ex[ 'r' ] >= 0 and ex[ 'r' ] < 32:
+      # (With a shadow register bank, r32-r63 are the shadow registers)
+      elif ex[ 'r' ] >= 0 and ex[ 'r' ] < cpu.r.depth:
+        # Registers which are waiting for a non-blocking load are
+        # checked later, once the load finishes.
+        busy = yield cpu.busy
+        if ( deferred is not None ) and ( ( busy >> ex[ 'r' ] ) & 1 ):
+          deferred.append( ( ni, ex ) )
+          continue
         cr = yield cpu.r[ ex[ 'r' ] ]
         if hexs( cr ) == hexs( ex[ 'e' ] ):
           p += 1
@@ -415,42 +1668,114 @@ def check_vals( expected, ni, cpu ):
                  %( ex[ 'r' ], hexs( ex[ 'e' ] ),
                     ni, hexs( cr ) ) )
 
+# Helper method to read a 64-bit counter from its low and high CSRs.
+def csr64( lo, hi ):
+  return ( yield lo ) | ( ( yield hi ) << 32 )
+
 # Helper method to run a CPU device for a given number of cycles,
 # and verify its expected register values over time.
 def cpu_run( cpu, expected ):
   global p, f
-  # Record how many CPU instructions have been executed.
-  ni = -1
+  # Record how many CPU instructions have been executed,
+  # and how many clock cycles it took to execute them.
+  ni = 0
+  nc = 0
   # Watch for timeouts if the CPU gets into a bad state.
   timeout = 0
   instret = 0
+  # Register checks which are waiting for non-blocking loads.
+  deferred = []
+  # Check the initial values, before any instructions finish.
+  yield Settle()
+  yield from check_vals( expected, ni, cpu, deferred )
   # Let the CPU run for N instructions.
-  while ni <= expected[ 'end' ]:
+  while ( ni <= expected[ 'end' ] ) or ( len( deferred ) > 0 ):
     # Let combinational logic settle before checking values.
     yield Settle()
     timeout = timeout + 1
+    # Check deferred register values if their loads have finished.
+    busy = yield cpu.busy
+    for d in [ d for d in deferred if not ( busy >> d[ 1 ][ 'r' ] ) & 1 ]:
+      deferred.remove( d )
+      yield from check_vals( { d[ 0 ]: [ d[ 1 ] ] }, d[ 0 ], cpu )
     # Only check expected values once per instruction.
-    ninstret = yield cpu.csr.minstret_instrs
+    ninstret = yield from csr64( cpu.csr.minstret_instrs,
+                                 cpu.csr.minstreth_instrs )
     if ninstret != instret:
-      ni += 1
+      # (Fused instruction pairs are counted together, so the counter
+      #  can increase by two. The state between them is never visible.)
+      ni += ( ninstret - instret )
       instret = ninstret
       timeout = 0
       # Check expected values, if any.
-      yield from check_vals( expected, ni, cpu )
+      yield from check_vals( expected, ni, cpu, deferred )
     elif timeout > 1000:
       f += 1
       print( "\033[31mFAIL: Timeout\033[0m" )
       break
     # Step the simulation.
     yield Tick()
+    nc += 1
+  return ( nc, ni )
+
+# Helper method to record and print the number of cycles per
+# instruction from a finished test program.
+def cpu_cpi( name, cfg, nc, ni ):
+  cpi.setdefault( cfg, [ 0, 0 ] )
+  cpi[ cfg ][ 0 ] += nc
+  cpi[ cfg ][ 1 ] += ni
+  print( "\033[35mDONE\033[0m running %s: executed %d instructions"
+         " in %d cycles (CPI: %.2f)"
+         %( name, ni, nc, ( nc / max( ni, 1 ) ) ) )
+
+# Helper method to print performance counters after a test program
+# finishes: how many branches were mis-predicted, if branch prediction
+# is enabled, how many fetches hit the prefetch queue and the
+# instruction cache, and how many instruction pairs were fused,
+# if they are used.
+# (These are the events that the 'MHPMCOUNTER' CSRs count by default)
+def cpu_stats( cpu ):
+  if cpu.pipeline and cpu.predict:
+    nm = yield from csr64( cpu.csr.mhpmcounter3_count,
+                           cpu.csr.mhpmcounter3h_count )
+    print( "  Branch mis-predictions: %d"%nm )
+  if cpu.mem.pf is not None:
+    nh = yield cpu.mem.pf.hits
+    nm = yield cpu.mem.pf.misses
+    print( "  Prefetch queue: %d hits, %d misses"%( nh, nm ) )
+  if cpu.mem.ic is not None:
+    nh = yield from csr64( cpu.csr.mhpmcounter4_count,
+                           cpu.csr.mhpmcounter4h_count )
+    nm = yield from csr64( cpu.csr.mhpmcounter5_count,
+                           cpu.csr.mhpmcounter5h_count )
+    print( "  Instruction cache: %d hits, %d misses"%( nh, nm ) )
+  if cpu.pipeline and cpu.fuse:
+    nf = yield from csr64( cpu.csr.mhpmcounter6_count,
+                           cpu.csr.mhpmcounter6h_count )
+    print( "  Fused instruction pairs: %d"%nf )
+  if cpu.wfi:
+    ng = yield cpu.gcycles
+    print( "  Clock-gated cycles: %d"%ng )
+
+# Helper method to describe a core configuration for printing.
+# The configuration is a dictionary of CPU constructor arguments.
+# (Accelerators are described by their class names)
+def cfg_str( cfg ):
+  opts = [ ( k if v is True else
+             "%s=%s"%( k, getattr( v, '__name__', v ) ) )
+           for k, v in cfg.items() if v ]
+  return ", ".join( opts ) if opts else "base"
 
 # Helper method to simulate running a CPU with the given ROM image
 # for the specified number of CPU cycles. The 'name' field is used
 # for printing and generating the waveform filename: "cpu_[name].vcd".
-def cpu_sim( test ):
+# The 'cfg' field selects which core configuration to simulate.
+def cpu_sim( test, cfg = {} ):
   print( "\033[33mSTART\033[0m running '%s' program:"%test[ 0 ] )
-  # Create the CPU device.
-  dut = CPU( ROM( test[ 2 ] ) )
+  # Create the CPU device. If it uses predecoded instructions, the
+  # ROM image stores them too.
+  dut = CPU( ROM( test[ 2 ], predecode = cfg.get( 'predecode', False ) ),
+             **cfg )
   cpu = ResetInserter( dut.clk_rst )( dut )
 
   # Run the simulation.
@@ -461,20 +1786,104 @@ def cpu_sim( test ):
       for i in range( len( test[ 3 ] ) ):
         yield cpu.mem.ram.data[ i ].eq( LITTLE_END( test[ 3 ][ i ] ) )
       # Run the program and print pass/fail for individual tests.
-      yield from cpu_run( cpu, test[ 4 ] )
-      print( "\033[35mDONE\033[0m running %s: executed %d instructions"
-             %( test[ 0 ], test[ 4 ][ 'end' ] ) )
+      nc, ni = yield from cpu_run( cpu, test[ 4 ] )
+      cpu_cpi( test[ 0 ], "ROM, %s"%cfg_str( cfg ), nc, ni )
+      yield from cpu_stats( cpu )
+    sim.add_clock( 1 / 6000000 )
+    sim.add_sync_process( proc )
+    sim.run()
+
+# Helper method to simulate running a trap handler program, and
+# measure how many cycles the CPU spends in the handler per trap.
+# The handler starts at 'hadr' and runs to the end of the ROM, and
+# the program counts its traps in the first word of RAM.
+def cpu_trap_sim( test, hadr, cfg = {} ):
+  print( "\033[33mSTART\033[0m running '%s' program:"%test[ 0 ] )
+  dut = CPU( ROM( test[ 2 ], predecode = cfg.get( 'predecode', False ) ),
+             **cfg )
+  cpu = ResetInserter( dut.clk_rst )( dut )
+  hc = [ 0 ]
+
+  with Simulator( cpu, vcd_file = open( "%s.vcd"%test[ 1 ], 'w' ) ) as sim:
+    def proc():
+      nc, ni = yield from cpu_run( cpu, test[ 4 ] )
+      cpu_cpi( test[ 0 ], "ROM, %s"%cfg_str( cfg ), nc, ni )
+      nt = yield cpu.mem.ram.data[ 0 ]
+      trap_cycles[ ( test[ 0 ], cfg_str( cfg ) ) ] = hc[ 0 ] / max( nt, 1 )
+      print( "  Trap handler: %d traps, %.2f cycles per trap"
+             %( nt, hc[ 0 ] / max( nt, 1 ) ) )
+    # Count the cycles where the PC is in the handler.
+    def count():
+      yield Passive()
+      while True:
+        yield Settle()
+        if ( yield cpu.pc ) >= hadr:
+          hc[ 0 ] += 1
+        yield Tick()
     sim.add_clock( 1 / 6000000 )
     sim.add_sync_process( proc )
+    sim.add_sync_process( count )
+    sim.run()
+
+# Helper method to simulate running a program which waits for
+# interrupts, while the external interrupt input is pulsed once every
+# 'period' cycles. Reports how many cycles it took the core to move
+# past the instruction that it was on when each interrupt arrived.
+def cpu_wfi_sim( test, period, cfg = {} ):
+  print( "\033[33mSTART\033[0m running '%s' program:"%test[ 0 ] )
+  dut = CPU( ROM( test[ 2 ], predecode = cfg.get( 'predecode', False ) ),
+             **cfg )
+  cpu = ResetInserter( dut.clk_rst )( dut )
+  wl = []
+
+  with Simulator( cpu, vcd_file = open( "%s.vcd"%test[ 1 ], 'w' ) ) as sim:
+    def proc():
+      global p, f
+      nc, ni = yield from cpu_run( cpu, test[ 4 ] )
+      cpu_cpi( test[ 0 ], "ROM, %s"%cfg_str( cfg ), nc, ni )
+      yield from cpu_stats( cpu )
+      print( "  Wake-up latency: %d cycles (max)"%max( wl + [ 0 ] ) )
+      # 'MCYCLE' keeps counting while the clock is gated.
+      ncyc = yield from csr64( cpu.csr.mcycle_cycles,
+                               cpu.csr.mcycleh_cycles )
+      if ncyc != nc:
+        f += 1
+        print( "  \033[31mFAIL:\033[0m MCYCLE == %d (got: %d)"%( nc, ncyc ) )
+      else:
+        p += 1
+        print( "  \033[32mPASS:\033[0m MCYCLE == %d"%nc )
+    # Pulse the interrupt input, and time how long the PC stays put.
+    def irq():
+      yield Passive()
+      nc = 0
+      while True:
+        nc += 1
+        yield cpu.irq.eq( ( nc % period ) == 0 )
+        if ( nc % period ) == 0:
+          yield Settle()
+          pc = yield cpu.pc
+          lat = 0
+          while ( yield cpu.pc ) == pc:
+            yield Tick()
+            yield cpu.irq.eq( 0 )
+            yield Settle()
+            lat += 1
+            nc += 1
+          wl.append( lat )
+        yield Tick()
+    sim.add_clock( 1 / 6000000 )
+    sim.add_sync_process( proc )
+    sim.add_sync_process( irq )
     sim.run()
 
 # Helper method to simulate running a CPU from simulated SPI
 # Flash which contains a given ROM image.
-def cpu_spi_sim( test ):
+def cpu_spi_sim( test, cfg = {} ):
   print( "\033[33mSTART\033[0m running '%s' program (SPI):"%test[ 0 ] )
   # Create the CPU device.
   sim_spi_off = ( 2 * 1024 * 1024 )
-  dut = CPU( SPI_ROM( sim_spi_off, sim_spi_off + 1024, test[ 2 ] ) )
+  dut = CPU( SPI_ROM( sim_spi_off, sim_spi_off + 1024, test[ 2 ] ),
+             **cfg )
   cpu = ResetInserter( dut.clk_rst )( dut )
 
   # Run the simulation.
@@ -483,9 +1892,9 @@ def cpu_spi_sim( test ):
     def proc():
       for i in range( len( test[ 3 ] ) ):
         yield cpu.mem.ram.data[ i ].eq( test[ 3 ][ i ] )
-      yield from cpu_run( cpu, test[ 4 ] )
-      print( "\033[35mDONE\033[0m running %s: executed %d instructions"
-             %( test[ 0 ], test[ 4 ][ 'end' ] ) )
+      nc, ni = yield from cpu_run( cpu, test[ 4 ] )
+      cpu_cpi( test[ 0 ], "SPI, %s"%cfg_str( cfg ), nc, ni )
+      yield from cpu_stats( cpu )
     sim.add_clock( 1 / 6000000 )
     sim.add_sync_process( proc )
     sim.run()
@@ -538,19 +1947,111 @@ from tests.test_roms.rv32i_srli import *
 from tests.test_roms.rv32i_sub import *
 from tests.test_roms.rv32i_xor import *
 from tests.test_roms.rv32i_xori import *
+from tests.test_roms.rv32m_mul import *
+from tests.test_roms.rv32m_mulh import *
+from tests.test_roms.rv32m_mulhsu import *
+from tests.test_roms.rv32m_mulhu import *
+from tests.test_roms.rv32m_div import *
+from tests.test_roms.rv32m_divu import *
+from tests.test_roms.rv32m_rem import *
+from tests.test_roms.rv32m_remu import *
+
+# Collected RV32I compliance test programs.
+rv32i_tests = [
+  add_test, addi_test, and_test, andi_test,
+  auipc_test, beq_test, bge_test, bgeu_test,
+  blt_test, bltu_test, bne_test, delay_slots_test,
+  ebreak_test, ecall_test, endianess_test, io_test,
+  jal_test, jalr_test, lb_test, lbu_test,
+  lh_test, lhu_test, lw_test, lui_test,
+  misalign_jmp_test, misalign_ldst_test, nop_test, or_test,
+  ori_test, rf_size_test, rf_width_test, rf_x0_test,
+  sb_test, sh_test, sw_test, sll_test,
+  slli_test, slt_test, slti_test, sltu_test,
+  sltiu_test, sra_test, srai_test, srl_test,
+  srli_test, sub_test, xor_test, xori_test
+]
+# Collected 'M' extension compliance test programs.
+rv32m_tests = [
+  mul_test, mulh_test, mulhsu_test, mulhu_test,
+  div_test, divu_test, rem_test, remu_test
+]
+
+# Core configurations to run the test programs on.
+cpu_cfgs = [
+  {},
+  { 'fast': True },
+  { 'pipeline': True },
+  { 'pipeline': True, 'predict': True },
+  { 'prefetch': 4 },
+  { 'pipeline': True, 'predict': True, 'prefetch': 2 },
+  { 'icache': ( 16, 4 ) },
+  { 'pipeline': True, 'predict': True, 'icache': ( 16, 4 ) },
+  { 'stbuf': 4 },
+  { 'pipeline': True, 'predict': True, 'stbuf': 2 },
+  { 'nbload': True },
+  { 'pipeline': True, 'predict': True, 'stbuf': 2, 'nbload': True },
+  { 'pipeline': True, 'predict': True, 'fuse': True },
+  { 'pipeline': True, 'fuse': True, 'nbload': True, 'icache': ( 16, 4 ) },
+  { 'predecode': True },
+  { 'pipeline': True, 'predict': True, 'fuse': True, 'predecode': True },
+  { 'rv32m': True },
+  { 'pipeline': True, 'predict': True, 'nbload': True, 'rv32m': True },
+  { 'bitmanip': True },
+  { 'pipeline': True, 'predict': True, 'rv32m': True, 'bitmanip': True },
+  { 'compressed': True },
+  { 'fast': True, 'icache': ( 16, 4 ), 'predecode': True, 'compressed': True },
+  { 'accel': RefAccel },
+  { 'pipeline': True, 'predict': True, 'nbload': True, 'predecode': True,
+    'accel': RefAccel },
+  { 'misaligned': True },
+  { 'pipeline': True, 'predict': True, 'stbuf': 2, 'nbload': True,
+    'misaligned': True },
+  { 'fetch64': True },
+  { 'fast': True, 'predecode': True, 'fetch64': True },
+  { 'itcm': 256 },
+  { 'pipeline': True, 'predict': True, 'prefetch': 2, 'itcm': 256 },
+  { 'fast': True, 'predecode': True, 'fetch64': True, 'itcm': 256 },
+  { 'atomic': True },
+  { 'pipeline': True, 'predict': True, 'stbuf': 2, 'nbload': True,
+    'atomic': True },
+  { 'fast': True, 'predecode': True, 'icache': ( 16, 4 ), 'atomic': True },
+  { 'serial': 1 },
+  { 'serial': 4, 'rv32m': True },
+  { 'serial': 4, 'predecode': True, 'compressed': True },
+  { 'shadow': True },
+  { 'fast': True, 'predecode': True, 'shadow': True },
+  { 'pipeline': True, 'predict': True, 'stbuf': 2, 'nbload': True,
+    'shadow': True },
+  { 'wfi': True },
+  { 'fast': True, 'prefetch': 2, 'wfi': True },
+  { 'pipeline': True, 'predict': True, 'icache': ( 16, 4 ),
+    'stbuf': 2, 'nbload': True, 'wfi': True },
+  { 'csrreg': True },
+  { 'fast': True, 'predecode': True, 'csrreg': True },
+  { 'pipeline': True, 'predict': True, 'fuse': True, 'stbuf': 2,
+    'nbload': True, 'csrreg': True }
+]
 
 # 'main' method to run a basic testbench.
 if __name__ == "__main__":
-  if ( len( sys.argv ) == 2 ) and ( sys.argv[ 1 ] == '-b' ):
+  if ( len( sys.argv ) >= 2 ) and ( sys.argv[ 1 ] == '-b' ):
     # Build the application for an iCE40UP5K FPGA.
     # Currently, this is meaningless, because it builds the CPU
     # with a hard-coded 'infinite loop' ROM. But it's a start.
+    # ('-b N' builds a core with an N-bit serial ALU instead, and
+    #  '-r' builds it with registered CSR reads, to compare their
+    #  size and maximum frequency)
+    args = [ a for a in sys.argv[ 2 : ] if a != '-r' ]
+    serial = int( args[ 0 ] ) if len( args ) > 0 else 0
+    csrreg = '-r' in sys.argv[ 2 : ]
     with warnings.catch_warnings():
       warnings.filterwarnings( "ignore", category = DriverConflict )
       warnings.filterwarnings( "ignore", category = UnusedElaboratable )
       # Build the CPU to read its program from a 2MB offset in SPI Flash.
       prog_start = ( 2 * 1024 * 1024 )
-      cpu = CPU( SPI_ROM( prog_start, prog_start * 2, None ) )
+      cpu = CPU( SPI_ROM( prog_start, prog_start * 2, None ),
+                 serial = serial, csrreg = csrreg )
       UpduinoPlatform().build( ResetInserter( cpu.clk_rst )( cpu ),
                                do_program = False )
   else:
@@ -558,61 +2059,92 @@ if __name__ == "__main__":
     with warnings.catch_warnings():
       warnings.filterwarnings( "ignore", category = DriverConflict )
 
-      print( '--- CPU Tests ---' )
-      # Simulate the 'infinite loop' ROM to screen for syntax errors.
-      cpu_sim( loop_test )
-      cpu_spi_sim( loop_test )
-      cpu_sim( ram_pc_test )
-      cpu_spi_sim( ram_pc_test )
-      # Simulate the RV32I compliance tests.
-      cpu_sim( add_test )
-      cpu_sim( addi_test )
-      cpu_sim( and_test )
-      cpu_sim( andi_test )
-      cpu_sim( auipc_test )
-      cpu_sim( beq_test )
-      cpu_sim( bge_test )
-      cpu_sim( bgeu_test )
-      cpu_sim( blt_test )
-      cpu_sim( bltu_test )
-      cpu_sim( bne_test )
-      cpu_sim( delay_slots_test )
-      cpu_sim( ebreak_test )
-      cpu_sim( ecall_test )
-      cpu_sim( endianess_test )
-      cpu_sim( io_test )
-      cpu_sim( jal_test )
-      cpu_sim( jalr_test )
-      cpu_sim( lb_test )
-      cpu_sim( lbu_test )
-      cpu_sim( lh_test )
-      cpu_sim( lhu_test )
-      cpu_sim( lw_test )
-      cpu_sim( lui_test )
-      cpu_sim( misalign_jmp_test )
-      cpu_sim( misalign_ldst_test )
-      cpu_sim( nop_test )
-      cpu_sim( or_test )
-      cpu_sim( ori_test )
-      cpu_sim( rf_size_test )
-      cpu_sim( rf_width_test )
-      cpu_sim( rf_x0_test )
-      cpu_sim( sb_test )
-      cpu_sim( sh_test )
-      cpu_sim( sw_test )
-      cpu_sim( sll_test )
-      cpu_sim( slli_test )
-      cpu_sim( slt_test )
-      cpu_sim( slti_test )
-      cpu_sim( sltu_test )
-      cpu_sim( sltiu_test )
-      cpu_sim( sra_test )
-      cpu_sim( srai_test )
-      cpu_sim( srl_test )
-      cpu_sim( srli_test )
-      cpu_sim( sub_test )
-      cpu_sim( xor_test )
-      cpu_sim( xori_test )
+      # Run each test program on every core configuration.
+      for cfg in cpu_cfgs:
+        print( '--- CPU Tests (%s core) ---'%cfg_str( cfg ) )
+        # Simulate the 'infinite loop' ROM to screen for syntax errors.
+        cpu_sim( loop_test, cfg )
+        cpu_spi_sim( loop_test, cfg )
+        cpu_sim( ram_pc_test, cfg )
+        cpu_spi_sim( ram_pc_test, cfg )
+        cpu_sim( fencei_test, cfg )
+        cpu_spi_sim( fencei_test, cfg )
+        cpu_sim( cache_test, cfg )
+        cpu_spi_sim( cache_test, cfg )
+        cpu_sim( load_test, cfg )
+        cpu_spi_sim( load_test, cfg )
+        cpu_sim( counters_test, cfg )
+        cpu_spi_sim( counters_test, cfg )
+        # Simulate the mis-aligned jump test, if those jumps trap.
+        if not cfg.get( 'compressed', False ):
+          cpu_sim( jump_trap_test, cfg )
+          cpu_spi_sim( jump_trap_test, cfg )
+        # Simulate the RV32I compliance tests. (Jumps to addresses
+        # which are not word-aligned don't trap with the 'C' extension,
+        # and mis-aligned loads and stores don't trap if they are split)
+        # (With a shadow register bank, the trap tests' handlers see
+        #  the shadow registers instead of the main code's, so their
+        #  result pointers are different, but the traps still have to
+        #  return to the right place with the main registers intact)
+        for test in rv32i_tests:
+          if ( test is misalign_jmp_test ) and \
+             cfg.get( 'compressed', False ):
+            continue
+          if ( test is misalign_ldst_test ) and \
+             cfg.get( 'misaligned', False ):
+            continue
+          cpu_sim( test, cfg )
+        # Simulate the 'M' extension tests, if it is enabled.
+        if cfg.get( 'rv32m', False ):
+          cpu_sim( muldiv_test, cfg )
+          cpu_spi_sim( muldiv_test, cfg )
+          for test in rv32m_tests:
+            cpu_sim( test, cfg )
+        # Simulate the bit-manipulation test, if they are enabled.
+        if cfg.get( 'bitmanip', False ):
+          cpu_sim( bitmanip_test, cfg )
+          cpu_spi_sim( bitmanip_test, cfg )
+        # Simulate the compressed instruction test, if it is enabled.
+        if cfg.get( 'compressed', False ):
+          cpu_sim( compressed_test, cfg )
+          cpu_spi_sim( compressed_test, cfg )
+        # Simulate the accelerator tests, if there is one. The custom
+        # instruction and memory-mapped programs do the same work.
+        if cfg.get( 'accel', None ) is not None:
+          cpu_sim( accel_insn_test, cfg )
+          cpu_sim( accel_mmio_test, cfg )
+          cpu_spi_sim( accel_insn_test, cfg )
+        # Simulate the mis-aligned access test, if they are split.
+        if cfg.get( 'misaligned', False ):
+          cpu_sim( misalign_test, cfg )
+          cpu_spi_sim( misalign_test, cfg )
+        # Simulate the ITCM test, if there is one.
+        if cfg.get( 'itcm', 0 ) > 0:
+          cpu_sim( itcm_test, cfg )
+          cpu_spi_sim( itcm_test, cfg )
+        # Simulate the atomic operations test, if they are enabled.
+        if cfg.get( 'atomic', False ):
+          cpu_sim( amo_test, cfg )
+          cpu_spi_sim( amo_test, cfg )
+        # Simulate the 'wait for interrupt' test, if 'WFI' gates
+        # the core's clock.
+        if cfg.get( 'wfi', False ):
+          cpu_wfi_sim( wfi_test, 100, cfg )
+        # Simulate the trap handler tests, if there is a shadow
+        # register bank. The handler which saves its registers runs
+        # on the same core without one, for comparison.
+        if cfg.get( 'shadow', False ):
+          cpu_trap_sim( trap_save_test, 0x40,
+                        dict( cfg, shadow = False ) )
+          cpu_trap_sim( trap_shadow_test, 0x40, cfg )
+          cpu_spi_sim( trap_shadow_test, cfg )
+          cpu_sim( trap_bank_test, cfg )
+          cpu_spi_sim( trap_bank_test, cfg )
 
       # Done; print results.
       print( "CPU Tests: %d Passed, %d Failed"%( p, f ) )
+      for cfg, stats in cpi.items():
+        print( "Average CPI (%s): %.2f"
+               %( cfg, ( stats[ 0 ] / max( stats[ 1 ], 1 ) ) ) )
+      for ( name, cfg ), nc in trap_cycles.items():
+        print( "Trap handler cycles (%s, %s): %.2f"%( name, cfg, nc ) )
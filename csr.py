@@ -15,11 +15,29 @@ import warnings
 # 'system' opcode, which is used to         #
 # read/write CSRs in the base ISA.          #
 # CSR named constants are in `isa.py`.      #
+# The logic is generated from the 'CSRS'    #
+# table in one of two ways:                 #
+# * By default, 'dat_r' is combinatorial,   #
+#   and each CSR is a 'Case' which compares #
+#   all 12 address bits.                    #
+# * With 'registered' set, the address is   #
+#   decoded in two parts, bits which always #
+#   read as 0 are left out of the read mux, #
+#   and 'dat_r' is registered. Reads take   #
+#   one cycle, so the CPU sets 'cyc' /      #
+#   'stb' and waits for 'ack'.              #
 #############################################
 
 # Core "CSR" class, which addresses Control and Status Registers.
 class CSR( Elaboratable, Interface ):
-  def __init__( self ):
+  def __init__( self, hartid = 0, registered = False,
+                compressed = False ):
+    # Use the registered-read CSR generator?
+    self.registered = registered
+    # Is the 'C' extension enabled? Without it, instructions are
+    # always word-aligned, so MEPC bit 1 reads as 0. (It can still
+    # be written)
+    self.compressed = compressed
     # CSR function select signal.
     self.f  = Signal( 3,  reset = 0b000 )
     # Actual data to write (depends on write/set/clear function)
@@ -43,10 +61,50 @@ class CSR( Elaboratable, Interface ):
           setattr( self,
                    "%s_%s"%( cname, bname ),
                    Const( bits[ 3 ] ) )
+    # Read-only hart ID, which is different for each core in a
+    # multi-hart system.
+    self.mhartid_hartid = Const( hartid, 32 )
+    # External interrupt pending flag, which the CPU drives.
+    self.mip_meip = Signal( 1, reset = 0 )
+
+  # Helper method to find which bits of a CSR can be read and
+  # written. Read-only fields which are always 0 are left out.
+  def masks( self, cname ):
+    rmask = 0
+    wmask = 0
+    for bname, bits in CSRS[ cname ][ 'bits' ].items():
+      fmask = ( ( 1 << ( bits[ 1 ] - bits[ 0 ] + 1 ) ) - 1 ) << bits[ 0 ]
+      v = getattr( self, "%s_%s"%( cname, bname ) )
+      if 'w' in bits[ 2 ]:
+        wmask |= fmask
+      if ( 'r' in bits[ 2 ] ) and \
+         not ( isinstance( v, Const ) and ( v.value == 0 ) ):
+        rmask |= fmask
+    return rmask, wmask
+
+  # Helper method to get the value that a CSR field reads as.
+  def rfield( self, cname, bname ):
+    v = getattr( self, "%s_%s"%( cname, bname ) )
+    if ( cname == 'mepc' ) and not self.compressed:
+      return Cat( Const( 0, 1 ), v[ 1 : ] )
+    return v
 
   def elaborate( self, platform ):
     m = Module()
 
+    # Only write CSRs if the operation changes them: 'CSRRS' / 'CSRRC'
+    # with no bits set are reads, which must not write the read value
+    # back to counters that changed in the meantime.
+    wen = Signal( 1, reset = 0 )
+    m.d.comb += wen.eq( self.we &
+                        ( ( self.f[ :2 ] == 0b01 ) | ( self.dat_w != 0 ) ) )
+
+    # Registered CSR generator.
+    if self.registered:
+      self.registered_logic( m, wen )
+      self.write_data( m )
+      return m
+
     # Read values default to 0.
     m.d.comb += self.dat_r.eq( 0 )
 
@@ -59,13 +117,70 @@ class CSR( Elaboratable, Interface ):
             if 'r' in bits[ 2 ]:
               m.d.comb += self.dat_r \
                 .bit_select( bits[ 0 ], bits[ 1 ] - bits[ 0 ] + 1 ) \
-                .eq( getattr( self, "%s_%s"%( cname, bname ) ) )
-            with m.If( self.we == 1 ):
+                .eq( self.rfield( cname, bname ) )
+            with m.If( wen ):
               # Writes are enabled; set new values on the next tick.
               if 'w' in bits[ 2 ]:
                 m.d.sync += getattr( self, "%s_%s"%( cname, bname ) ) \
                   .eq( self.wd[ bits[ 0 ] : ( bits[ 1 ] + 1 ) ] )
 
+    self.write_data( m )
+    return m
+
+  # Registered CSR logic: precompute each CSR's read / write masks,
+  # decode its address in two parts, and register the read data for
+  # the next cycle.
+  def registered_logic( self, m, wen ):
+    # Address decode: the implemented CSRs only use a few 'pages' of
+    # 16 addresses, so compare the upper 8 address bits once for each
+    # page, and decode the lower 4 bits once for all of them.
+    pages = sorted( set( reg[ 'c_addr' ] >> 4 for reg in CSRS.values() ) )
+    pg = Signal( len( pages ), reset = 0 )
+    lo = Signal( 16, reset = 0 )
+    for i in range( len( pages ) ):
+      m.d.comb += pg[ i ].eq( self.adr[ 4 : ] == pages[ i ] )
+    for i in range( 16 ):
+      m.d.comb += lo[ i ].eq( self.adr[ :4 ] == i )
+
+    # Assemble each CSR's read value from its readable bits, and
+    # apply writes to its writable fields. Each page's CSRs are also
+    # collected by their lower 4 address bits, so that the read mux
+    # is a small 'Switch' for each page and an OR of the pages.
+    pcsrs = [ {} for p in pages ]
+    for cname, reg in CSRS.items():
+      p = pages.index( reg[ 'c_addr' ] >> 4 )
+      sel = Signal( 1, name = "%s_sel"%cname, reset = 0 )
+      rv = Signal( 32, name = "%s_rv"%cname, reset = 0 )
+      m.d.comb += sel.eq( pg[ p ] & lo[ reg[ 'c_addr' ] & 0xF ] )
+      rmask, wmask = self.masks( cname )
+      for bname, bits in reg[ 'bits' ].items():
+        v = getattr( self, "%s_%s"%( cname, bname ) )
+        if ( rmask >> bits[ 0 ] ) & 1:
+          m.d.comb += rv[ bits[ 0 ] : ( bits[ 1 ] + 1 ) ] \
+            .eq( self.rfield( cname, bname ) )
+        if ( wmask >> bits[ 0 ] ) & 1:
+          with m.If( wen & sel ):
+            m.d.sync += v.eq( self.wd[ bits[ 0 ] : ( bits[ 1 ] + 1 ) ] )
+      pcsrs[ p ][ reg[ 'c_addr' ] & 0xF ] = rv
+
+    # Register the read data, and acknowledge requests on the cycle
+    # after they start, when it is valid.
+    rd = Const( 0, 32 )
+    for i in range( len( pages ) ):
+      pr = Signal( 32, name = "page%d_rd"%i, reset = 0 )
+      with m.Switch( self.adr[ :4 ] ):
+        for lo_a, rv in pcsrs[ i ].items():
+          with m.Case( lo_a ):
+            m.d.comb += pr.eq( rv )
+      rd = rd | Mux( pg[ i ], pr, 0 )
+    m.d.sync += [
+      self.dat_r.eq( rd ),
+      self.ack.eq( self.cyc & self.stb & ~self.ack )
+    ]
+
+  # Set the value to write to the selected CSR, based on the current
+  # read value and the CSR function.
+  def write_data( self, m ):
     # Process 32-bit CSR write logic.
     with m.If( ( self.f[ :2 ] ) == 0b01 ):
       # 'Write' - set the register to the input value.
@@ -79,7 +194,6 @@ class CSR( Elaboratable, Interface ):
     with m.Else():
       # Read-only operation; set write data to current value.
       m.d.comb += self.wd.eq( self.dat_r )
-    return m
 
 ##################
 # CSR testbench: #
@@ -135,12 +249,46 @@ def csr_rw_ut( csr, reg ):
   # 'Clear' with rin == 0 reads the value without writing.
   yield from csr_ut( csr, reg, 0x00000000, F_CSRRC,  0x00000000 )
 
+# Check that 'CSRRS' / 'CSRRC' reads with no bits set do not write
+# the CSR, while the 'MCYCLE' counter keeps incrementing. ('inc' is
+# a testbench signal which increments it every cycle, like the CPU)
+def csr_nw_ut( csr, inc, cf ):
+  global p, f
+  # Read the counter's starting value.
+  start = yield csr.mcycle_cycles
+  # Read 'MCYCLE' with writes enabled while it counts 4 cycles.
+  yield csr.adr.eq( CSRA_MCYCLE )
+  yield csr.dat_w.eq( 0 )
+  yield csr.f.eq( cf )
+  yield csr.we.eq( 1 )
+  yield inc.eq( 1 )
+  for i in range( 4 ):
+    yield Tick()
+  # Stop counting and check that no cycles were lost.
+  yield csr.adr.eq( 0 )
+  yield csr.f.eq( 0 )
+  yield csr.we.eq( 0 )
+  yield inc.eq( 0 )
+  yield Tick()
+  yield Settle()
+  actual = yield csr.mcycle_cycles
+  if ( start + 4 ) != actual:
+    f += 1
+    print( "\033[31mFAIL:\033[0m MCYCLE = %s after a no-op write "
+           "(got: %s)"%( hexs( start + 4 ), hexs( actual ) ) )
+  else:
+    p += 1
+    print( "\033[32mPASS:\033[0m MCYCLE = %s after a no-op write"
+           %hexs( start + 4 ) )
+
 # Top-level CSR test method.
-def csr_test( csr ):
+def csr_test( csr, inc ):
   # Wait a tick and let signals settle after reset.
   yield Settle()
   # Print a test header.
-  print( "--- CSR Tests ---" )
+  print( "--- CSR Tests%s%s ---"
+         %( " (registered reads)" if csr.registered else "",
+            " ('C' extension)" if csr.compressed else "" ) )
 
   # Test reading / writing 'MSTATUS' CSR. (Only 'MIE' can be written)
   yield from csr_ut( csr, CSRA_MSTATUS, 0xFFFFFFFF, F_CSRRWI, 0x00000000 )
@@ -154,10 +302,12 @@ def csr_test( csr ):
   yield from csr_ut( csr, CSRA_MTVEC, 0xFFFFFFFE, F_CSRRSI, 0x00000000 )
   yield from csr_ut( csr, CSRA_MTVEC, 0x00000003, F_CSRRW,  0xFFFFFFFC )
   yield from csr_ut( csr, CSRA_MTVEC, 0x00000000, F_CSRRS,  0x00000001 )
-  # Test reading / writing the 'MEPC' CSR. All bits except 0-1 R/W.
+  # Test reading / writing the 'MEPC' CSR. All bits except 0-1 R/W,
+  # and bit 1 is also R/W with the 'C' extension.
   yield from csr_ut( csr, CSRA_MEPC, 0x00000000, F_CSRRS,  0x00000000 )
   yield from csr_ut( csr, CSRA_MEPC, 0xFFFFFFFF, F_CSRRSI, 0x00000000 )
-  yield from csr_ut( csr, CSRA_MEPC, 0x01234567, F_CSRRC,  0xFFFFFFFC )
+  yield from csr_ut( csr, CSRA_MEPC, 0x01234567, F_CSRRC,
+                     0xFFFFFFFE if csr.compressed else 0xFFFFFFFC )
   yield from csr_ut( csr, CSRA_MEPC, 0x0C0FFEE0, F_CSRRW,  0xFEDCBA98 )
   yield from csr_ut( csr, CSRA_MEPC, 0xFFFFCBA9, F_CSRRW,  0x0C0FFEE0 )
   yield from csr_ut( csr, CSRA_MEPC, 0xFFFFFFFF, F_CSRRCI, 0xFFFFCBA8 )
@@ -166,6 +316,33 @@ def csr_test( csr ):
   yield from csr_rw_ut( csr, CSRA_MCAUSE )
   # Test reading / writing the 'MTVAL' CSR.
   yield from csr_rw_ut( csr, CSRA_MTVAL )
+  # Test reading / writing the 64-bit counters' low and high halves.
+  yield from csr_rw_ut( csr, CSRA_MCYCLE )
+  yield from csr_rw_ut( csr, CSRA_MCYCLEH )
+  # Test that reads with no bits set don't drop counter increments.
+  yield from csr_nw_ut( csr, inc, F_CSRRS )
+  yield from csr_nw_ut( csr, inc, F_CSRRC )
+  yield from csr_rw_ut( csr, CSRA_MINSTRET )
+  yield from csr_rw_ut( csr, CSRA_MINSTRETH )
+  yield from csr_ut( csr, CSRA_MHPMCOUNTER3, 0x89ABCDEF, F_CSRRW,  0x00000000 )
+  yield from csr_ut( csr, CSRA_MHPMCOUNTER3, 0x0000FF00, F_CSRRC,  0x89ABCDEF )
+  yield from csr_ut( csr, CSRA_MHPMCOUNTER3, 0x00000000, F_CSRRS,  0x89AB00EF )
+  yield from csr_ut( csr, CSRA_MHPMCOUNTER6H, 0x00001234, F_CSRRW, 0x00000000 )
+  yield from csr_ut( csr, CSRA_MHPMCOUNTER6H, 0x00000000, F_CSRRS, 0x00001234 )
+  # Test reading / writing the event selectors. (4 bits each, and
+  # they start out counting the original fixed events)
+  yield from csr_ut( csr, CSRA_MHPMEVENT3, 0x00000000, F_CSRRS,  HPM_MISPRED )
+  yield from csr_ut( csr, CSRA_MHPMEVENT6, 0x00000000, F_CSRRS,  HPM_FUSED )
+  yield from csr_ut( csr, CSRA_MHPMEVENT4, 0xFFFFFFFF, F_CSRRW,  HPM_ICHIT )
+  yield from csr_ut( csr, CSRA_MHPMEVENT4, HPM_LOAD,   F_CSRRW,  0x0000000F )
+  yield from csr_ut( csr, CSRA_MHPMEVENT4, 0x00000000, F_CSRRS,  HPM_LOAD )
+  # Test reading / writing 'MCOUNTINHIBIT'. (Bit 1 is reserved)
+  yield from csr_ut( csr, CSRA_MCOUNTINHIBIT, 0xFFFFFFFF, F_CSRRW, 0x00000000 )
+  yield from csr_ut( csr, CSRA_MCOUNTINHIBIT, 0x00000000, F_CSRRW, 0x0000007D )
+  # Test reading the read-only 'MHARTID' CSR.
+  yield from csr_ut( csr, CSRA_MHARTID, 0x00000000, F_CSRRS,  0x00000003 )
+  yield from csr_ut( csr, CSRA_MHARTID, 0xFFFFFFFF, F_CSRRW,  0x00000003 )
+  yield from csr_ut( csr, CSRA_MHARTID, 0x00000000, F_CSRRS,  0x00000003 )
   # Test an unrecognized CSR.
   yield from csr_ut( csr, 0x101, 0x89ABCDEF, F_CSRRW,  0x00000000 )
   yield from csr_ut( csr, 0x101, 0x89ABCDEF, F_CSRRC,  0x00000000 )
@@ -180,12 +357,28 @@ def csr_test( csr ):
 
 # 'main' method to run a basic testbench.
 if __name__ == "__main__":
-  # Instantiate a CSR module.
-  dut = CSR()
-  # Run the tests.
-  with Simulator( dut, vcd_file = open( 'csr.vcd', 'w' ) ) as sim:
-    def proc():
-      yield from csr_test( dut )
-    sim.add_clock( 1e-6 )
-    sim.add_sync_process( proc )
-    sim.run()
+  # The testbench increments 'MCYCLE' from outside of the CSR module.
+  with warnings.catch_warnings():
+    warnings.filterwarnings( "ignore", category = DriverConflict )
+
+    # Test both CSR generators, with and without the 'C' extension
+    # and with a non-zero hart ID.
+    for registered, compressed in [ ( False, False ), ( True, False ),
+                                    ( False, True ), ( True, True ) ]:
+      dut = CSR( hartid = 3, registered = registered,
+                 compressed = compressed )
+      vcd = 'csr%s%s.vcd'%( '_reg' if registered else '',
+                            '_c' if compressed else '' )
+      # Increment 'MCYCLE' when 'inc' is set, like the CPU does.
+      inc = Signal( 1, reset = 0 )
+      tb = Module()
+      tb.submodules.csr = dut
+      with tb.If( inc ):
+        tb.d.sync += dut.mcycle_cycles.eq( dut.mcycle_cycles + 1 )
+      # Run the tests.
+      with Simulator( tb, vcd_file = open( vcd, 'w' ) ) as sim:
+        def proc():
+          yield from csr_test( dut, inc )
+        sim.add_clock( 1e-6 )
+        sim.add_sync_process( proc )
+        sim.run()
@@ -25,9 +25,12 @@ class GPIO( Elaboratable, Interface ):
     #
     # iCE40s don't have programmable pulling resistors, so...
     # not many options here. You get an I, and you get an O.
-    Interface.__init__( self, addr_width = 5, data_width = 32 )
-    self.memory_map = MemoryMap( addr_width = self.addr_width,
-                                 data_width = self.data_width,
+    # (Bus addresses are in words, and each byte lane of a
+    #  register holds 4 pins which can be written separately)
+    Interface.__init__( self, addr_width = 3, data_width = 32,
+                        granularity = 8 )
+    self.memory_map = MemoryMap( addr_width = self.addr_width + 2,
+                                 data_width = self.granularity,
                                  alignment = 0 )
     # Backing data store. A 'Memory' would be smaller, but
     # the 'pin multiplexer' peripheral needs parallel access.
@@ -46,10 +49,9 @@ class GPIO( Elaboratable, Interface ):
     m.d.sync += self.ack.eq( self.cyc )
 
     # Switch case to select the currently-addressed register.
-    # This peripheral must be accessed with a word-aligned address.
     with m.Switch( self.adr ):
       for i in range( 4 ):
-        with m.Case( i * 4 ):
+        with m.Case( i ):
           # Logic for each of the register's 16 possible pins,
           # ignoring ones that aren't in the 'PINS' array.
           for j in range( 16 ):
@@ -59,8 +61,10 @@ class GPIO( Elaboratable, Interface ):
               m.d.comb += self.dat_r.bit_select( j * 2, 2 ).eq(
                 self.p[ pnum ] )
               # Write logic: if this bus is selected and writes
-              # are enabled, set 'value' and 'direction' bits.
-              with m.If( ( self.we == 1 ) & ( self.cyc == 1 ) ):
+              # are enabled for the pin's byte lane, set 'value'
+              # and 'direction' bits.
+              with m.If( ( self.we == 1 ) & ( self.cyc == 1 ) &
+                         ( self.sel[ j // 4 ] == 1 ) ):
                 m.d.sync += self.p[ pnum ].eq(
                   self.dat_w.bit_select( j * 2, 2 ) )
 
@@ -29,9 +29,11 @@ class GPIO_Mux( Elaboratable, Interface ):
   def __init__( self, periphs ):
     # Wishbone interface: address <=64 pins, 4 bits per pin.
     # The bus is 32 bits wide for compatibility, so 8 pins per word.
-    Interface.__init__( self, addr_width = 6, data_width = 32 )
-    self.memory_map = MemoryMap( addr_width = self.addr_width,
-                                 data_width = self.data_width,
+    # (Bus addresses are in words, and each byte lane holds 2 pins)
+    Interface.__init__( self, addr_width = 4, data_width = 32,
+                        granularity = 8 )
+    self.memory_map = MemoryMap( addr_width = self.addr_width + 2,
+                                 data_width = self.granularity,
                                  alignment = 0 )
 
     # Backing data store for QFN48 pins. A 'Memory' would be more
@@ -69,11 +71,10 @@ class GPIO_Mux( Elaboratable, Interface ):
     m.d.sync +=  self.ack.eq( self.cyc )
 
     # Switch case to read/write the currently-addressed register.
-    # This peripheral must be accessed with a word-aligned address.
     with m.Switch( self.adr ):
       # 49 pin addresses (0-48), 8 pins per register, so 7 registers.
       for i in range( 7 ):
-        with m.Case( i * 4 ):
+        with m.Case( i ):
           # Read logic for valid pins (each has 4 bits).
           for j in range( 8 ):
             pnum = ( i * 8 ) + j
@@ -82,7 +83,8 @@ class GPIO_Mux( Elaboratable, Interface ):
                 self.pin_mux[ pnum ] )
               # Write logic for valid pins (again, 4 bits each).
               with m.If( ( self.cyc == 1 ) &
-                         ( self.we == 1 ) ):
+                         ( self.we == 1 ) &
+                         ( self.sel[ j // 2 ] == 1 ) ):
                 m.d.sync += self.pin_mux[ pnum ].eq(
                   self.dat_w.bit_select( j * 4, 4 ) )
 
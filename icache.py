@@ -0,0 +1,234 @@
+from nmigen import *
+from math import ceil, log2
+from nmigen.back.pysim import *
+from nmigen_soc.memory import *
+from nmigen_soc.wishbone import *
+
+from isa import *
+from rom import *
+
+################################################################
+# Instruction cache module: a direct-mapped, read-only cache   #
+# which sits between the instruction bus multiplexer and a     #
+# (slow) ROM module such as 'SPI_ROM'. Cached words and tags   #
+# are kept in 'Memory' blocks, which map to iCE40 BRAMs.       #
+# Word address fields, from LSbit to MSbit:                    #
+# * [ 0 : wb ]: word offset within a line                      #
+# * [ wb : wb + ib ]: line index                               #
+# * [ wb + ib : ]: tag                                         #
+################################################################
+
+class ICache( Elaboratable ):
+  # Cache hits are acknowledged one cycle after they are requested,
+  # so one word per cycle can be read while 'cyc' is held.
+  pipelined = True
+
+  def __init__( self, rom_module, lines, words ):
+    # Number of cache lines, and words per line.
+    # (Both should be powers of two)
+    self.lines = lines
+    self.words = words
+    self.wb = ceil( log2( words ) )
+    self.ib = ceil( log2( lines ) )
+    # ROM bus used to fill cache lines.
+    self.rom = rom_module
+    self.rbus = rom_module.new_bus()
+    self.aw = self.rbus.addr_width
+    self.tb = max( self.aw - self.wb - self.ib, 1 )
+    # Cached data and tags.
+    self.data = Memory( width = 32, depth = lines * words,
+      init = ( 0x00000000 for i in range( lines * words ) ) )
+    self.tags = Memory( width = self.tb, depth = lines,
+      init = ( 0 for i in range( lines ) ) )
+    # Read and write ports.
+    self.dr = self.data.read_port()
+    self.dw = self.data.write_port()
+    self.tr = self.tags.read_port()
+    self.tw = self.tags.write_port()
+    # 'Valid' flags for each cache line. These are kept in a
+    # register instead of a BRAM so that they can all be cleared
+    # at once when the cache is invalidated.
+    self.valid = Signal( lines, reset = 0 )
+    # Invalidate signal: clears every line when it is set.
+    self.inv = Signal( reset = 0 )
+    # Flags which are set when a request hits or misses the cache.
+    self.hit = Signal( reset = 0 )
+    self.miss = Signal( reset = 0 )
+
+    # Bus interface for the instruction bus multiplexer. This uses
+    # the same address width as the ROM module that it caches.
+    self.bus = Interface( addr_width = self.aw, data_width = 32,
+                          granularity = 8 )
+    self.bus.memory_map = MemoryMap( addr_width = self.aw + 2,
+                                     data_width = 8,
+                                     alignment = 0 )
+
+  # Helper methods to get the fields of a bus address.
+  def word( self, adr ):
+    return adr[ : self.wb ]
+  def index( self, adr ):
+    return adr[ self.wb : self.wb + self.ib ]
+  def tag( self, adr ):
+    lo = self.wb + self.ib
+    return adr[ lo : self.aw ] if lo < self.aw else C( 0, 1 )
+
+  def elaborate( self, platform ):
+    m = Module()
+    m.submodules.dr = self.dr
+    m.submodules.dw = self.dw
+    m.submodules.tr = self.tr
+    m.submodules.tw = self.tw
+
+    # Address and 'request' flag from the previous cycle. The
+    # read ports' outputs are registered, so their data
+    # corresponds to the previous cycle's address.
+    padr = Signal( self.aw, reset = 0 )
+    preq = Signal( 1, reset = 0 )
+    m.d.sync += padr.eq( self.bus.adr )
+    # Line index, tag, and word counter for cache line fills.
+    fidx = Signal( max( self.ib, 1 ), reset = 0 )
+    ftag = Signal( self.tb, reset = 0 )
+    fw   = Signal( max( self.wb, 1 ), reset = 0 )
+
+    # Read the cached word and tag at the current bus address.
+    m.d.comb += [
+      self.dr.addr.eq( Cat( self.word( self.bus.adr ),
+                            self.index( self.bus.adr ) ) ),
+      self.tr.addr.eq( self.index( self.bus.adr ) ),
+      self.bus.dat_r.eq( self.dr.data ),
+      self.bus.ack.eq( self.hit )
+    ]
+
+    with m.FSM():
+      # 'Idle' state: check requests against the cache, and 'ack'
+      # them if they hit. Start filling the line if they miss.
+      with m.State( "IC_IDLE" ):
+        m.d.sync += preq.eq( self.bus.cyc & self.bus.stb )
+        m.d.comb += [
+          self.hit.eq( preq &
+            self.valid.bit_select( self.index( padr ), 1 ) &
+            ( self.tr.data == self.tag( padr ) ) ),
+          self.miss.eq( preq & ~self.hit )
+        ]
+        with m.If( self.miss ):
+          m.d.sync += [
+            fidx.eq( self.index( padr ) ),
+            ftag.eq( self.tag( padr ) ),
+            fw.eq( 0 )
+          ]
+          m.next = "IC_FILL"
+      # 'Fill' state: read each word in the line from the ROM, then
+      # mark the line as valid. The request which missed is retried
+      # from the 'idle' state, once the line is filled.
+      with m.State( "IC_FILL" ):
+        m.d.sync += preq.eq( 0 )
+        m.d.comb += [
+          self.rbus.adr.eq( Cat( fw[ :self.wb ], fidx[ :self.ib ],
+                                 ftag ) ),
+          self.rbus.cyc.eq( ~self.rbus.ack ),
+          self.rbus.stb.eq( self.rbus.cyc ),
+          self.dw.addr.eq( Cat( fw[ :self.wb ], fidx[ :self.ib ] ) ),
+          self.dw.data.eq( self.rbus.dat_r ),
+          self.dw.en.eq( self.rbus.ack )
+        ]
+        with m.If( self.rbus.ack ):
+          m.d.sync += fw.eq( fw + 1 )
+          with m.If( fw == ( self.words - 1 ) ):
+            m.d.comb += [
+              self.tw.addr.eq( fidx[ :self.ib ] ),
+              self.tw.data.eq( ftag ),
+              self.tw.en.eq( 1 )
+            ]
+            m.d.sync += self.valid.bit_select( fidx[ :self.ib ], 1 ).eq( 1 )
+            m.next = "IC_IDLE"
+
+    # Invalidate every cache line if requested.
+    with m.If( self.inv ):
+      m.d.sync += self.valid.eq( 0 )
+
+    # End of instruction cache module definition.
+    return m
+
+################################
+# Instruction cache testbench: #
+################################
+# Keep track of test pass / fail rates.
+p = 0
+f = 0
+
+# Perform an individual I-cache unit test: request a word, and
+# wait for it. Check the returned data and the number of cycles.
+def ic_read_ut( ic, address, expected, cycles ):
+  global p, f
+  yield ic.bus.adr.eq( address )
+  yield ic.bus.cyc.eq( 1 )
+  yield ic.bus.stb.eq( 1 )
+  yield Tick()
+  nc = 1
+  yield Settle()
+  while ( yield ic.bus.ack ) == 0:
+    yield Tick()
+    nc += 1
+    yield Settle()
+  yield ic.bus.cyc.eq( 0 )
+  yield ic.bus.stb.eq( 0 )
+  actual = yield ic.bus.dat_r
+  if ( expected != actual ) or ( cycles != nc ):
+    f += 1
+    print( "\033[31mFAIL:\033[0m IC[ 0x%08X ] = 0x%08X in %d cycles "
+           "(got: 0x%08X in %d cycles)"
+           %( address, expected, cycles, actual, nc ) )
+  else:
+    p += 1
+    print( "\033[32mPASS:\033[0m IC[ 0x%08X ] = 0x%08X in %d cycles"
+           %( address, expected, cycles ) )
+
+# Top-level I-cache test method.
+def ic_test( ic ):
+  global p, f
+
+  # Let signals settle after reset.
+  yield Settle()
+  # Print a test header.
+  print( "--- Instruction Cache Tests ---" )
+
+  # The first read misses, and fills a 2-word line from the ROM.
+  yield from ic_read_ut( ic, 0x0, LITTLE_END( 0x01234567 ), 7 )
+  # Reads from the same line hit, and take one cycle.
+  yield from ic_read_ut( ic, 0x1, LITTLE_END( 0x89ABCDEF ), 1 )
+  yield from ic_read_ut( ic, 0x0, LITTLE_END( 0x01234567 ), 1 )
+  # Reads from the next line miss.
+  yield from ic_read_ut( ic, 0x3, LITTLE_END( 0xDEADBEEF ), 7 )
+  yield from ic_read_ut( ic, 0x2, LITTLE_END( 0x42424242 ), 1 )
+  # Lines 0 and 2 map to the same index, so they evict each other.
+  yield from ic_read_ut( ic, 0x4, LITTLE_END( 0xCAFEF00D ), 7 )
+  yield from ic_read_ut( ic, 0x1, LITTLE_END( 0x89ABCDEF ), 7 )
+  yield from ic_read_ut( ic, 0x2, LITTLE_END( 0x42424242 ), 1 )
+  # Invalidating the cache causes every line to miss again.
+  yield ic.inv.eq( 1 )
+  yield Tick()
+  yield ic.inv.eq( 0 )
+  yield from ic_read_ut( ic, 0x2, LITTLE_END( 0x42424242 ), 7 )
+  yield from ic_read_ut( ic, 0x0, LITTLE_END( 0x01234567 ), 7 )
+
+  # Done.
+  yield Tick()
+  print( "Instruction Cache Tests: %d Passed, %d Failed"%( p, f ) )
+
+# 'main' method to run a basic testbench.
+if __name__ == "__main__":
+  # Instantiate a test ROM module with 24 bytes of data,
+  # and a cache with two 2-word lines to read from it.
+  rom = ROM( [ 0x01234567, 0x89ABCDEF, 0x42424242, 0xDEADBEEF,
+               0xCAFEF00D, 0x12345678 ] )
+  dut = ICache( rom, 2, 2 )
+  m = Module()
+  m.submodules.rom = rom
+  m.submodules.ic  = dut
+  # Run the instruction cache tests.
+  with Simulator( m, vcd_file = open( 'icache.vcd', 'w' ) ) as sim:
+    def proc():
+      yield from ic_test( dut )
+    sim.add_clock( 1e-6 )
+    sim.add_sync_process( proc )
+    sim.run()
@@ -15,6 +15,12 @@ OP_REG    = 0b0110011
 OP_IMM    = 0b0010011
 OP_SYSTEM = 0b1110011
 OP_FENCE  = 0b0001111
+# Opcodes which are reserved for custom extensions. They use the
+# R-type format, and are executed by an optional accelerator.
+OP_CUSTOM0 = 0b0001011
+OP_CUSTOM1 = 0b0101011
+# 'A' extension atomic memory operations.
+OP_AMO    = 0b0101111
 # RV32I "funct3" bits. These select different functions with
 # R-type, I-type, S-type, and B-type instructions.
 F_JALR    = 0b000
@@ -66,6 +72,61 @@ FF_SRL    = 0b0000000
 FF_SRA    = 0b0100000
 FF_OR     = 0b0000000
 FF_AND    = 0b0000000
+# 'M' extension multiply / divide instructions use the R-type
+# opcode, with their own 'funct7' bits.
+FF_MULDIV = 0b0000001
+F_MUL     = 0b000
+F_MULH    = 0b001
+F_MULHSU  = 0b010
+F_MULHU   = 0b011
+F_DIV     = 0b100
+F_DIVU    = 0b101
+F_REM     = 0b110
+F_REMU    = 0b111
+# 'A' extension instructions only support words, and select their
+# operation with the 5 MSbits of 'funct7'. (The other two bits are
+# the 'acquire' / 'release' ordering flags)
+F_AMOW      = 0b010
+FF_LR       = 0b00010
+FF_SC       = 0b00011
+FF_AMOSWAP  = 0b00001
+FF_AMOADD   = 0b00000
+FF_AMOXOR   = 0b00100
+FF_AMOAND   = 0b01100
+FF_AMOOR    = 0b01000
+FF_AMOMIN   = 0b10000
+FF_AMOMAX   = 0b10100
+FF_AMOMINU  = 0b11000
+FF_AMOMAXU  = 0b11100
+# 'Zba' / 'Zbb' bit-manipulation instructions also use the R-type
+# and I-type opcodes. Their 'funct7' bits are:
+FF_SHADD  = 0b0010000
+FF_ANDN   = 0b0100000
+FF_MINMAX = 0b0000101
+FF_ROT    = 0b0110000
+# Their 'funct3' bits are:
+F_SH1ADD  = 0b010
+F_SH2ADD  = 0b100
+F_SH3ADD  = 0b110
+F_ANDN    = 0b111
+F_ORN     = 0b110
+F_XNOR    = 0b100
+F_MIN     = 0b100
+F_MINU    = 0b101
+F_MAX     = 0b110
+F_MAXU    = 0b111
+F_ROL     = 0b001
+F_ROR     = 0b101
+F_RORI    = 0b101
+F_UNARY   = 0b001
+F_REV8    = 0b101
+# And the 12-bit immediate values of the single-operand ones are:
+IMM_CLZ   = 0x600
+IMM_CTZ   = 0x601
+IMM_CPOP  = 0x602
+IMM_SEXTB = 0x604
+IMM_SEXTH = 0x605
+IMM_REV8  = 0x698
 # CSR definitions, for 'ECALL' system instructions.
 # Like with other "I-type" instructions, the 'funct3' bits select
 # between different types of environment calls.
@@ -76,6 +137,10 @@ F_CSRRC  = 0b011
 F_CSRRWI = 0b101
 F_CSRRSI = 0b110
 F_CSRRCI = 0b111
+# 'FENCE' instruction funct3 bits. 'FENCE.I' synchronizes the
+# instruction and data streams, e.g. by invalidating I-caches.
+F_FENCE  = 0b000
+F_FENCEI = 0b001
 # Definitions for non-CSR 'ECALL' system instructions. These seem to
 # use the whole 12-bit immediate to encode their functionality.
 IMM_MRET = 0x302
@@ -125,12 +190,34 @@ ALU_AND   = 0b0111
 ALU_SLL   = 0b0001
 ALU_SRL   = 0b0101
 ALU_SRA   = 0b1101
+# Bit-manipulation ALU operations. (Only available if the ALU
+# is built with them) 'Zba' address calculations use 'ADD', and
+# 'ANDN' / 'ORN' / 'XNOR' use 'AND' / 'OR' / 'XOR' with an
+# inverted 'B' input. 'CTZ' and 'ROL' are 'CLZ' and 'ROR' with
+# flipped inputs and outputs, like 'SLL'.
+ALU_CLZ   = 0b10000
+ALU_CPOP  = 0b10001
+ALU_SEXTB = 0b10010
+ALU_SEXTH = 0b10011
+ALU_MIN   = 0b10100
+ALU_MINU  = 0b10101
+ALU_MAX   = 0b10110
+ALU_MAXU  = 0b10111
+ALU_ROR   = 0b11000
+ALU_REV8  = 0b11001
 # String mappings for opcodes, function bits, etc.
 ALU_STRS = {
   ALU_ADD:  "+", ALU_SLT:  "<", ALU_SLTU: "<",
   ALU_XOR:  "^", ALU_OR:   "|", ALU_AND:  "&",
   ALU_SLL: "<<", ALU_SRL: ">>", ALU_SRA: ">>",
-  ALU_SUB:  "-"
+  ALU_SUB:  "-",
+  ALU_CLZ: "clz", ALU_CPOP: "cpop", ALU_SEXTB: "sext.b",
+  ALU_SEXTH: "sext.h", ALU_MIN: "min", ALU_MINU: "minu",
+  ALU_MAX: "max", ALU_MAXU: "maxu", ALU_ROR: "ror", ALU_REV8: "rev8"
+}
+MD_STRS = {
+  F_MUL:   "*", F_MULH: "*h", F_MULHSU: "*hsu", F_MULHU: "*hu",
+  F_DIV:   "/", F_DIVU: "/u", F_REM:    "%",    F_REMU:  "%u"
 }
 
 # CSR Addresses for the supported subset of 'Machine-Level ISA' CSRs.
@@ -156,13 +243,72 @@ CSRA_MTVAL2     = 0x34B
 # Machine counters:
 CSRA_MCYCLE           = 0xB00
 CSRA_MINSTRET         = 0xB02
+CSRA_MHPMCOUNTER3     = 0xB03
+CSRA_MHPMCOUNTER4     = 0xB04
+CSRA_MHPMCOUNTER5     = 0xB05
+CSRA_MHPMCOUNTER6     = 0xB06
+CSRA_MCYCLEH          = 0xB80
+CSRA_MINSTRETH        = 0xB82
+CSRA_MHPMCOUNTER3H    = 0xB83
+CSRA_MHPMCOUNTER4H    = 0xB84
+CSRA_MHPMCOUNTER5H    = 0xB85
+CSRA_MHPMCOUNTER6H    = 0xB86
 # Machine counter setup:
 CSRA_MCOUNTINHIBIT    = 0x320
+CSRA_MHPMEVENT3       = 0x323
+CSRA_MHPMEVENT4       = 0x324
+CSRA_MHPMEVENT5       = 0x325
+CSRA_MHPMEVENT6       = 0x326
+# Event codes for the 'MHPMEVENT' CSRs, which select what each
+# 'MHPMCOUNTER' counts.
+HPM_NONE    = 0   # Nothing.
+HPM_MISPRED = 1   # Mis-predicted branches. ('pipeline' mode)
+HPM_ICHIT   = 2   # Instruction cache hits.
+HPM_ICMISS  = 3   # Instruction cache misses.
+HPM_FUSED   = 4   # Fused instruction pairs.
+HPM_IWAIT   = 5   # Cycles spent waiting for instruction fetches.
+HPM_DWAIT   = 6   # Cycles spent waiting for the data bus.
+HPM_BRANCH  = 7   # Taken conditional branches.
+HPM_LOAD    = 8   # Load instructions.
+HPM_STORE   = 9   # Store instructions.
+HPM_TRAP    = 10  # Traps.
+HPM_EVENTS  = 11
 # CSR memory map definitions.
 CSRS = {
+  # Hart ID; the CSR module replaces its value with the ID that it
+  # is created with.
+  'mhartid': {
+    'c_addr': CSRA_MHARTID,
+    'bits': { 'hartid': [ 0, 31, 'r', 0 ] }
+  },
+  # 64-bit cycle and retired instruction counters. The 'H' CSRs
+  # hold the upper 32 bits.
+  'mcycle': {
+    'c_addr': CSRA_MCYCLE,
+    'bits': { 'cycles': [ 0, 31, 'rw', 0 ] }
+  },
+  'mcycleh': {
+    'c_addr': CSRA_MCYCLEH,
+    'bits': { 'cycles': [ 0, 31, 'rw', 0 ] }
+  },
   'minstret': {
     'c_addr': CSRA_MINSTRET,
-    'bits': { 'instrs': [ 0, 15, 'rw', 0 ] }
+    'bits': { 'instrs': [ 0, 31, 'rw', 0 ] }
+  },
+  'minstreth': {
+    'c_addr': CSRA_MINSTRETH,
+    'bits': { 'instrs': [ 0, 31, 'rw', 0 ] }
+  },
+  # Stops 'MCYCLE' ('CY'), 'MINSTRET' ('IR'), or the event counters
+  # ('HPM', one bit per counter starting at 'MHPMCOUNTER3') from
+  # counting while their bits are set.
+  'mcountinhibit': {
+    'c_addr': CSRA_MCOUNTINHIBIT,
+    'bits': {
+      'cy':  [ 0, 0, 'rw', 0 ],
+      'ir':  [ 2, 2, 'rw', 0 ],
+      'hpm': [ 3, 6, 'rw', 0 ]
+    }
   },
   'mstatus': {
     'c_addr': CSRA_MSTATUS,
@@ -171,6 +317,16 @@ CSRS = {
       'mpie': [ 7,  7,  'r',  0 ]
      }
   },
+  # Machine external interrupt enable and pending flags. ('MEIP'
+  # follows the CPU's interrupt request input)
+  'mie': {
+    'c_addr': CSRA_MIE,
+    'bits': { 'meie': [ 11, 11, 'rw', 0 ] }
+  },
+  'mip': {
+    'c_addr': CSRA_MIP,
+    'bits': { 'meip': [ 11, 11, 'r', 0 ] }
+  },
   'mcause': {
     'c_addr': CSRA_MCAUSE,
     'bits': {
@@ -192,10 +348,31 @@ CSRS = {
   'mepc': {
     'c_addr': CSRA_MEPC,
     'bits': {
-      'mepc': [ 2, 31, 'rw', 0 ]
+      'mepc': [ 1, 31, 'rw', 0 ]
     }
   },
+  'mscratch': {
+    'c_addr': CSRA_MSCRATCH,
+    'bits': { 'scratch': [ 0, 31, 'rw', 0 ] }
+  },
 }
+# 64-bit event counters, and the CSRs which select their events. By
+# default, they count mis-predicted branches, instruction cache hits
+# and misses, and fused instruction pairs.
+for i, ev in zip( range( 3, 7 ),
+                  [ HPM_MISPRED, HPM_ICHIT, HPM_ICMISS, HPM_FUSED ] ):
+  CSRS[ 'mhpmcounter%d'%i ] = {
+    'c_addr': CSRA_MHPMCOUNTER3 + ( i - 3 ),
+    'bits': { 'count': [ 0, 31, 'rw', 0 ] }
+  }
+  CSRS[ 'mhpmcounter%dh'%i ] = {
+    'c_addr': CSRA_MHPMCOUNTER3H + ( i - 3 ),
+    'bits': { 'count': [ 0, 31, 'rw', 0 ] }
+  }
+  CSRS[ 'mhpmevent%d'%i ] = {
+    'c_addr': CSRA_MHPMEVENT3 + ( i - 3 ),
+    'bits': { 'event': [ 0, 3, 'rw', ev ] }
+  }
 
 # R-type operation: Rc = Ra ? Rb
 # The '?' operation depends on the opcode, funct3, and funct7 bits.
@@ -205,7 +382,7 @@ def RV32I_R( op, f, ff, c, a, b ):
          ( ( f  & 0x07 ) << 12 ) |
          ( ( a  & 0x1F ) << 15 ) |
          ( ( b  & 0x1F ) << 20 ) |
-         ( ( ff & 0x7C ) << 25 ) )
+         ( ( ff & 0x7F ) << 25 ) )
 
 # I-type operation: Rc = Ra ? Immediate
 # The '?' operation depends on the opcode and funct3 bits.
@@ -224,7 +401,7 @@ def RV32I_S( op, f, a, b, i ):
          ( ( f  & 0x07 ) << 12 ) |
          ( ( a  & 0x1F ) << 15 ) |
          ( ( b  & 0x1F ) << 20 ) |
-         ( ( ( i >> 5 ) & 0x7C ) ) )
+         ( ( ( i >> 5 ) & 0x7F ) << 25 ) )
 
 # B-type operation: Branch to (PC + Immediate) if Ra ? Rb.
 # The '?' compare operation depends on the funct3 bits.
@@ -283,6 +460,98 @@ def OR( c, a, b ):
   return RV32I_R( OP_REG, F_OR, FF_OR, c, a, b )
 def AND( c, a, b ):
   return RV32I_R( OP_REG, F_AND, FF_AND, c, a, b )
+# 'M' extension operations:
+def MUL( c, a, b ):
+  return RV32I_R( OP_REG, F_MUL, FF_MULDIV, c, a, b )
+def MULH( c, a, b ):
+  return RV32I_R( OP_REG, F_MULH, FF_MULDIV, c, a, b )
+def MULHSU( c, a, b ):
+  return RV32I_R( OP_REG, F_MULHSU, FF_MULDIV, c, a, b )
+def MULHU( c, a, b ):
+  return RV32I_R( OP_REG, F_MULHU, FF_MULDIV, c, a, b )
+def DIV( c, a, b ):
+  return RV32I_R( OP_REG, F_DIV, FF_MULDIV, c, a, b )
+def DIVU( c, a, b ):
+  return RV32I_R( OP_REG, F_DIVU, FF_MULDIV, c, a, b )
+def REM( c, a, b ):
+  return RV32I_R( OP_REG, F_REM, FF_MULDIV, c, a, b )
+def REMU( c, a, b ):
+  return RV32I_R( OP_REG, F_REMU, FF_MULDIV, c, a, b )
+# 'Zba' / 'Zbb' bit-manipulation operations:
+def SH1ADD( c, a, b ):
+  return RV32I_R( OP_REG, F_SH1ADD, FF_SHADD, c, a, b )
+def SH2ADD( c, a, b ):
+  return RV32I_R( OP_REG, F_SH2ADD, FF_SHADD, c, a, b )
+def SH3ADD( c, a, b ):
+  return RV32I_R( OP_REG, F_SH3ADD, FF_SHADD, c, a, b )
+def ANDN( c, a, b ):
+  return RV32I_R( OP_REG, F_ANDN, FF_ANDN, c, a, b )
+def ORN( c, a, b ):
+  return RV32I_R( OP_REG, F_ORN, FF_ANDN, c, a, b )
+def XNOR( c, a, b ):
+  return RV32I_R( OP_REG, F_XNOR, FF_ANDN, c, a, b )
+def MIN( c, a, b ):
+  return RV32I_R( OP_REG, F_MIN, FF_MINMAX, c, a, b )
+def MINU( c, a, b ):
+  return RV32I_R( OP_REG, F_MINU, FF_MINMAX, c, a, b )
+def MAX( c, a, b ):
+  return RV32I_R( OP_REG, F_MAX, FF_MINMAX, c, a, b )
+def MAXU( c, a, b ):
+  return RV32I_R( OP_REG, F_MAXU, FF_MINMAX, c, a, b )
+def ROL( c, a, b ):
+  return RV32I_R( OP_REG, F_ROL, FF_ROT, c, a, b )
+def ROR( c, a, b ):
+  return RV32I_R( OP_REG, F_ROR, FF_ROT, c, a, b )
+# Special case: like the other immediate shift operations,
+# 'RORI' is structured as an R-type operation.
+def RORI( c, a, i ):
+  return RV32I_R( OP_IMM, F_RORI, FF_ROT, c, a, i )
+# Single-operand operations use a fixed immediate value.
+def CLZ( c, a ):
+  return RV32I_I( OP_IMM, F_UNARY, c, a, IMM_CLZ )
+def CTZ( c, a ):
+  return RV32I_I( OP_IMM, F_UNARY, c, a, IMM_CTZ )
+def CPOP( c, a ):
+  return RV32I_I( OP_IMM, F_UNARY, c, a, IMM_CPOP )
+def SEXT_B( c, a ):
+  return RV32I_I( OP_IMM, F_UNARY, c, a, IMM_SEXTB )
+def SEXT_H( c, a ):
+  return RV32I_I( OP_IMM, F_UNARY, c, a, IMM_SEXTH )
+def REV8( c, a ):
+  return RV32I_I( OP_IMM, F_REV8, c, a, IMM_REV8 )
+# Atomic memory operations: rc = Memory[ Ra ], and then
+# Memory[ Ra ] = Memory[ Ra ] ? Rb. ('LR.W' only loads, and 'SC.W'
+# only stores if it succeeds; it sets rc = 0 if it does)
+def RV32A( ff, c, a, b ):
+  return RV32I_R( OP_AMO, F_AMOW, ff << 2, c, a, b )
+def LR_W( c, a ):
+  return RV32A( FF_LR, c, a, 0 )
+def SC_W( c, a, b ):
+  return RV32A( FF_SC, c, a, b )
+def AMOSWAP_W( c, a, b ):
+  return RV32A( FF_AMOSWAP, c, a, b )
+def AMOADD_W( c, a, b ):
+  return RV32A( FF_AMOADD, c, a, b )
+def AMOXOR_W( c, a, b ):
+  return RV32A( FF_AMOXOR, c, a, b )
+def AMOAND_W( c, a, b ):
+  return RV32A( FF_AMOAND, c, a, b )
+def AMOOR_W( c, a, b ):
+  return RV32A( FF_AMOOR, c, a, b )
+def AMOMIN_W( c, a, b ):
+  return RV32A( FF_AMOMIN, c, a, b )
+def AMOMAX_W( c, a, b ):
+  return RV32A( FF_AMOMAX, c, a, b )
+def AMOMINU_W( c, a, b ):
+  return RV32A( FF_AMOMINU, c, a, b )
+def AMOMAXU_W( c, a, b ):
+  return RV32A( FF_AMOMAXU, c, a, b )
+# Custom accelerator operations: 'f' and 'ff' are passed on to the
+# accelerator, which decides what they mean.
+def CUSTOM0( f, ff, c, a, b ):
+  return RV32I_R( OP_CUSTOM0, f, ff, c, a, b )
+def CUSTOM1( f, ff, c, a, b ):
+  return RV32I_R( OP_CUSTOM1, f, ff, c, a, b )
 # Special case: immediate shift operations use
 # 5-bit immediates, structured as an R-type operation.
 def SLLI( c, a, i ):
@@ -344,6 +613,33 @@ def AUIPC( c, i ):
 # J-type operation:
 def JAL( c, i ):
   return RV32I_J( OP_JAL, c, i )
+# CSR operations: ( rd, CSR address, rs1 / immediate )
+def CSRRW( c, csr, a ):
+  return RV32I_I( OP_SYSTEM, F_CSRRW, c, a, csr )
+def CSRRS( c, csr, a ):
+  return RV32I_I( OP_SYSTEM, F_CSRRS, c, a, csr )
+def CSRRC( c, csr, a ):
+  return RV32I_I( OP_SYSTEM, F_CSRRC, c, a, csr )
+def CSRRWI( c, csr, i ):
+  return RV32I_I( OP_SYSTEM, F_CSRRWI, c, i, csr )
+def CSRRSI( c, csr, i ):
+  return RV32I_I( OP_SYSTEM, F_CSRRSI, c, i, csr )
+def CSRRCI( c, csr, i ):
+  return RV32I_I( OP_SYSTEM, F_CSRRCI, c, i, csr )
+# Trap operations:
+def ECALL():
+  return RV32I_I( OP_SYSTEM, F_TRAPS, 0, 0, 0x000 )
+def EBREAK():
+  return RV32I_I( OP_SYSTEM, F_TRAPS, 0, 0, 0x001 )
+def MRET():
+  return RV32I_I( OP_SYSTEM, F_TRAPS, 0, 0, IMM_MRET )
+def WFI():
+  return RV32I_I( OP_SYSTEM, F_TRAPS, 0, 0, IMM_WFI )
+# Fence operations:
+def FENCE():
+  return RV32I_I( OP_FENCE, F_FENCE, 0, 0, 0x0FF )
+def FENCE_I():
+  return RV32I_I( OP_FENCE, F_FENCEI, 0, 0, 0x000 )
 # Assembly pseudo-ops:
 def LI( c, i ):
   if ( ( i & 0x0FFF ) & 0x0800 ):
@@ -354,8 +650,116 @@ def LI( c, i ):
 def NOP():
   return ADDI( 0, 0, 0x000 )
 
+# 'C' extension compressed instructions. These are 16 bits long, so
+# their encoders return 'C16' values to let 'rom_img' pack them two
+# to a word. Registers are given by their full numbers, but some
+# instructions can only use r8-r15. Like the 32-bit jump and branch
+# encoders, the compressed ones take half of the address offset.
+class C16( int ):
+  pass
+OP_C0     = 0b00
+OP_C1     = 0b01
+OP_C2     = 0b10
+# Helper method to pick bits [ lo : hi + 1 ] out of an immediate
+# value, and shift them to bit 'pos' of an instruction.
+def CBITS( i, hi, lo, pos ):
+  return ( ( i >> lo ) & ( ( 1 << ( hi - lo + 1 ) ) - 1 ) ) << pos
+# Quadrant 0: stack pointer offsets, loads, and stores.
+def C_ADDI4SPN( c, i ):
+  return C16( OP_C0 | ( ( c - 8 ) << 2 ) | CBITS( i, 3, 3, 5 ) |
+              CBITS( i, 2, 2, 6 ) | CBITS( i, 9, 6, 7 ) |
+              CBITS( i, 5, 4, 11 ) | ( 0b000 << 13 ) )
+def C_LW( c, a, i ):
+  return C16( OP_C0 | ( ( c - 8 ) << 2 ) | CBITS( i, 6, 6, 5 ) |
+              CBITS( i, 2, 2, 6 ) | ( ( a - 8 ) << 7 ) |
+              CBITS( i, 5, 3, 10 ) | ( 0b010 << 13 ) )
+def C_SW( a, b, i ):
+  return C16( OP_C0 | ( ( b - 8 ) << 2 ) | CBITS( i, 6, 6, 5 ) |
+              CBITS( i, 2, 2, 6 ) | ( ( a - 8 ) << 7 ) |
+              CBITS( i, 5, 3, 10 ) | ( 0b110 << 13 ) )
+# Quadrant 1: immediate values, arithmetic, jumps, and branches.
+def RV32C_CI( op, f, c, i ):
+  return C16( op | CBITS( i, 4, 0, 2 ) | ( ( c & 0x1F ) << 7 ) |
+              CBITS( i, 5, 5, 12 ) | ( f << 13 ) )
+def RV32C_CJ( f, i ):
+  i = i << 1
+  return C16( OP_C1 | CBITS( i, 5, 5, 2 ) | CBITS( i, 3, 1, 3 ) |
+              CBITS( i, 7, 7, 6 ) | CBITS( i, 6, 6, 7 ) |
+              CBITS( i, 10, 10, 8 ) | CBITS( i, 9, 8, 9 ) |
+              CBITS( i, 4, 4, 11 ) | CBITS( i, 11, 11, 12 ) |
+              ( f << 13 ) )
+def RV32C_CB( f, a, i ):
+  i = i << 1
+  return C16( OP_C1 | CBITS( i, 5, 5, 2 ) | CBITS( i, 2, 1, 3 ) |
+              CBITS( i, 7, 6, 5 ) | ( ( a - 8 ) << 7 ) |
+              CBITS( i, 4, 3, 10 ) | CBITS( i, 8, 8, 12 ) |
+              ( f << 13 ) )
+def RV32C_CA( f, c, b ):
+  return C16( OP_C1 | ( ( b - 8 ) << 2 ) | ( f << 5 ) |
+              ( ( c - 8 ) << 7 ) | ( 0b100011 << 10 ) )
+def C_NOP():
+  return RV32C_CI( OP_C1, 0b000, 0, 0 )
+def C_ADDI( c, i ):
+  return RV32C_CI( OP_C1, 0b000, c, i )
+def C_JAL( i ):
+  return RV32C_CJ( 0b001, i )
+def C_LI( c, i ):
+  return RV32C_CI( OP_C1, 0b010, c, i )
+def C_ADDI16SP( i ):
+  return C16( OP_C1 | CBITS( i, 5, 5, 2 ) | CBITS( i, 8, 7, 3 ) |
+              CBITS( i, 6, 6, 5 ) | CBITS( i, 4, 4, 6 ) | ( 2 << 7 ) |
+              CBITS( i, 9, 9, 12 ) | ( 0b011 << 13 ) )
+def C_LUI( c, i ):
+  return RV32C_CI( OP_C1, 0b011, c, i >> 12 )
+def C_SRLI( c, i ):
+  return C16( RV32C_CI( OP_C1, 0b100, c - 8, i ) | ( 0b00 << 10 ) )
+def C_SRAI( c, i ):
+  return C16( RV32C_CI( OP_C1, 0b100, c - 8, i ) | ( 0b01 << 10 ) )
+def C_ANDI( c, i ):
+  return C16( RV32C_CI( OP_C1, 0b100, c - 8, i ) | ( 0b10 << 10 ) )
+def C_SUB( c, b ):
+  return RV32C_CA( 0b00, c, b )
+def C_XOR( c, b ):
+  return RV32C_CA( 0b01, c, b )
+def C_OR( c, b ):
+  return RV32C_CA( 0b10, c, b )
+def C_AND( c, b ):
+  return RV32C_CA( 0b11, c, b )
+def C_J( i ):
+  return RV32C_CJ( 0b101, i )
+def C_BEQZ( a, i ):
+  return RV32C_CB( 0b110, a, i )
+def C_BNEZ( a, i ):
+  return RV32C_CB( 0b111, a, i )
+# Quadrant 2: shifts, stack pointer loads / stores, and
+# register-to-register operations.
+def RV32C_CR( f, c, b ):
+  return C16( OP_C2 | ( ( b & 0x1F ) << 2 ) | ( ( c & 0x1F ) << 7 ) |
+              ( f << 12 ) )
+def C_SLLI( c, i ):
+  return RV32C_CI( OP_C2, 0b000, c, i )
+def C_LWSP( c, i ):
+  return C16( OP_C2 | CBITS( i, 7, 6, 2 ) | CBITS( i, 4, 2, 4 ) |
+              ( ( c & 0x1F ) << 7 ) | CBITS( i, 5, 5, 12 ) |
+              ( 0b010 << 13 ) )
+def C_JR( a ):
+  return RV32C_CR( 0b1000, a, 0 )
+def C_MV( c, b ):
+  return RV32C_CR( 0b1000, c, b )
+def C_EBREAK():
+  return RV32C_CR( 0b1001, 0, 0 )
+def C_JALR( a ):
+  return RV32C_CR( 0b1001, a, 0 )
+def C_ADD( c, b ):
+  return RV32C_CR( 0b1001, c, b )
+def C_SWSP( b, i ):
+  return C16( OP_C2 | ( ( b & 0x1F ) << 2 ) | CBITS( i, 7, 6, 7 ) |
+              CBITS( i, 5, 2, 9 ) | ( 0b110 << 13 ) )
+
 # Helper method to assemble a ROM image from a mix of instructions
-# and assembly pseudo-operations.
+# and assembly pseudo-operations. If there are any compressed
+# instructions, every instruction is split into halfwords which
+# are packed back into words, padded with a 'C.NOP' if necessary.
 def rom_img( arr ):
   a = []
   for i in arr:
@@ -364,10 +768,165 @@ def rom_img( arr ):
         a.append( j )
     else:
       a.append( i )
-  return a
+  if not any( type( i ) == C16 for i in a ):
+    return a
+  h = []
+  for i in a:
+    if type( i ) == C16:
+      h.append( i )
+    else:
+      h.extend( [ LITTLE_END( i ) & 0xFFFF, LITTLE_END( i ) >> 16 ] )
+  if len( h ) % 2:
+    h.append( C_NOP() )
+  return [ LITTLE_END( h[ i ] | ( h[ i + 1 ] << 16 ) )
+           for i in range( 0, len( h ), 2 ) ]
 # Helper method to assemble a RAM image for a test program.
 def ram_img( arr ):
   a = []
   for i in arr:
     a.append( i )
   return a
+
+# Predecoded instruction fields. ROM images can store these next to
+# each instruction, so that the CPU does not need to decode them:
+# * Bits 0-31:  Sign-extended immediate value, in the instruction's
+#               format. (I-type for R-type and system instructions)
+# * Bit 32:     'Writes rd' flag: set if the instruction writes a
+#               value to a CPU register other than r0.
+# * Bits 33-46: One-hot instruction class, in 'PD_OPS' order. It is
+#               zero for unrecognized opcodes.
+PD_OPS = [ OP_LUI, OP_AUIPC, OP_JAL, OP_JALR, OP_BRANCH, OP_LOAD,
+           OP_STORE, OP_IMM, OP_REG, OP_SYSTEM, OP_FENCE,
+           OP_CUSTOM0, OP_CUSTOM1, OP_AMO ]
+PD_IMM = slice( 0, 32 )
+PD_WR  = 32
+PD_CLS = slice( 33, 33 + len( PD_OPS ) )
+PD_W   = 33 + len( PD_OPS )
+# Immediate value formats for each instruction class.
+PD_FMT = {
+  OP_LUI: 'U', OP_AUIPC: 'U', OP_JAL: 'J', OP_BRANCH: 'B',
+  OP_STORE: 'S'
+}
+
+# Helper method to sign-extend an N-bit value.
+def SEXT( v, n ):
+  return ( v & ( ( 1 << n ) - 1 ) ) - ( ( v & ( 1 << ( n - 1 ) ) ) << 1 )
+
+# Get an instruction's immediate value in a given format.
+def IMM( v, fmt ):
+  if fmt == 'U':
+    return v & 0xFFFFF000
+  elif fmt == 'J':
+    return SEXT( ( ( ( v >> 31 ) & 0x001 ) << 20 ) |
+                 ( ( ( v >> 12 ) & 0x0FF ) << 12 ) |
+                 ( ( ( v >> 20 ) & 0x001 ) << 11 ) |
+                 ( ( ( v >> 21 ) & 0x3FF ) << 1  ), 21 )
+  elif fmt == 'B':
+    return SEXT( ( ( ( v >> 31 ) & 0x01 ) << 12 ) |
+                 ( ( ( v >> 7  ) & 0x01 ) << 11 ) |
+                 ( ( ( v >> 25 ) & 0x3F ) << 5  ) |
+                 ( ( ( v >> 8  ) & 0x0F ) << 1  ), 13 )
+  elif fmt == 'S':
+    return SEXT( ( ( ( v >> 25 ) & 0x7F ) << 5 ) |
+                 ( ( v >> 7 ) & 0x1F ), 12 )
+  return SEXT( v >> 20, 12 )
+# Immediate value decoding for use within an nMigen design.
+def IMM_L( v, fmt ):
+  if fmt == 'U':
+    return Cat( Repl( 0, 12 ), v[ 12 : 32 ] )
+  elif fmt == 'J':
+    return Cat( Repl( 0, 1 ), v[ 21 : 31 ], v[ 20 ], v[ 12 : 20 ],
+                Repl( v[ 31 ], 12 ) )
+  elif fmt == 'B':
+    return Cat( Repl( 0, 1 ), v[ 8 : 12 ], v[ 25 : 31 ], v[ 7 ],
+                Repl( v[ 31 ], 20 ) )
+  elif fmt == 'S':
+    return Cat( v[ 7 : 12 ], v[ 25 : 32 ], Repl( v[ 31 ], 20 ) )
+  return Cat( v[ 20 : 32 ], Repl( v[ 31 ], 20 ) )
+
+# Predecode an instruction word, for storing in a ROM image.
+# (The word is in normal byte order, not little-endian format.)
+def PREDECODE( v ):
+  op = v & 0x7F
+  imm = IMM( v, PD_FMT.get( op, 'I' ) ) & 0xFFFFFFFF
+  if op not in PD_OPS:
+    return imm
+  wr = ( ( ( v >> 7 ) & 0x1F ) != 0 ) and \
+       ( op not in [ OP_BRANCH, OP_STORE, OP_FENCE ] ) and \
+       not ( ( op == OP_SYSTEM ) and ( ( ( v >> 12 ) & 0x7 ) == F_TRAPS ) )
+  return ( imm | ( int( wr ) << PD_WR ) |
+           ( 1 << ( PD_CLS.start + PD_OPS.index( op ) ) ) )
+# Instruction predecoding for use within an nMigen design. This is
+# used for instructions which are fetched from other memories.
+def PREDECODE_L( v ):
+  cls = Cat( v[ 0 : 7 ] == op for op in PD_OPS )
+  imm = IMM_L( v, 'I' )
+  for op, fmt in PD_FMT.items():
+    imm = Mux( cls[ PD_OPS.index( op ) ], IMM_L( v, fmt ), imm )
+  wr = ( ( v[ 7 : 12 ] != 0 ) &
+         ~( cls[ PD_OPS.index( OP_BRANCH ) ] |
+            cls[ PD_OPS.index( OP_STORE ) ] |
+            cls[ PD_OPS.index( OP_FENCE ) ] |
+            ( cls[ PD_OPS.index( OP_SYSTEM ) ] &
+              ( v[ 12 : 15 ] == F_TRAPS ) ) ) &
+         ( cls != 0 ) )
+  return Cat( imm, wr, cls )
+
+##################
+# ISA testbench: #
+##################
+# Keep track of test pass / fail rates.
+p = 0
+f = 0
+
+# Check that an assembled instruction's immediate value and source
+# registers decode back to the values that it was assembled with.
+# ( S / B-type: rs1 and rs2, I-type: rs1, U / J-type: none )
+def enc_ut( name, v, fmt, regs, i ):
+  global p, f
+  v = LITTLE_END( v )
+  rs = ( ( v >> 15 ) & 0x1F, ( v >> 20 ) & 0x1F )[ :len( regs ) ]
+  imm = IMM( v, fmt )
+  if ( rs == tuple( regs ) ) and ( imm == i ):
+    p += 1
+    print( "\033[32mPASS:\033[0m %s %s, %s"
+           %( name, list( regs ), hexs( i & 0xFFFFFFFF ) ) )
+  else:
+    f += 1
+    print( "\033[31mFAIL:\033[0m %s %s, %s (got: %s, %s)"
+           %( name, list( regs ), hexs( i & 0xFFFFFFFF ),
+              list( rs ), hexs( imm & 0xFFFFFFFF ) ) )
+
+# 'main' method to run the instruction encoder tests.
+if __name__ == "__main__":
+  print( "--- Instruction Encoder Tests ---" )
+  # S-type: store offsets are split between two immediate fields.
+  enc_ut( "SW", SW( 1, 2, 0x000 ), 'S', [ 1, 2 ], 0x000 )
+  enc_ut( "SW", SW( 3, 31, 0x01F ), 'S', [ 3, 31 ], 0x01F )
+  enc_ut( "SW", SW( 3, 31, 0x020 ), 'S', [ 3, 31 ], 0x020 )
+  enc_ut( "SH", SH( 10, 11, 0x444 ), 'S', [ 10, 11 ], 0x444 )
+  enc_ut( "SB", SB( 31, 1, 0x7FF ), 'S', [ 31, 1 ], 0x7FF )
+  enc_ut( "SB", SB( 5, 6, -1 ), 'S', [ 5, 6 ], -1 )
+  enc_ut( "SW", SW( 7, 8, -2048 ), 'S', [ 7, 8 ], -2048 )
+  # Every S-type offset, with a single result.
+  sf = [ i for i in range( -2048, 2048 )
+         if IMM( LITTLE_END( SW( 1, 2, i ) ), 'S' ) != i ]
+  if len( sf ) == 0:
+    p += 1
+    print( "\033[32mPASS:\033[0m SW offsets -2048 to 2047" )
+  else:
+    f += 1
+    print( "\033[31mFAIL:\033[0m SW offsets -2048 to 2047 "
+           "(%d wrong, first: %d)"%( len( sf ), sf[ 0 ] ) )
+  # I-type, B-type, U-type, and J-type immediates. (Branch and jump
+  # encoders take half of the address offset)
+  enc_ut( "LW", LW( 4, 5, 0x7FF ), 'I', [ 5 ], 0x7FF )
+  enc_ut( "ADDI", ADDI( 4, 5, -2048 ), 'I', [ 5 ], -2048 )
+  enc_ut( "BEQ", BEQ( 1, 2, 0x7FF ), 'B', [ 1, 2 ], 0xFFE )
+  enc_ut( "BNE", BNE( 3, 4, -0x800 ), 'B', [ 3, 4 ], -0x1000 )
+  enc_ut( "LUI", LUI( 9, 0xFEDCB000 ), 'U', [], 0xFEDCB000 )
+  enc_ut( "JAL", JAL( 1, 0x7FFFF ), 'J', [], 0xFFFFE )
+  enc_ut( "JAL", JAL( 1, -0x80000 ), 'J', [], -0x100000 )
+
+  # Done.
+  print( "Instruction Encoder Tests: %d Passed, %d Failed"%( p, f ) )
@@ -0,0 +1,175 @@
+from nmigen import *
+from math import ceil, log2
+from nmigen.back.pysim import *
+from nmigen_soc.memory import *
+from nmigen_soc.wishbone import *
+
+from isa import *
+
+##################################################################
+# Tightly-coupled instruction memory ('ITCM') module: a small    #
+# RAM with a dedicated instruction fetch port. Fetches do not go #
+# through the instruction bus multiplexer or an arbiter; the     #
+# fetch port's address comes straight from the fetch address,   #
+# and its registered output holds the word on the next cycle.   #
+# The data bus port can read and write the same memory, so that #
+# programs can copy code into it before running it. Since the   #
+# two ports are separate, fetches never wait for data accesses. #
+# (Like with RAM, stores are only guaranteed to be visible to    #
+#  instruction fetches after a 'FENCE.I' instruction)            #
+##################################################################
+
+class ITCM( Elaboratable ):
+  def __init__( self, size_words, wide = False ):
+    # Record size.
+    self.size = ( size_words * 4 )
+    # Data storage.
+    self.data = Memory( width = 32, depth = size_words,
+      init = ( 0x000000 for i in range( size_words ) ) )
+    # Data bus read and write ports. The write port has one enable
+    # bit per byte, like the RAM module's.
+    self.r = self.data.read_port()
+    self.w = self.data.write_port( granularity = 8 )
+    # Data bus interface. Bus addresses are in words, and 'sel'
+    # selects which bytes of the word are accessed.
+    self.bus = Interface( addr_width = ceil( log2( size_words + 1 ) ),
+                          data_width = 32,
+                          granularity = 8 )
+    self.bus.memory_map = MemoryMap( addr_width = self.bus.addr_width + 2,
+                                     data_width = self.bus.granularity,
+                                     alignment = 0 )
+
+    # Instruction fetch port: a word address, a 'request' flag, the
+    # word at the previous cycle's address, and a flag which is set
+    # if it was requested. With 64-bit fetches ('wide'), the address
+    # is a doubleword address, and both of its words are returned.
+    self.wide = wide
+    self.fr = [ self.data.read_port() for i in range( 2 if wide else 1 ) ]
+    self.fadr = Signal( self.bus.addr_width - ( 1 if wide else 0 ),
+                        reset = 0 )
+    self.freq = Signal( 1, reset = 0 )
+    self.fdat = Signal( 64 if wide else 32, reset = 0 )
+    self.fack = Signal( 1, reset = 0 )
+
+  def elaborate( self, platform ):
+    m = Module()
+    m.submodules.r = self.r
+    m.submodules.w = self.w
+    for i in range( len( self.fr ) ):
+      setattr( m.submodules, "fr%d"%i, self.fr[ i ] )
+
+    # Data bus port: like the RAM module, ack one cycle after
+    # activation, and only write the bytes whose 'sel' lanes are set.
+    m.d.sync += self.bus.ack.eq( self.bus.cyc )
+    m.d.comb += [
+      self.r.addr.eq( self.bus.adr ),
+      self.w.addr.eq( self.bus.adr ),
+      self.bus.dat_r.eq( self.r.data ),
+      self.w.data.eq( self.bus.dat_w ),
+      self.w.en.eq( Mux( self.bus.cyc & self.bus.we,
+                         self.bus.sel, 0 ) )
+    ]
+
+    # Instruction fetch port: there is no handshake, so a new word
+    # can be requested on every cycle.
+    m.d.sync += self.fack.eq( self.freq )
+    if self.wide:
+      m.d.comb += [
+        self.fr[ 0 ].addr.eq( Cat( Repl( 0, 1 ), self.fadr ) ),
+        self.fr[ 1 ].addr.eq( Cat( Repl( 1, 1 ), self.fadr ) ),
+        self.fdat.eq( Cat( self.fr[ 0 ].data, self.fr[ 1 ].data ) )
+      ]
+    else:
+      m.d.comb += [
+        self.fr[ 0 ].addr.eq( self.fadr ),
+        self.fdat.eq( self.fr[ 0 ].data )
+      ]
+
+    # End of ITCM module definition.
+    return m
+
+###################
+# ITCM testbench: #
+###################
+# Keep track of test pass / fail rates.
+p = 0
+f = 0
+
+# Helper method to record unit test pass/fails.
+def itcm_ut( name, actual, expected ):
+  global p, f
+  if expected != actual:
+    f += 1
+    print( "\033[31mFAIL:\033[0m %s (0x%08X != 0x%08X)"
+           %( name, actual, expected ) )
+  else:
+    p += 1
+    print( "\033[32mPASS:\033[0m %s (0x%08X == 0x%08X)"
+           %( name, actual, expected ) )
+
+# Write a word through the data bus port, and wait for 'ack'.
+def itcm_write( itcm, address, data, sel ):
+  yield itcm.bus.adr.eq( address )
+  yield itcm.bus.dat_w.eq( data )
+  yield itcm.bus.sel.eq( sel )
+  yield itcm.bus.we.eq( 1 )
+  yield itcm.bus.cyc.eq( 1 )
+  yield Tick()
+  yield Settle()
+  itcm_ut( "Write [0x%02X] ack"%address, ( yield itcm.bus.ack ), 1 )
+  yield itcm.bus.we.eq( 0 )
+  yield itcm.bus.cyc.eq( 0 )
+  yield Tick()
+
+# Fetch a word through the fetch port. It should arrive on the next
+# cycle, even if the data bus port is busy.
+def itcm_fetch( itcm, address, expected ):
+  yield itcm.fadr.eq( address )
+  yield itcm.freq.eq( 1 )
+  yield Tick()
+  yield Settle()
+  yield itcm.freq.eq( 0 )
+  itcm_ut( "Fetch [0x%02X] ack"%address, ( yield itcm.fack ), 1 )
+  itcm_ut( "Fetch [0x%02X] data"%address, ( yield itcm.fdat ), expected )
+
+# Top-level ITCM test method.
+def itcm_test( itcm ):
+  global p, f
+
+  # Let signals settle after reset.
+  yield Settle()
+  # Print a test header.
+  print( "--- ITCM Tests ---" )
+
+  # Write a few words, and fetch them back.
+  yield from itcm_write( itcm, 0x00, 0x01234567, 0b1111 )
+  yield from itcm_write( itcm, 0x01, 0x89ABCDEF, 0b1111 )
+  yield from itcm_write( itcm, 0x07, 0xDEADBEEF, 0b1111 )
+  yield from itcm_fetch( itcm, 0x00, 0x01234567 )
+  yield from itcm_fetch( itcm, 0x01, 0x89ABCDEF )
+  yield from itcm_fetch( itcm, 0x07, 0xDEADBEEF )
+  # Byte writes only change the selected bytes.
+  yield from itcm_write( itcm, 0x07, 0x00C0FFEE, 0b0110 )
+  yield from itcm_fetch( itcm, 0x07, 0xDEC0FFEF )
+  # Fetches don't wait for data bus reads.
+  yield itcm.bus.adr.eq( 0x01 )
+  yield itcm.bus.cyc.eq( 1 )
+  yield from itcm_fetch( itcm, 0x00, 0x01234567 )
+  itcm_ut( "Read [0x01] data", ( yield itcm.bus.dat_r ), 0x89ABCDEF )
+  yield itcm.bus.cyc.eq( 0 )
+
+  # Done.
+  yield Tick()
+  print( "ITCM Tests: %d Passed, %d Failed"%( p, f ) )
+
+# 'main' method to run a basic testbench.
+if __name__ == "__main__":
+  # Instantiate a test ITCM module with 32 bytes of data.
+  dut = ITCM( 8 )
+  # Run the ITCM tests.
+  with Simulator( dut, vcd_file = open( 'itcm.vcd', 'w' ) ) as sim:
+    def proc():
+      yield from itcm_test( dut )
+    sim.add_clock( 1e-6 )
+    sim.add_sync_process( proc )
+    sim.run()
@@ -0,0 +1,293 @@
+from nmigen import *
+from nmigen.back.pysim import *
+
+from isa import *
+
+import sys
+
+###############################################################
+# Multiply / divide module for the RISC-V 'M' extension.      #
+# * Multiplications are split into four 16x16-bit products,   #
+#   which use the iCE40UP5K's 'SB_MAC16' DSP blocks when the  #
+#   design is built. They are registered, and the result is   #
+#   ready one cycle after the operation starts.               #
+# * Divisions use a radix-2 restoring divider, which finds    #
+#   one quotient bit per cycle. The result is ready 33 cycles #
+#   after the operation starts.                               #
+# The 'f' input takes the instruction's 'funct3' bits.        #
+###############################################################
+
+class MulDiv( Elaboratable ):
+  def __init__( self ):
+    # 'A' and 'B' data inputs.
+    self.a = Signal( 32, reset = 0x00000000 )
+    self.b = Signal( 32, reset = 0x00000000 )
+    # 'F' function select input.
+    self.f = Signal( 3,  reset = 0b000 )
+    # 'Start' input: latches the inputs and starts an operation.
+    self.start = Signal( reset = 0 )
+    # 'Y' data output, and a flag which is set for one cycle
+    # when it holds the result of the last operation.
+    self.y = Signal( 32, reset = 0x00000000 )
+    self.done = Signal( reset = 0 )
+
+  # Helper method to multiply two unsigned 16-bit values. Simulations
+  # use a behavioural model; builds use a DSP block with no registers.
+  def mul16( self, m, platform, a, b ):
+    p = Signal( 32, reset = 0x00000000 )
+    if platform is None:
+      m.d.comb += p.eq( a * b )
+    else:
+      m.submodules += Instance( "SB_MAC16",
+        p_NEG_TRIGGER = 0,
+        p_C_REG = 0, p_A_REG = 0, p_B_REG = 0, p_D_REG = 0,
+        p_TOP_8x8_MULT_REG = 0, p_BOT_8x8_MULT_REG = 0,
+        p_PIPELINE_16x16_MULT_REG1 = 0,
+        p_PIPELINE_16x16_MULT_REG2 = 0,
+        p_TOPOUTPUT_SELECT = 0b11, p_TOPADDSUB_LOWERINPUT = 0b00,
+        p_TOPADDSUB_UPPERINPUT = 0, p_TOPADDSUB_CARRYSELECT = 0b00,
+        p_BOTOUTPUT_SELECT = 0b11, p_BOTADDSUB_LOWERINPUT = 0b00,
+        p_BOTADDSUB_UPPERINPUT = 0, p_BOTADDSUB_CARRYSELECT = 0b00,
+        p_MODE_8x8 = 0, p_A_SIGNED = 0, p_B_SIGNED = 0,
+        i_CLK = ClockSignal(), i_CE = 1,
+        i_A = a, i_B = b, i_C = 0, i_D = 0,
+        i_AHOLD = 0, i_BHOLD = 0, i_CHOLD = 0, i_DHOLD = 0,
+        i_IRSTTOP = 0, i_IRSTBOT = 0, i_ORSTTOP = 0, i_ORSTBOT = 0,
+        i_OLOADTOP = 0, i_OLOADBOT = 0,
+        i_ADDSUBTOP = 0, i_ADDSUBBOT = 0,
+        i_OHOLDTOP = 0, i_OHOLDBOT = 0,
+        i_CI = 0, i_ACCUMCI = 0, i_SIGNEXTIN = 0,
+        o_O = p )
+    return p
+
+  def elaborate( self, platform ):
+    # Core multiply / divide module.
+    m = Module()
+
+    # Function bits of the operation in progress.
+    fl  = Signal( 3, reset = 0b000 )
+    # Multiplier: partial products, and a correction which is
+    # subtracted from the upper word for signed operands.
+    # (a * b = ( ah * bh << 32 ) + ( ( ah * bl + al * bh ) << 16 )
+    #          + al * bl, and a signed operand 'x' is equal to its
+    #  unsigned value minus ( x[ 31 ] << 32 ).)
+    pll = Signal( 32, reset = 0x00000000 )
+    plh = Signal( 32, reset = 0x00000000 )
+    phl = Signal( 32, reset = 0x00000000 )
+    phh = Signal( 32, reset = 0x00000000 )
+    cor = Signal( 32, reset = 0x00000000 )
+    mp  = Signal( 64, reset = 0 )
+    mdone = Signal( reset = 0 )
+    # Divider: remaining cycles, remainder, and the register which
+    # holds the dividend and shifts in the quotient bits. The
+    # operands' magnitudes are divided, and the signs are fixed up
+    # once the division is finished.
+    dbusy = Signal( reset = 0 )
+    cnt = Signal( range( 33 ), reset = 0 )
+    q   = Signal( 32, reset = 0x00000000 )
+    r   = Signal( 32, reset = 0x00000000 )
+    d   = Signal( 32, reset = 0x00000000 )
+    t   = Signal( 33, reset = 0 )
+    negq = Signal( reset = 0 )
+    negr = Signal( reset = 0 )
+    dz  = Signal( reset = 0 )
+    # Signed operands' sign bits. ('DIVU' / 'REMU' and 'MULHU'
+    #  are unsigned, and 'MULHSU' only has a signed 'A' operand)
+    sa  = Signal( reset = 0 )
+    sb  = Signal( reset = 0 )
+
+    m.d.comb += [
+      sa.eq( self.a[ 31 ] & Mux( self.f[ 2 ], ~self.f[ 0 ],
+                                 ~( self.f[ 0 ] & self.f[ 1 ] ) ) ),
+      sb.eq( self.b[ 31 ] & Mux( self.f[ 2 ], ~self.f[ 0 ],
+                                 self.f[ :2 ] == F_MULH ) )
+    ]
+
+    # Start a new operation.
+    with m.If( self.start ):
+      m.d.sync += fl.eq( self.f )
+      # Multiplications: register the partial products.
+      with m.If( self.f[ 2 ] == 0 ):
+        m.d.sync += [
+          pll.eq( self.mul16( m, platform,
+                              self.a[ :16 ], self.b[ :16 ] ) ),
+          plh.eq( self.mul16( m, platform,
+                              self.a[ :16 ], self.b[ 16: ] ) ),
+          phl.eq( self.mul16( m, platform,
+                              self.a[ 16: ], self.b[ :16 ] ) ),
+          phh.eq( self.mul16( m, platform,
+                              self.a[ 16: ], self.b[ 16: ] ) ),
+          cor.eq( Mux( sa, self.b, 0 ) + Mux( sb, self.a, 0 ) ),
+          mdone.eq( 1 )
+        ]
+      # Divisions: latch the operands' magnitudes.
+      with m.Else():
+        m.d.sync += [
+          q.eq( Mux( sa, -self.a, self.a ) ),
+          d.eq( Mux( sb, -self.b, self.b ) ),
+          r.eq( 0 ),
+          cnt.eq( 32 ),
+          dbusy.eq( 1 ),
+          negq.eq( sa ^ sb ),
+          negr.eq( sa ),
+          dz.eq( self.b == 0 )
+        ]
+    with m.Else():
+      m.d.sync += mdone.eq( 0 )
+
+    # Multiplication result: add the partial products, and select
+    # the lower or (corrected) upper word.
+    m.d.comb += mp.eq( pll + ( ( plh + phl ) << 16 ) + ( phh << 32 ) )
+    with m.If( mdone ):
+      m.d.comb += [
+        self.done.eq( 1 ),
+        self.y.eq( Mux( fl[ :2 ] == F_MUL, mp[ :32 ],
+                        mp[ 32: ] - cor ) )
+      ]
+
+    # Division steps: shift the next dividend bit into the remainder,
+    # and subtract the divisor from it if it is large enough.
+    m.d.comb += t.eq( Cat( q[ 31 ], r ) )
+    with m.If( dbusy & ( cnt != 0 ) ):
+      m.d.sync += [
+        r.eq( Mux( t >= d, t - d, t ) ),
+        q.eq( Cat( t >= d, q[ :31 ] ) ),
+        cnt.eq( cnt - 1 )
+      ]
+    # Division result: fix the signs. Division by zero returns a
+    # quotient with all bits set and the dividend as the remainder,
+    # so its quotient is never negated.
+    with m.Elif( dbusy ):
+      m.d.sync += dbusy.eq( 0 )
+      m.d.comb += [
+        self.done.eq( 1 ),
+        self.y.eq( Mux( fl[ 1 ], Mux( negr, -r, r ),
+                        Mux( negq & ~dz, -q, q ) ) )
+      ]
+
+    # End of multiply / divide module definition.
+    return m
+
+##################################
+# Multiply / divide testbench:   #
+##################################
+# Keep track of test pass / fail rates.
+p = 0
+f = 0
+# Perform an individual multiply / divide unit test, and check
+# how many cycles it took.
+def md_ut( md, a, b, fn, expected, cycles ):
+  global p, f
+  # Set A, B, F, and start the operation.
+  yield md.a.eq( a )
+  yield md.b.eq( b )
+  yield md.f.eq( fn )
+  yield md.start.eq( 1 )
+  yield Tick()
+  yield md.start.eq( 0 )
+  nc = 1
+  # Wait for the result.
+  yield Settle()
+  while ( yield md.done ) == 0:
+    yield Tick()
+    nc += 1
+    yield Settle()
+  # Done. Check the result after combinatorial logic settles.
+  actual = yield md.y
+  if ( hexs( expected ) != hexs( actual ) ) or ( nc != cycles ):
+    f += 1
+    print( "\033[31mFAIL:\033[0m %s %s %s = %s in %d cycles "
+           "(got: %s in %d cycles)"
+           %( hexs( a ), MD_STRS[ fn ], hexs( b ),
+              hexs( expected ), cycles, hexs( actual ), nc ) )
+  else:
+    p += 1
+    print( "\033[32mPASS:\033[0m %s %s %s = %s"
+           %( hexs( a ), MD_STRS[ fn ],
+              hexs( b ), hexs( expected ) ) )
+  yield Tick()
+
+# Top-level multiply / divide test method.
+def md_test( md ):
+  # Let signals settle after reset.
+  yield Settle()
+
+  # Print a test header.
+  print( "--- Multiply / Divide Tests ---" )
+
+  # Test the 'MUL' operation (lower 32 bits of the product).
+  print( "MUL (*) tests:" )
+  yield from md_ut( md, 0, 0, F_MUL, 0, 1 )
+  yield from md_ut( md, 7, 6, F_MUL, 42, 1 )
+  yield from md_ut( md, -7, 6, F_MUL, -42, 1 )
+  yield from md_ut( md, 0x12345678, 0x9ABCDEF0, F_MUL, 0x242D2080, 1 )
+  yield from md_ut( md, 0xFFFFFFFF, 0xFFFFFFFF, F_MUL, 1, 1 )
+
+  # Test the 'MULH' operation (upper 32 bits, signed * signed).
+  print( "MULH (*h) tests:" )
+  yield from md_ut( md, 7, 6, F_MULH, 0, 1 )
+  yield from md_ut( md, -7, 6, F_MULH, -1, 1 )
+  yield from md_ut( md, -1, -1, F_MULH, 0, 1 )
+  yield from md_ut( md, 0x80000000, 0x80000000, F_MULH, 0x40000000, 1 )
+  yield from md_ut( md, 0x7FFFFFFF, 0x80000000, F_MULH, 0xC0000000, 1 )
+  yield from md_ut( md, 0x12345678, 0x9ABCDEF0, F_MULH, 0xF8CC93D6, 1 )
+
+  # Test the 'MULHSU' operation (upper 32 bits, signed * unsigned).
+  print( "MULHSU (*hsu) tests:" )
+  yield from md_ut( md, -1, -1, F_MULHSU, 0xFFFFFFFF, 1 )
+  yield from md_ut( md, 1, -1, F_MULHSU, 0, 1 )
+  yield from md_ut( md, 0x80000000, 0xFFFFFFFF, F_MULHSU, 0x80000000, 1 )
+  yield from md_ut( md, 0x12345678, 0x9ABCDEF0, F_MULHSU, 0x0B00EA4E, 1 )
+
+  # Test the 'MULHU' operation (upper 32 bits, unsigned * unsigned).
+  print( "MULHU (*hu) tests:" )
+  yield from md_ut( md, -1, -1, F_MULHU, 0xFFFFFFFE, 1 )
+  yield from md_ut( md, 0x80000000, 0x80000000, F_MULHU, 0x40000000, 1 )
+  yield from md_ut( md, 0x12345678, 0x9ABCDEF0, F_MULHU, 0x0B00EA4E, 1 )
+
+  # Test the 'DIV' operation (signed).
+  print( "DIV (/) tests:" )
+  yield from md_ut( md, 42, 6, F_DIV, 7, 33 )
+  yield from md_ut( md, -42, 6, F_DIV, -7, 33 )
+  yield from md_ut( md, 43, -6, F_DIV, -7, 33 )
+  yield from md_ut( md, -43, -6, F_DIV, 7, 33 )
+  yield from md_ut( md, 42, 0, F_DIV, -1, 33 )
+  yield from md_ut( md, -42, 0, F_DIV, -1, 33 )
+  yield from md_ut( md, 0x80000000, -1, F_DIV, 0x80000000, 33 )
+
+  # Test the 'DIVU' operation (unsigned).
+  print( "DIVU (/u) tests:" )
+  yield from md_ut( md, 42, 6, F_DIVU, 7, 33 )
+  yield from md_ut( md, -42, 6, F_DIVU, 0x2AAAAAA3, 33 )
+  yield from md_ut( md, 0xFFFFFFFF, 1, F_DIVU, 0xFFFFFFFF, 33 )
+  yield from md_ut( md, 42, 0, F_DIVU, 0xFFFFFFFF, 33 )
+
+  # Test the 'REM' operation (signed; the sign follows the dividend).
+  print( "REM (%) tests:" )
+  yield from md_ut( md, 43, 6, F_REM, 1, 33 )
+  yield from md_ut( md, -43, 6, F_REM, -1, 33 )
+  yield from md_ut( md, 43, -6, F_REM, 1, 33 )
+  yield from md_ut( md, -43, 0, F_REM, -43, 33 )
+  yield from md_ut( md, 0x80000000, -1, F_REM, 0, 33 )
+
+  # Test the 'REMU' operation (unsigned).
+  print( "REMU (%u) tests:" )
+  yield from md_ut( md, 43, 6, F_REMU, 1, 33 )
+  yield from md_ut( md, -43, 6, F_REMU, 3, 33 )
+  yield from md_ut( md, 43, 0, F_REMU, 43, 33 )
+
+  # Done.
+  yield Tick()
+  print( "Multiply / Divide Tests: %d Passed, %d Failed"%( p, f ) )
+
+# 'main' method to run a basic testbench.
+if __name__ == "__main__":
+  # Instantiate a multiply / divide module.
+  dut = MulDiv()
+  # Run the tests.
+  with Simulator( dut, vcd_file = open( 'muldiv.vcd', 'w' ) ) as sim:
+    def proc():
+      yield from md_test( dut )
+    sim.add_clock( 1e-6 )
+    sim.add_sync_process( proc )
+    sim.run()
@@ -0,0 +1,231 @@
+from nmigen import *
+from nmigen.back.pysim import *
+from nmigen_soc.wishbone import *
+from nmigen_soc.memory import *
+
+from isa import *
+from rom import *
+
+###############################################################
+# Instruction prefetch queue: sits between the CPU and the    #
+# instruction bus, and keeps fetching sequential words into a #
+# small FIFO while the CPU is busy executing instructions.    #
+# Any request for an address other than the one at the head   #
+# of the queue (i.e. a jump, branch, or trap) flushes it.     #
+###############################################################
+
+class Prefetch( Elaboratable ):
+  def __init__( self, ibus, depth, pipe = None ):
+    # Memory-side bus which instructions are fetched from.
+    self.ibus = ibus
+    # Optional method which returns whether the memory at a given
+    # address can return one word per cycle while 'cyc' is held.
+    self.pipe = pipe
+    # Number of words which can be buffered.
+    self.depth = depth
+    # FIFO storage, with head / tail indices and a word count.
+    self.q = Array( Signal( 32, reset = 0, name = "pfq_%d"%i )
+                    for i in range( depth ) )
+    self.head = Signal( range( depth ), reset = 0 )
+    self.tail = Signal( range( depth ), reset = 0 )
+    self.count = Signal( range( depth + 1 ), reset = 0 )
+    # (Word) address of the word at the head of the queue.
+    self.hadr = Signal( 30, reset = 0 )
+    # Address of the next word to fetch.
+    self.tadr = Signal( 30, reset = 0 )
+    # Address which was on the memory-side bus during the last cycle.
+    # An 'ack' is only for the word at 'tadr' if they match.
+    self.padr = Signal( 30, reset = 0 )
+    # Flag which is set if the current request had to wait for memory.
+    self.wait = Signal( reset = 0 )
+    # Invalidate signal: flushes the queue when it is set.
+    self.inv = Signal( reset = 0 )
+    # Hit / miss counters. A 'hit' is a request which was
+    # answered from the queue without waiting for memory.
+    self.hits = Signal( 32, reset = 0 )
+    self.misses = Signal( 32, reset = 0 )
+    # CPU-side bus. Like the ROM and RAM modules, 'ack' is asserted
+    # one cycle after a request, so sequential words can be streamed.
+    self.bus = Interface( addr_width = 30, data_width = 32,
+                          granularity = 8 )
+
+  # Helper method to increment a queue index, wrapping at 'depth'.
+  def inc( self, i ):
+    return Mux( i == ( self.depth - 1 ), 0, i + 1 )
+
+  def elaborate( self, platform ):
+    m = Module()
+
+    # Queue control signals.
+    push  = Signal( reset = 0 )
+    pop   = Signal( reset = 0 )
+    flush = Signal( reset = 0 )
+    fwd   = Signal( reset = 0 )
+    # Address to restart fetching from when the queue is flushed.
+    nadr  = Signal( 30, reset = 0 )
+
+    # CPU-side logic: return the head of the queue if the requested
+    # address matches it, and flush the queue if it doesn't or if it
+    # is invalidated. If the queue is empty and the word arrives
+    # this cycle, forward it directly instead of pushing it.
+    m.d.comb += [
+      flush.eq( ( self.bus.cyc & ( self.bus.adr != self.hadr ) ) |
+                self.inv ),
+      nadr.eq( Mux( self.bus.cyc, self.bus.adr, self.hadr ) ),
+      push.eq( self.ibus.ack & ( self.padr == self.tadr ) & ~flush ),
+      fwd.eq( self.bus.cyc & push & ( self.count == 0 ) ),
+      pop.eq( self.bus.cyc & ~flush & ( self.count != 0 ) )
+    ]
+    m.d.sync += self.bus.ack.eq( pop | fwd )
+    with m.If( pop | fwd ):
+      m.d.sync += [
+        self.bus.dat_r.eq( Mux( fwd, self.ibus.dat_r,
+                                self.q[ self.head ] ) ),
+        self.hadr.eq( self.hadr + 1 ),
+        self.wait.eq( 0 )
+      ]
+      with m.If( self.wait ):
+        m.d.sync += self.misses.eq( self.misses + 1 )
+      with m.Else():
+        m.d.sync += self.hits.eq( self.hits + 1 )
+    with m.Elif( self.bus.cyc ):
+      m.d.sync += self.wait.eq( 1 )
+    with m.If( flush ):
+      m.d.sync += self.hadr.eq( nadr )
+
+    # Memory-side logic: fetch sequential words from 'tadr' until
+    # the queue is full. When the queue is flushed, start fetching
+    # from the new address immediately; slow memories abort any read
+    # which is in progress when the address changes. 'cyc' is released
+    # on 'ack' cycles unless the memory can return one word per cycle.
+    if self.pipe is None:
+      stream = 0
+    else:
+      stream = self.pipe( Cat( Repl( 0, 2 ), self.tadr ) )
+    m.d.comb += [
+      self.ibus.adr.eq( Mux( flush, nadr,
+                        Mux( push, self.tadr + 1, self.tadr ) ) ),
+      self.ibus.cyc.eq( ( flush | ( ( self.count + push ) < self.depth ) ) &
+                        ~( self.ibus.ack & ~stream ) ),
+      self.ibus.stb.eq( self.ibus.cyc )
+    ]
+    m.d.sync += self.padr.eq( self.ibus.adr )
+
+    # Queue updates.
+    with m.If( flush ):
+      m.d.sync += [
+        self.tadr.eq( nadr ),
+        self.head.eq( 0 ),
+        self.tail.eq( 0 ),
+        self.count.eq( 0 )
+      ]
+    with m.Else():
+      with m.If( push ):
+        m.d.sync += self.tadr.eq( self.tadr + 1 )
+        with m.If( ~fwd ):
+          m.d.sync += [
+            self.q[ self.tail ].eq( self.ibus.dat_r ),
+            self.tail.eq( self.inc( self.tail ) )
+          ]
+      with m.If( pop ):
+        m.d.sync += self.head.eq( self.inc( self.head ) )
+      with m.If( push & ~fwd & ~pop ):
+        m.d.sync += self.count.eq( self.count + 1 )
+      with m.Elif( pop & ~push ):
+        m.d.sync += self.count.eq( self.count - 1 )
+
+    # End of prefetch module definition.
+    return m
+
+#############################
+# Prefetch queue testbench: #
+#############################
+# Keep track of test pass / fail rates.
+p = 0
+f = 0
+
+# Perform an individual prefetch unit test: request a word, and
+# wait for it. Check the returned data and the number of cycles.
+def pf_read_ut( pf, address, expected, cycles ):
+  global p, f
+  yield pf.bus.adr.eq( address )
+  yield pf.bus.cyc.eq( 1 )
+  yield Tick()
+  nc = 1
+  yield Settle()
+  while ( yield pf.bus.ack ) == 0:
+    yield Tick()
+    nc += 1
+    yield Settle()
+  yield pf.bus.cyc.eq( 0 )
+  actual = yield pf.bus.dat_r
+  if ( expected != actual ) or ( cycles != nc ):
+    f += 1
+    print( "\033[31mFAIL:\033[0m PF[ 0x%08X ] = 0x%08X in %d cycles "
+           "(got: 0x%08X in %d cycles)"
+           %( address, expected, cycles, actual, nc ) )
+  else:
+    p += 1
+    print( "\033[32mPASS:\033[0m PF[ 0x%08X ] = 0x%08X in %d cycles"
+           %( address, expected, cycles ) )
+
+# Helper method to check the hit / miss counters.
+def pf_count_ut( pf, hits, misses ):
+  global p, f
+  ah = yield pf.hits
+  am = yield pf.misses
+  if ( ah != hits ) or ( am != misses ):
+    f += 1
+    print( "\033[31mFAIL:\033[0m %d hits, %d misses "
+           "(got: %d hits, %d misses)"%( hits, misses, ah, am ) )
+  else:
+    p += 1
+    print( "\033[32mPASS:\033[0m %d hits, %d misses"%( hits, misses ) )
+
+# Top-level prefetch test method.
+def pf_test( pf ):
+  global p, f
+
+  # Let signals settle after reset.
+  yield Settle()
+  # Print a test header.
+  print( "--- Prefetch Queue Tests ---" )
+
+  # The queue starts fetching from address 0 after reset.
+  yield from pf_read_ut( pf, 0x0, LITTLE_END( 0x01234567 ), 1 )
+  # Let the queue fill up, then read buffered words.
+  yield Tick()
+  yield Tick()
+  yield Tick()
+  yield from pf_read_ut( pf, 0x1, LITTLE_END( 0x89ABCDEF ), 1 )
+  yield from pf_read_ut( pf, 0x2, LITTLE_END( 0x42424242 ), 1 )
+  yield from pf_count_ut( pf, 3, 0 )
+  # Jumping to a new address flushes the queue.
+  yield from pf_read_ut( pf, 0x1, LITTLE_END( 0x89ABCDEF ), 3 )
+  yield Tick()
+  yield Tick()
+  yield Tick()
+  yield from pf_read_ut( pf, 0x2, LITTLE_END( 0x42424242 ), 1 )
+  yield from pf_read_ut( pf, 0x3, LITTLE_END( 0xDEADBEEF ), 1 )
+  yield from pf_count_ut( pf, 5, 1 )
+
+  # Done.
+  yield Tick()
+  print( "Prefetch Queue Tests: %d Passed, %d Failed"%( p, f ) )
+
+# 'main' method to run a basic testbench.
+if __name__ == "__main__":
+  # Instantiate a test ROM module with 16 bytes of data,
+  # and a 2-word prefetch queue to read from it.
+  rom = ROM( [ 0x01234567, 0x89ABCDEF, 0x42424242, 0xDEADBEEF ] )
+  dut = Prefetch( rom.new_bus(), 2 )
+  m = Module()
+  m.submodules.rom = rom
+  m.submodules.pf  = dut
+  # Run the prefetch queue tests.
+  with Simulator( m, vcd_file = open( 'prefetch.vcd', 'w' ) ) as sim:
+    def proc():
+      yield from pf_test( dut )
+    sim.add_clock( 1e-6 )
+    sim.add_sync_process( proc )
+    sim.run()
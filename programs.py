@@ -1,3 +1,4 @@
+from accel import *
 from isa import *
 
 # "Infinite Loop" program: I think this is the simplest error-free
@@ -75,7 +76,792 @@ ram_exp = {
   'end': 22
 }
 
+# "Self-modifying code" program: copy a short program to RAM and
+# jump to it. That program overwrites one of its own instructions,
+# then uses 'FENCE.I' to make sure that the new one is executed
+# instead of a stale copy from the store buffer, prefetch queue,
+# or pipeline.
+fencei_rom = rom_img( [
+  # Load the starting address of the 'RAM program' into r1, and
+  # the instruction which it should write into r2.
+  LI( 1, 0x20000000 ),
+  LI( 2, LITTLE_END( ADDI( 7, 0, 0x222 ) ) ),
+  # Initialize the 'RAM program'.
+  LI( 3, LITTLE_END( SW( 1, 2, 0x008 ) ) ), SW( 1, 3, 0x000 ),
+  LI( 3, LITTLE_END( FENCE_I() ) ), SW( 1, 3, 0x004 ),
+  LI( 3, LITTLE_END( ADDI( 7, 0, 0x111 ) ) ), SW( 1, 3, 0x008 ),
+  LI( 3, LITTLE_END( JALR( 5, 4, 0x000 ) ) ), SW( 1, 3, 0x00C ),
+  # Make sure that the stores are visible to instruction fetches.
+  FENCE_I(),
+  # Jump to RAM.
+  JALR( 4, 1, 0x000 ),
+  # (This is where the program should jump back to.)
+  ADDI( 9, 0, 0x123 ),
+  # Done; infinite loop.
+  JAL( 1, 0x00000 )
+] )
+
+# Expected runtime values for the "Self-modifying code" program.
+fencei_exp = {
+  0:  [ { 'r': 'pc', 'e': 0x00000000 } ],
+  # The next 16 instructions load the 'RAM program', and
+  # 'FENCE.I' waits for it to be written.
+  17: [
+        { 'r': 'pc', 'e': 0x00000044 },
+        { 'r': 'RAM%d'%( 0x00 ),
+          'e': LITTLE_END( SW( 1, 2, 0x008 ) ) },
+        { 'r': 'RAM%d'%( 0x04 ), 'e': LITTLE_END( FENCE_I() ) },
+        { 'r': 'RAM%d'%( 0x08 ),
+          'e': LITTLE_END( ADDI( 7, 0, 0x111 ) ) },
+        { 'r': 'RAM%d'%( 0x0C ),
+          'e': LITTLE_END( JALR( 5, 4, 0x000 ) ) }
+      ],
+  # The next instruction should jump to RAM.
+  18: [
+        { 'r': 'pc', 'e': 0x20000000 },
+        { 'r': 4, 'e': 0x00000048 }
+      ],
+  # The 'RAM program' overwrites its third instruction.
+  20: [
+        { 'r': 'pc', 'e': 0x20000008 },
+        { 'r': 'RAM%d'%( 0x08 ),
+          'e': LITTLE_END( ADDI( 7, 0, 0x222 ) ) }
+      ],
+  # The new instruction should run, not the old one.
+  21: [
+        { 'r': 'pc', 'e': 0x2000000C },
+        { 'r': 7, 'e': 0x00000222 }
+      ],
+  # The next instruction should jump back to ROM address space.
+  22: [ { 'r': 'pc', 'e': 0x00000048 } ],
+  # Finally, one more instruction should set r9.
+  23: [ { 'r': 9, 'e': 0x00000123 } ],
+  'end': 24
+}
+
+# "Cached loop" program: sum the numbers from 1 to 16 in a loop, then
+# invalidate the instruction cache with 'FENCE.I' and do it again.
+# When running from SPI Flash, an instruction cache should make
+# the second and later iterations of each loop much faster.
+cache_rom = rom_img( [
+  ADDI( 1, 0, 0x000 ), ADDI( 2, 0, 0x010 ),
+  ADD( 1, 1, 2 ), ADDI( 2, 2, -1 ), BNE( 2, 0, -4 ),
+  FENCE_I(),
+  ADDI( 2, 0, 0x010 ),
+  ADD( 1, 1, 2 ), ADDI( 2, 2, -1 ), BNE( 2, 0, -4 ),
+  # Done; infinite loop.
+  JAL( 0, 0x00000 )
+] )
+
+# Expected runtime values for the "Cached loop" program.
+cache_exp = {
+  0:   [ { 'r': 'pc', 'e': 0x00000000 } ],
+  # The first two instructions initialize r1 and r2.
+  2:   [
+         { 'r': 'pc', 'e': 0x00000008 },
+         { 'r': 1, 'e': 0x00000000 },
+         { 'r': 2, 'e': 0x00000010 }
+       ],
+  # The first loop runs 16 times, with 3 instructions per iteration.
+  50:  [
+         { 'r': 'pc', 'e': 0x00000014 },
+         { 'r': 1, 'e': 136 },
+         { 'r': 2, 'e': 0x00000000 }
+       ],
+  # 'FENCE.I' shouldn't change anything, then r2 is reset.
+  52:  [
+         { 'r': 'pc', 'e': 0x0000001C },
+         { 'r': 1, 'e': 136 },
+         { 'r': 2, 'e': 0x00000010 }
+       ],
+  # The second loop also runs 16 times.
+  100: [
+         { 'r': 'pc', 'e': 0x00000028 },
+         { 'r': 1, 'e': 272 },
+         { 'r': 2, 'e': 0x00000000 }
+       ],
+  'end': 101
+}
+
+# "Load latency" program: sum a table of words which are stored in
+# ROM, doing some unrelated work after each load. When running from
+# SPI Flash, non-blocking loads let the unrelated instructions run
+# while each load is still waiting for the Flash chip.
+load_rom = rom_img( [
+  ADDI( 1, 0, 0x040 ), ADDI( 2, 0, 0x004 ),
+  ADDI( 3, 0, 0x000 ), ADDI( 4, 0, 0x000 ),
+  LW( 5, 1, 0x000 ),
+  ADDI( 4, 4, 1 ), ADDI( 4, 4, 1 ), ADDI( 4, 4, 1 ), ADDI( 4, 4, 1 ),
+  ADD( 3, 3, 5 ), ADDI( 1, 1, 4 ), ADDI( 2, 2, -1 ), BNE( 2, 0, -16 ),
+  # Done; infinite loop.
+  JAL( 0, 0x00000 ),
+  # (Padding, then the table of words at 0x40.)
+  NOP(), NOP(),
+  0x11111111, 0x22222222, 0x33333333, 0x44444444
+] )
+
+# Expected runtime values for the "Load latency" program.
+load_exp = {
+  0:  [ { 'r': 'pc', 'e': 0x00000000 } ],
+  # The first four instructions initialize r1-r4.
+  4:  [
+        { 'r': 'pc', 'e': 0x00000010 },
+        { 'r': 1, 'e': 0x00000040 },
+        { 'r': 2, 'e': 0x00000004 }
+      ],
+  # The loop runs 4 times, with 9 instructions per iteration.
+  40: [
+        { 'r': 'pc', 'e': 0x00000034 },
+        { 'r': 1, 'e': 0x00000050 },
+        { 'r': 2, 'e': 0x00000000 },
+        { 'r': 3, 'e': 0xAAAAAAAA },
+        { 'r': 4, 'e': 0x00000010 }
+      ],
+  'end': 41
+}
+
+# "Multiply / divide" program: calculate 10! in a loop with 'MUL',
+# then check the other 'M' extension instructions, including
+# divisions by zero. (Only for cores with the 'M' extension)
+muldiv_rom = rom_img( [
+  ADDI( 1, 0, 0x001 ), ADDI( 2, 0, 0x00A ),
+  MUL( 1, 1, 2 ), ADDI( 2, 2, -1 ), BNE( 2, 0, -4 ),
+  ADDI( 3, 0, -7 ),
+  MULH( 4, 1, 3 ), MULHU( 5, 3, 3 ), DIV( 6, 1, 3 ),
+  REM( 7, 3, 2 ), DIVU( 8, 1, 2 ),
+  # Done; infinite loop.
+  JAL( 0, 0x00000 )
+] )
+
+# Expected runtime values for the "Multiply / divide" program.
+muldiv_exp = {
+  0:  [ { 'r': 'pc', 'e': 0x00000000 } ],
+  # The loop runs 10 times, with 3 instructions per iteration.
+  32: [
+        { 'r': 'pc', 'e': 0x00000014 },
+        { 'r': 1, 'e': 3628800 },
+        { 'r': 2, 'e': 0x00000000 }
+      ],
+  39: [
+        { 'r': 'pc', 'e': 0x0000002C },
+        { 'r': 3, 'e': -7 },
+        { 'r': 4, 'e': 0xFFFFFFFF },
+        { 'r': 5, 'e': 0xFFFFFFF2 },
+        { 'r': 6, 'e': -518400 },
+        { 'r': 7, 'e': -7 },
+        { 'r': 8, 'e': 0xFFFFFFFF }
+      ],
+  'end': 40
+}
+
+# "Bit-manipulation" program: check each 'Zba' / 'Zbb' instruction
+# once. (Only for cores with the bit-manipulation extensions)
+bitmanip_rom = rom_img( [
+  ADDI( 1, 0, -16 ), ADDI( 2, 0, 0x123 ),
+  CLZ( 3, 2 ), CTZ( 4, 1 ), CPOP( 5, 2 ),
+  SEXT_B( 6, 2 ), SEXT_H( 7, 1 ),
+  MIN( 8, 1, 2 ), MINU( 9, 1, 2 ), MAX( 10, 1, 2 ), MAXU( 11, 1, 2 ),
+  ANDN( 12, 2, 1 ), ORN( 13, 2, 1 ), XNOR( 14, 1, 2 ),
+  SH1ADD( 15, 2, 1 ), SH3ADD( 16, 2, 2 ),
+  ROL( 17, 2, 1 ), ROR( 18, 2, 1 ), RORI( 19, 2, 4 ), REV8( 20, 2 ),
+  # Done; infinite loop.
+  JAL( 0, 0x00000 )
+] )
+
+# Expected runtime values for the "Bit-manipulation" program.
+bitmanip_exp = {
+  0:  [ { 'r': 'pc', 'e': 0x00000000 } ],
+  20: [
+        { 'r': 'pc', 'e': 0x00000050 },
+        { 'r': 3,  'e': 23 },
+        { 'r': 4,  'e': 4 },
+        { 'r': 5,  'e': 4 },
+        { 'r': 6,  'e': 0x00000023 },
+        { 'r': 7,  'e': 0xFFFFFFF0 },
+        { 'r': 8,  'e': 0xFFFFFFF0 },
+        { 'r': 9,  'e': 0x00000123 },
+        { 'r': 10, 'e': 0x00000123 },
+        { 'r': 11, 'e': 0xFFFFFFF0 },
+        { 'r': 12, 'e': 0x00000003 },
+        { 'r': 13, 'e': 0x0000012F },
+        { 'r': 14, 'e': 0x0000012C },
+        { 'r': 15, 'e': 0x00000236 },
+        { 'r': 16, 'e': 0x00000A3B },
+        { 'r': 17, 'e': 0x01230000 },
+        { 'r': 18, 'e': 0x01230000 },
+        { 'r': 19, 'e': 0x30000012 },
+        { 'r': 20, 'e': 0x23010000 }
+      ],
+  'end': 21
+}
+
+# "Compressed" program: sum the numbers from 1 to 10 in a loop, store
+# and load the result, and call a function which multiplies it by 4.
+# Some 32-bit instructions straddle two words. (Only for cores with
+# the 'C' extension)
+compressed_rom = rom_img( [
+  C_LI( 8, 0 ), C_LI( 9, 10 ),
+  LUI( 2, 0x20000000 ), C_ADDI16SP( 0x100 ), ADDI( 11, 0, 0x123 ),
+  # Loop: r8 += r9, until r9 = 0.
+  C_ADD( 8, 9 ), C_ADDI( 9, -1 ), C_BNEZ( 9, -2 ),
+  C_SWSP( 8, 8 ), C_LWSP( 10, 8 ), C_JAL( 6 ),
+  SW( 2, 11, 0x000 ), LW( 12, 2, 0x000 ),
+  # Done; infinite loop.
+  C_J( 0 ),
+  # Function: r13 = r10 << 2.
+  C_MV( 13, 10 ), C_SLLI( 13, 2 ), C_JR( 1 )
+] )
+
+# Expected runtime values for the "Compressed" program.
+compressed_exp = {
+  0:  [ { 'r': 'pc', 'e': 0x00000000 } ],
+  5:  [
+        { 'r': 'pc', 'e': 0x0000000E },
+        { 'r': 2,  'e': 0x20000100 },
+        { 'r': 11, 'e': 0x00000123 }
+      ],
+  # The loop runs 10 times, with 3 instructions per iteration.
+  35: [
+        { 'r': 'pc', 'e': 0x00000014 },
+        { 'r': 8, 'e': 55 },
+        { 'r': 9, 'e': 0 }
+      ],
+  38: [
+        { 'r': 'pc', 'e': 0x00000024 },
+        { 'r': 1,  'e': 0x0000001A },
+        { 'r': 10, 'e': 55 }
+      ],
+  43: [
+        { 'r': 'pc', 'e': 0x00000022 },
+        { 'r': 12, 'e': 0x00000123 },
+        { 'r': 13, 'e': 220 }
+      ],
+  'end': 44
+}
+
+# "Accelerator" program: find the CRC-32 of the bytes 8, 7, ..., 1,
+# then check the reference accelerator's other operations, using
+# custom instructions. (Only for cores with an accelerator)
+accel_rom = rom_img( [
+  ADDI( 1, 0, -1 ), ADDI( 2, 0, 8 ),
+  CRC32_B( 1, 1, 2 ), ADDI( 2, 2, -1 ), BNE( 2, 0, -4 ),
+  XORI( 1, 1, -1 ),
+  ADDI( 3, 0, -1 ), SRLI( 3, 3, 1 ), ADDI( 4, 0, 1 ), ADDI( 7, 0, -1 ),
+  SADD( 5, 3, 4 ), SADDU( 6, 7, 4 ),
+  LI( 8, 0x00FF8040 ), PACK565( 9, 8 ),
+  # Done; infinite loop.
+  JAL( 0, 0x00000 )
+] )
+
+# Expected runtime values for the "Accelerator" program.
+accel_exp = {
+  0:  [ { 'r': 'pc', 'e': 0x00000000 } ],
+  # The loop runs 8 times, with 3 instructions per iteration.
+  26: [
+        { 'r': 'pc', 'e': 0x00000014 },
+        { 'r': 2, 'e': 0x00000000 }
+      ],
+  36: [
+        { 'r': 'pc', 'e': 0x0000003C },
+        { 'r': 1, 'e': 0xA5CCED25 },
+        { 'r': 5, 'e': 0x7FFFFFFF },
+        { 'r': 6, 'e': 0xFFFFFFFF },
+        { 'r': 9, 'e': 0x0000FC08 }
+      ],
+  'end': 37
+}
+
+# "Memory-mapped accelerator" program: the same as the "Accelerator"
+# program, but it uses the peripheral at 0x40030000 instead of custom
+# instructions. Each operation takes two stores and a load, so
+# comparing the two programs' runtimes shows how much faster the
+# custom instructions are. (Only for cores with an accelerator)
+accel_mmio_rom = rom_img( [
+  ADDI( 1, 0, -1 ), ADDI( 2, 0, 8 ), LUI( 10, 0x40030000 ),
+  SW( 10, 1, ACCEL_A ), SW( 10, 2, ACCEL_B ),
+  LW( 1, 10, ACCEL_Y + ( 4 * F_CRC32B ) ),
+  ADDI( 2, 2, -1 ), BNE( 2, 0, -8 ),
+  XORI( 1, 1, -1 ),
+  ADDI( 3, 0, -1 ), SRLI( 3, 3, 1 ), ADDI( 4, 0, 1 ), ADDI( 7, 0, -1 ),
+  SW( 10, 3, ACCEL_A ), SW( 10, 4, ACCEL_B ),
+  LW( 5, 10, ACCEL_Y + ( 4 * F_SADD ) ),
+  SW( 10, 7, ACCEL_A ), LW( 6, 10, ACCEL_Y + ( 4 * F_SADDU ) ),
+  LI( 8, 0x00FF8040 ), SW( 10, 8, ACCEL_A ),
+  LW( 9, 10, ACCEL_Y + ( 4 * F_PACK565 ) ),
+  # Done; infinite loop.
+  JAL( 0, 0x00000 )
+] )
+
+# Expected runtime values for the "Memory-mapped accelerator" program.
+accel_mmio_exp = {
+  0:  [ { 'r': 'pc', 'e': 0x00000000 } ],
+  # The loop runs 8 times, with 5 instructions per iteration.
+  43: [
+        { 'r': 'pc', 'e': 0x00000020 },
+        { 'r': 2, 'e': 0x00000000 }
+      ],
+  57: [
+        { 'r': 'pc', 'e': 0x00000058 },
+        { 'r': 1, 'e': 0xA5CCED25 },
+        { 'r': 5, 'e': 0x7FFFFFFF },
+        { 'r': 6, 'e': 0xFFFFFFFF },
+        { 'r': 9, 'e': 0x0000FC08 }
+      ],
+  'end': 58
+}
+
+# "Mis-aligned access" program: store and load words and halfwords
+# which span two words of RAM, and load some from ROM. (Only for
+# cores which split mis-aligned accesses)
+misalign_rom = rom_img( [
+  LUI( 1, 0x20000000 ), LI( 2, 0x11223344 ),
+  SW( 1, 2, 1 ), LW( 3, 1, 1 ),
+  SW( 1, 2, 6 ), SW( 1, 2, 11 ), SH( 1, 2, 15 ),
+  LW( 4, 1, 6 ), LW( 5, 1, 11 ), LH( 6, 1, 15 ), LHU( 7, 1, 3 ),
+  LW( 8, 1, 2 ), LW( 9, 0, 1 ), LH( 10, 0, 3 ),
+  # Done; infinite loop.
+  JAL( 0, 0x00000 )
+] )
+
+# Expected runtime values for the "Mis-aligned access" program.
+misalign_exp = {
+  0:  [ { 'r': 'pc', 'e': 0x00000000 } ],
+  15: [
+        { 'r': 'pc', 'e': 0x0000003C },
+        { 'r': 3,  'e': 0x11223344 },
+        { 'r': 4,  'e': 0x11223344 },
+        { 'r': 5,  'e': 0x11223344 },
+        { 'r': 6,  'e': 0x00003344 },
+        { 'r': 7,  'e': 0x00001122 },
+        { 'r': 8,  'e': 0x00112233 },
+        { 'r': 9,  'e': 0x37200000 },
+        { 'r': 10, 'e': 0x00003720 },
+        { 'r': 'RAM0',  'e': 0x22334400 },
+        { 'r': 'RAM4',  'e': 0x33440011 },
+        { 'r': 'RAM8',  'e': 0x44001122 },
+        { 'r': 'RAM12', 'e': 0x44112233 },
+        { 'r': 'RAM16', 'e': 0x00000033 }
+      ],
+  'end': 16
+}
+
+# "Run from ITCM" program: copy a short loop into the tightly-coupled
+# instruction memory, run it, and jump back to ROM. (Only for cores
+# which have an ITCM) The loop should run at the same speed whether
+# the ROM is on-chip or in SPI Flash.
+itcm_rom = rom_img( [
+  # Load the starting address of the ITCM into r1.
+  LI( 1, 0x10000000 ),
+  # Copy the loop into the ITCM.
+  LI( 3, LITTLE_END( ADD( 5, 5, 6 ) ) ), SW( 1, 3, 0x000 ),
+  LI( 3, LITTLE_END( ADDI( 6, 6, -1 ) ) ), SW( 1, 3, 0x004 ),
+  LI( 3, LITTLE_END( BNE( 6, 0, -4 ) ) ), SW( 1, 3, 0x008 ),
+  LI( 3, LITTLE_END( JALR( 0, 4, 0x000 ) ) ), SW( 1, 3, 0x00C ),
+  # Make sure that the stores are visible to instruction fetches.
+  FENCE_I(),
+  # Run the loop 16 times.
+  ADDI( 6, 0, 0x010 ),
+  JALR( 4, 1, 0x000 ),
+  # (This is where the program should jump back to.)
+  # The ITCM can also be read from the data bus.
+  LW( 7, 1, 0x004 ),
+  # Done; infinite loop.
+  JAL( 0, 0x00000 )
+] )
+
+# Expected runtime values for the "Run from ITCM" program.
+itcm_exp = {
+  0:  [ { 'r': 'pc', 'e': 0x00000000 } ],
+  # The next 17 instructions copy the loop, set r6, and jump to it.
+  17: [
+        { 'r': 'pc', 'e': 0x10000000 },
+        { 'r': 4, 'e': 0x00000044 },
+        { 'r': 6, 'e': 0x00000010 }
+      ],
+  # The loop runs 16 times, with 3 instructions per iteration.
+  65: [
+        { 'r': 'pc', 'e': 0x1000000C },
+        { 'r': 5, 'e': 136 },
+        { 'r': 6, 'e': 0x00000000 }
+      ],
+  # The next instruction should jump back to ROM address space.
+  66: [ { 'r': 'pc', 'e': 0x00000044 } ],
+  # The next instruction should read a word back from the ITCM.
+  67: [
+        { 'r': 'pc', 'e': 0x00000048 },
+        { 'r': 7, 'e': LITTLE_END( ADDI( 6, 6, -1 ) ) }
+      ],
+  'end': 68
+}
+
+# "Atomic operations" program: check that 'SC.W' only succeeds while
+# the 'LR.W' reservation is valid, and that every AMO returns the old
+# word and writes the right result to RAM. (Only for cores which
+# implement the 'A' extension)
+amo_rom = rom_img( [
+  LUI( 1, 0x20000000 ), LI( 2, 5 ), SW( 1, 2, 0x000 ),
+  # 'LR.W' / 'SC.W' pair which succeeds, then one without a
+  # reservation and one whose reservation was cancelled by a store.
+  LR_W( 3, 1 ), ADDI( 3, 3, 1 ), SC_W( 4, 1, 3 ), SC_W( 5, 1, 3 ),
+  LR_W( 6, 1 ), SW( 1, 0, 0x000 ), SC_W( 7, 1, 3 ),
+  # Every AMO, on the next word of RAM.
+  ADDI( 8, 1, 4 ), LI( 2, 0x0F0F00FF ), SW( 8, 2, 0x000 ),
+  AMOSWAP_W( 9, 8, 3 ), AMOADD_W( 10, 8, 3 ),
+  LI( 2, 0x000000F0 ), AMOXOR_W( 11, 8, 2 ),
+  AMOOR_W( 12, 8, 3 ), AMOAND_W( 13, 8, 2 ),
+  ADDI( 2, 0, -1 ), AMOMIN_W( 14, 8, 2 ), AMOMAX_W( 15, 8, 3 ),
+  AMOMINU_W( 16, 8, 2 ), AMOMAXU_W( 17, 8, 2 ),
+  # 'SC.W' of x0, and an AMO which discards the old word.
+  LR_W( 18, 8 ), SC_W( 19, 8, 0 ), AMOADD_W( 0, 8, 3 ),
+  LW( 20, 8, 0x000 ),
+  # Done; infinite loop.
+  JAL( 0, 0x00000 )
+] )
+
+# Expected runtime values for the "Atomic operations" program.
+amo_exp = {
+  0:  [ { 'r': 'pc', 'e': 0x00000000 } ],
+  # The first 11 instructions test 'LR.W' / 'SC.W'.
+  11: [
+        { 'r': 'pc', 'e': 0x0000002C },
+        { 'r': 3, 'e': 6 },
+        { 'r': 4, 'e': 0 },
+        { 'r': 5, 'e': 1 },
+        { 'r': 6, 'e': 6 },
+        { 'r': 7, 'e': 1 },
+        { 'r': 'RAM0', 'e': 0x00000000 }
+      ],
+  # The next 20 instructions test the AMOs.
+  31: [
+        { 'r': 'pc', 'e': 0x0000007C },
+        { 'r': 9,  'e': 0x0F0F00FF },
+        { 'r': 10, 'e': 0x00000006 },
+        { 'r': 11, 'e': 0x0000000C },
+        { 'r': 12, 'e': 0x000000FC },
+        { 'r': 13, 'e': 0x000000FE },
+        { 'r': 14, 'e': 0x000000F0 },
+        { 'r': 15, 'e': 0xFFFFFFFF },
+        { 'r': 16, 'e': 0x00000006 },
+        { 'r': 17, 'e': 0x00000006 },
+        { 'r': 18, 'e': 0xFFFFFFFF },
+        { 'r': 19, 'e': 0x00000000 },
+        { 'r': 20, 'e': 0x00000006 },
+        { 'r': 'RAM4', 'e': 0x00000006 }
+      ],
+  'end': 32
+}
+
+# "Trap handler" programs: the main code sets up a trap handler at
+# 0x40, puts known values in r5-r7, and runs 'ECALL' 4 times. The
+# handler skips the 'ECALL', and counts the traps in RAM. One version
+# of the handler saves and restores the registers that it uses on a
+# stack whose address is kept in 'MSCRATCH'; the other one doesn't,
+# so it only works on cores with a shadow register bank.
+trap_main = [
+  # Set the trap handler address, and the handler's stack pointer.
+  ADDI( 1, 0, 0x040 ), CSRRW( 0, CSRA_MTVEC, 1 ),
+  LI( 2, 0x20000100 ), CSRRW( 0, CSRA_MSCRATCH, 2 ),
+  # Values which the handler should not change.
+  ADDI( 5, 0, 5 ), ADDI( 6, 0, 6 ), ADDI( 7, 0, 7 ),
+  # Trigger 4 traps.
+  ADDI( 8, 0, 4 ),
+  ECALL(), ADDI( 8, 8, -1 ), BNE( 8, 0, -4 ),
+  # Done; infinite loop.
+  JAL( 0, 0x00000 ),
+  NOP(), NOP(), NOP()
+]
+trap_save_rom = rom_img( trap_main + [
+  # Swap the stack pointer into r2, and save r5-r7.
+  CSRRW( 2, CSRA_MSCRATCH, 2 ),
+  SW( 2, 5, 0x000 ), SW( 2, 6, 0x004 ), SW( 2, 7, 0x008 ),
+  # Return to the instruction after the 'ECALL'.
+  CSRRS( 5, CSRA_MEPC, 0 ), ADDI( 5, 5, 4 ), CSRRW( 0, CSRA_MEPC, 5 ),
+  # Count the trap.
+  LUI( 6, 0x20000000 ), LW( 7, 6, 0x000 ), ADDI( 7, 7, 1 ),
+  SW( 6, 7, 0x000 ),
+  # Restore r5-r7 and the stack pointer.
+  LW( 5, 2, 0x000 ), LW( 6, 2, 0x004 ), LW( 7, 2, 0x008 ),
+  CSRRW( 2, CSRA_MSCRATCH, 2 ),
+  MRET()
+] )
+trap_shadow_rom = rom_img( trap_main + [
+  # Return to the instruction after the 'ECALL'.
+  CSRRS( 5, CSRA_MEPC, 0 ), ADDI( 5, 5, 4 ), CSRRW( 0, CSRA_MEPC, 5 ),
+  # Count the trap.
+  LUI( 6, 0x20000000 ), LW( 7, 6, 0x000 ), ADDI( 7, 7, 1 ),
+  SW( 6, 7, 0x000 ),
+  MRET()
+] )
+
+# Expected runtime values for the "Trap handler" programs.
+trap_save_exp = {
+  0:  [ { 'r': 'pc', 'e': 0x00000000 } ],
+  # The first 9 instructions set up the handler, and each trap
+  # takes the 'ECALL', 16 handler instructions, and 2 loop ones.
+  86: [
+        { 'r': 'pc', 'e': 0x00000030 },
+        { 'r': 5, 'e': 5 },
+        { 'r': 6, 'e': 6 },
+        { 'r': 7, 'e': 7 },
+        { 'r': 8, 'e': 0 },
+        { 'r': 'RAM0', 'e': 4 }
+      ],
+  'end': 87
+}
+trap_shadow_exp = {
+  0:  [ { 'r': 'pc', 'e': 0x00000000 } ],
+  # With the shadow bank, each trap takes 8 handler instructions.
+  # The handler's registers are still in the shadow bank. (r32-r63)
+  54: [
+        { 'r': 'pc', 'e': 0x00000030 },
+        { 'r': 5, 'e': 5 },
+        { 'r': 6, 'e': 6 },
+        { 'r': 7, 'e': 7 },
+        { 'r': 8, 'e': 0 },
+        { 'r': 37, 'e': 0x00000028 },
+        { 'r': 38, 'e': 0x20000000 },
+        { 'r': 39, 'e': 4 },
+        { 'r': 'RAM0', 'e': 4 }
+      ],
+  'end': 55
+}
+
+# "Register bank" program: put a different value in every register,
+# then trap to a handler at 0x100 which overwrites all of them and
+# returns. Only cores with a shadow register bank get the original
+# values back in the main registers afterwards.
+trap_bank_rom = rom_img( [
+  ADDI( 1, 0, 0x100 ), CSRRW( 0, CSRA_MTVEC, 1 ) ] +
+  [ ADDI( i, 0, 0x100 + i ) for i in range( 1, 32 ) ] + [
+  ECALL(),
+  # Done; infinite loop.
+  JAL( 0, 0x00000 ) ] +
+  [ NOP() ] * 29 + [
+  # Trap handler: return to the instruction after the 'ECALL', and
+  # overwrite every register.
+  CSRRS( 1, CSRA_MEPC, 0 ), ADDI( 1, 1, 4 ), CSRRW( 0, CSRA_MEPC, 1 ) ] +
+  [ ADDI( i, 0, -i ) for i in range( 1, 32 ) ] + [
+  MRET()
+] )
+
+# Expected runtime values for the "Register bank" program.
+trap_bank_exp = {
+  0:  [ { 'r': 'pc', 'e': 0x00000000 } ],
+  # The first 33 instructions set up the handler and the registers.
+  33: [ { 'r': 'pc', 'e': 0x00000084 } ] +
+      [ { 'r': i, 'e': 0x100 + i } for i in range( 1, 32 ) ],
+  # The trap takes the 'ECALL' and 35 handler instructions. The main
+  # registers are unchanged, and the handler's values are in the
+  # shadow bank. (r32-r63)
+  69: [ { 'r': 'pc', 'e': 0x00000088 } ] +
+      [ { 'r': i, 'e': 0x100 + i } for i in range( 1, 32 ) ] +
+      [ { 'r': 32 + i, 'e': ( -i ) & 0xFFFFFFFF }
+        for i in range( 1, 32 ) ],
+  'end': 70
+}
+
+# "Wait for interrupt" program: enable the external interrupt, and
+# run 'WFI' 4 times, counting how many times it wakes up in r5.
+# (Interrupts stay disabled in 'MSTATUS', so no traps are taken)
+wfi_rom = rom_img( [
+  LI( 1, 0x00000800 ), CSRRS( 0, CSRA_MIE, 1 ),
+  ADDI( 5, 0, 0 ), ADDI( 6, 0, 4 ),
+  WFI(), ADDI( 5, 5, 1 ), BNE( 5, 6, -4 ),
+  # Read the 'MIE' CSR back.
+  CSRRS( 7, CSRA_MIE, 0 ),
+  # Done; infinite loop.
+  JAL( 0, 0x00000 )
+] )
+
+# Expected runtime values for the "Wait for interrupt" program.
+wfi_exp = {
+  0:  [ { 'r': 'pc', 'e': 0x00000000 } ],
+  # 5 setup instructions, 4 loops of 3, and the 'MIE' read.
+  18: [
+        { 'r': 'pc', 'e': 0x00000024 },
+        { 'r': 5, 'e': 4 },
+        { 'r': 7, 'e': 0x00000800 }
+      ],
+  'end': 19
+}
+
+# "Performance counters" program: check that 'MCOUNTINHIBIT' stops
+# the counters, that 'MCYCLE' carries into 'MCYCLEH', and count taken
+# branches, loads, stores, and traps with the event counters.
+counters_rom = rom_img( [
+  # Stop every counter except 'MINSTRET', and check that 'MCYCLE'
+  # does not change.
+  ADDI( 7, 0, 0x079 ), CSRRW( 0, CSRA_MCOUNTINHIBIT, 7 ),
+  CSRRS( 2, CSRA_MCYCLE, 0 ), NOP(), CSRRS( 3, CSRA_MCYCLE, 0 ),
+  SUB( 2, 3, 2 ),
+  # Count one cycle from 0xFFFFFFFF, so that 'MCYCLEH' becomes 1.
+  ADDI( 1, 0, -1 ), CSRRW( 0, CSRA_MCYCLE, 1 ),
+  CSRRW( 0, CSRA_MCYCLEH, 0 ),
+  CSRRW( 0, CSRA_MCOUNTINHIBIT, 0 ), CSRRW( 0, CSRA_MCOUNTINHIBIT, 7 ),
+  CSRRS( 17, CSRA_MCYCLEH, 0 ),
+  # Clear the event counters, and select which events they count.
+  CSRRW( 0, CSRA_MHPMCOUNTER3, 0 ), CSRRW( 0, CSRA_MHPMCOUNTER4, 0 ),
+  CSRRW( 0, CSRA_MHPMCOUNTER5, 0 ), CSRRW( 0, CSRA_MHPMCOUNTER6, 0 ),
+  ADDI( 1, 0, HPM_BRANCH ), CSRRW( 0, CSRA_MHPMEVENT3, 1 ),
+  ADDI( 1, 0, HPM_LOAD ), CSRRW( 0, CSRA_MHPMEVENT4, 1 ),
+  ADDI( 1, 0, HPM_STORE ), CSRRW( 0, CSRA_MHPMEVENT5, 1 ),
+  ADDI( 1, 0, HPM_TRAP ), CSRRW( 0, CSRA_MHPMEVENT6, 1 ),
+  ADDI( 1, 0, 0x0B0 ), CSRRW( 0, CSRA_MTVEC, 1 ),
+  # Start counting: 3 stores, 3 loads, 2 taken branches, and a trap.
+  LUI( 4, 0x20000000 ), ADDI( 5, 0, 3 ),
+  CSRRW( 0, CSRA_MCOUNTINHIBIT, 0 ), CSRRS( 15, CSRA_MCYCLE, 0 ),
+  SW( 4, 5, 0x000 ), LW( 6, 4, 0x000 ), ADDI( 5, 5, -1 ),
+  BNE( 5, 0, -6 ),
+  ECALL(),
+  # Stop counting, and read the counters.
+  CSRRS( 16, CSRA_MCYCLE, 0 ), CSRRW( 0, CSRA_MCOUNTINHIBIT, 7 ),
+  SLTU( 15, 15, 16 ),
+  CSRRS( 8, CSRA_MHPMCOUNTER3, 0 ), CSRRS( 9, CSRA_MHPMCOUNTER4, 0 ),
+  CSRRS( 10, CSRA_MHPMCOUNTER5, 0 ), CSRRS( 11, CSRA_MHPMCOUNTER6, 0 ),
+  # Done; infinite loop.
+  JAL( 0, 0x00000 ),
+  # Trap handler at 0xB0: skip the 'ECALL'.
+  NOP(),
+  CSRRS( 14, CSRA_MEPC, 0 ), ADDI( 14, 14, 4 ),
+  CSRRW( 0, CSRA_MEPC, 14 ), MRET()
+] )
+
+# Expected runtime values for the "Performance counters" program.
+counters_exp = {
+  0:  [ { 'r': 'pc', 'e': 0x00000000 } ],
+  # 38 setup / readout instructions, 3 loops of 4, and the handler.
+  54: [
+        { 'r': 'pc', 'e': 0x000000A8 },
+        { 'r': 2,  'e': 0 },
+        { 'r': 17, 'e': 1 },
+        { 'r': 8,  'e': 2 },
+        { 'r': 9,  'e': 3 },
+        { 'r': 10, 'e': 3 },
+        { 'r': 11, 'e': 1 },
+        { 'r': 15, 'e': 1 }
+      ],
+  'end': 55
+}
+
+# "Mis-aligned jump" program: take a jump, an indirect jump, and a
+# branch to addresses which are not word-aligned. Each one traps, and
+# the handler returns to the following instruction, which reads the
+# return address from 'MEPC' and the jump's target from 'MTVAL'.
+jump_trap_rom = rom_img( [
+  ADDI( 1, 0, 0x040 ), CSRRW( 0, CSRA_MTVEC, 1 ),
+  JAL( 0, 0x005 ),
+  CSRRS( 6, CSRA_MEPC, 0 ), CSRRS( 7, CSRA_MTVAL, 0 ),
+  ADDI( 1, 0, 0x022 ), JALR( 0, 1, 0 ),
+  CSRRS( 8, CSRA_MEPC, 0 ), CSRRS( 9, CSRA_MTVAL, 0 ),
+  BEQ( 0, 0, 0x005 ),
+  CSRRS( 12, CSRA_MEPC, 0 ), CSRRS( 13, CSRA_MTVAL, 0 ),
+  # Done; infinite loop.
+  JAL( 0, 0x00000 ), NOP(), NOP(), NOP(),
+  # Trap handler: skip the jump which caused the trap.
+  CSRRS( 3, CSRA_MEPC, 0 ), ADDI( 3, 3, 4 ), CSRRW( 0, CSRA_MEPC, 3 ),
+  MRET()
+] )
+
+# Expected runtime values for the "Mis-aligned jump" program.
+jump_trap_exp = {
+  0:  [ { 'r': 'pc', 'e': 0x00000000 } ],
+  # 12 main instructions, and 3 traps which run 4 handler instructions.
+  # ('MEPC' holds each jump's address plus 4 when it is read back)
+  24: [
+        { 'r': 'pc', 'e': 0x00000030 },
+        { 'r': 6,  'e': 0x0000000C },
+        { 'r': 7,  'e': 0x00000012 },
+        { 'r': 8,  'e': 0x0000001C },
+        { 'r': 9,  'e': 0x00000022 },
+        { 'r': 12, 'e': 0x00000028 },
+        { 'r': 13, 'e': 0x0000002E }
+      ],
+  'end': 25
+}
+
+# "Parallel sum" program for multi-hart systems: sum the numbers from
+# 1 to 'n', with each hart adding every N'th number and storing its
+# partial sum at 0x20000040 + ( 4 * hart ID ). All harts start at
+# address 0; hart 0 starts the others by writing the address of the
+# shared code to their words in the 'boot mailbox' at 0x20000000.
+# (The program depends on how many harts there are, so this
+#  method generates it)
+def smp_rom( harts, n ):
+  # Address of the code which all harts run.
+  entry = ( 11 + ( harts - 1 ) ) * 4
+  return rom_img( [
+    # Read the hart ID into r1. Hart 0 skips the mailbox loop.
+    CSRRS( 1, CSRA_MHARTID, 0 ),
+    BEQ( 1, 0, 14 ),
+    # Other harts wait for a start address in their mailbox.
+    SLLI( 2, 1, 2 ), LUI( 3, 0x20000000 ), ADD( 2, 2, 3 ),
+    LW( 4, 2, 0x000 ), BEQ( 4, 0, -2 ),
+    JALR( 0, 4, 0x000 ),
+    # Hart 0 writes the start address to the other harts' mailboxes.
+    LUI( 3, 0x20000000 ), LI( 4, entry ),
+    tuple( SW( 3, 4, i * 4 ) for i in range( 1, harts ) ),
+    # Every hart: r5 = sum, r6 = next number, r7 = limit.
+    ADDI( 5, 0, 0x000 ), ADDI( 6, 1, 1 ), ADDI( 7, 0, n + 1 ),
+    ADD( 5, 5, 6 ), ADDI( 6, 6, harts ), BLT( 6, 7, -4 ),
+    # Store the partial sum.
+    LUI( 3, 0x20000000 ), SLLI( 2, 1, 2 ), ADD( 2, 2, 3 ),
+    SW( 2, 5, 0x040 ),
+    # Done; infinite loop.
+    JAL( 0, 0x00000 )
+  ] )
+
+# "Atomic counter" program for multi-hart systems: every hart adds 1
+# to the word at 0x20000040 'n' times with 'AMOADD.W', and to the word
+# at 0x20000044 'n' times with an 'LR.W' / 'SC.W' retry loop. Neither
+# counter should lose any increments. (All harts run the same code,
+# so they don't need to wait for hart 0)
+def amo_smp_rom( n ):
+  return rom_img( [
+    LUI( 1, 0x20000000 ), ADDI( 4, 1, 0x040 ), ADDI( 5, 1, 0x044 ),
+    ADDI( 2, 0, n ), ADDI( 3, 0, 1 ),
+    AMOADD_W( 0, 4, 3 ),
+    LR_W( 6, 5 ), ADDI( 6, 6, 1 ), SC_W( 7, 5, 6 ), BNE( 7, 0, -6 ),
+    ADDI( 2, 2, -1 ), BNE( 2, 0, -12 ),
+    # Done; infinite loop.
+    JAL( 0, 0x00000 )
+  ] )
+
 loop_test    = [ 'inifinite loop test', 'cpu_loop',
                  loop_rom, [], loop_exp ]
 ram_pc_test  = [ 'run from RAM test', 'cpu_ram',
                  ram_rom, [], ram_exp ]
+fencei_test  = [ 'self-modifying code test', 'cpu_fencei',
+                 fencei_rom, [], fencei_exp ]
+cache_test   = [ 'cached loop test', 'cpu_cache',
+                 cache_rom, [], cache_exp ]
+load_test    = [ 'load latency test', 'cpu_load',
+                 load_rom, [], load_exp ]
+muldiv_test  = [ 'multiply / divide test', 'cpu_muldiv',
+                 muldiv_rom, [], muldiv_exp ]
+bitmanip_test = [ 'bit-manipulation test', 'cpu_bitmanip',
+                  bitmanip_rom, [], bitmanip_exp ]
+compressed_test = [ 'compressed instruction test', 'cpu_compressed',
+                    compressed_rom, [], compressed_exp ]
+accel_insn_test = [ 'custom instruction accelerator test', 'cpu_accel',
+                    accel_rom, [], accel_exp ]
+accel_mmio_test = [ 'memory-mapped accelerator test', 'cpu_accel_mmio',
+                    accel_mmio_rom, [], accel_mmio_exp ]
+misalign_test = [ 'mis-aligned access test', 'cpu_misalign',
+                  misalign_rom, [], misalign_exp ]
+itcm_test    = [ 'run from ITCM test', 'cpu_itcm',
+                 itcm_rom, [], itcm_exp ]
+amo_test     = [ 'atomic operations test', 'cpu_amo',
+                 amo_rom, [], amo_exp ]
+wfi_test     = [ 'wait for interrupt test', 'cpu_wfi',
+                 wfi_rom, [], wfi_exp ]
+counters_test = [ 'performance counters test', 'cpu_counters',
+                  counters_rom, [], counters_exp ]
+jump_trap_test = [ 'mis-aligned jump test', 'cpu_jump_trap',
+                  jump_trap_rom, [], jump_trap_exp ]
+trap_save_test = [ 'trap handler test', 'cpu_trap_save',
+                   trap_save_rom, [], trap_save_exp ]
+trap_shadow_test = [ 'shadow register trap handler test',
+                     'cpu_trap_shadow',
+                     trap_shadow_rom, [], trap_shadow_exp ]
+trap_bank_test = [ 'shadow register bank test', 'cpu_trap_bank',
+                   trap_bank_rom, [], trap_bank_exp ]
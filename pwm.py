@@ -21,9 +21,10 @@ class PWM( Elaboratable, Interface ):
     # Initialize wishbone bus interface for peripheral registers.
     # This seems sort of pointless with only one register, but
     # it lets the peripheral be added to the wider memory map.
-    Interface.__init__( self, addr_width = 1, data_width = 32 )
-    self.memory_map = MemoryMap( addr_width = self.addr_width,
-                                 data_width = self.data_width,
+    Interface.__init__( self, addr_width = 1, data_width = 32,
+                        granularity = 8 )
+    self.memory_map = MemoryMap( addr_width = self.addr_width + 2,
+                                 data_width = self.granularity,
                                  alignment = 0 )
     # Peripheral signals. Use 8 bits to allow duty cycles
     # to be set with a granularity of ~0.4%
@@ -55,7 +56,7 @@ class PWM( Elaboratable, Interface ):
     with m.If( self.adr == 0 ):
       # The "compare" value is located in the register's 8 LSbits.
       m.d.comb += self.dat_r.eq( self.compare )
-      with m.If( self.we & self.cyc ):
+      with m.If( self.we & self.cyc & self.sel[ 0 ] ):
         m.d.sync += self.compare.eq( self.dat_w[ :8 ] )
 
     return m
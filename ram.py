@@ -10,42 +10,56 @@ from isa import *
 # RAM module: #
 ###############
 
-# Data input width definitions.
-RAM_DW_8  = 0
-RAM_DW_16 = 1
-RAM_DW_32 = 2
-
 class RAM( Elaboratable ):
   def __init__( self, size_words ):
     # Record size.
     self.size = ( size_words * 4 )
-    # Width of data input.
-    self.dw   = Signal( 3, reset = 0b000 )
     # Data storage.
     self.data = Memory( width = 32, depth = size_words,
       init = ( 0x000000 for i in range( size_words ) ) )
-    # Read and write ports.
+    # Read and write ports. The write port has one enable bit per
+    # byte, so that each of the bus' 'sel' lanes can be written
+    # without touching the rest of the word.
     self.r = self.data.read_port()
-    self.w = self.data.write_port()
+    self.w = self.data.write_port( granularity = 8 )
 
-    # Initialize Wishbone bus arbiter.
-    self.arb = Arbiter( addr_width = ceil( log2( self.size + 1 ) ),
-                        data_width = 32 )
+    # Initialize Wishbone bus arbiter. Bus addresses are in words,
+    # and 'sel' selects which bytes of the word are accessed.
+    self.arb = Arbiter( addr_width = ceil( log2( size_words + 1 ) ),
+                        data_width = 32,
+                        granularity = 8 )
     self.arb.bus.memory_map = MemoryMap(
-      addr_width = self.arb.bus.addr_width,
-      data_width = self.arb.bus.data_width,
+      addr_width = self.arb.bus.addr_width + 2,
+      data_width = self.arb.bus.granularity,
       alignment = 0 )
+    # Optional 64-bit bus. (See 'wide_bus')
+    self.wbus = None
 
   def new_bus( self ):
     # Initialize a new Wishbone bus interface.
     bus = Interface( addr_width = self.arb.bus.addr_width,
-                     data_width = self.arb.bus.data_width )
-    bus.memory_map = MemoryMap( addr_width = bus.addr_width,
-                                data_width = bus.data_width,
+                     data_width = self.arb.bus.data_width,
+                     granularity = self.arb.bus.granularity )
+    bus.memory_map = MemoryMap( addr_width = bus.addr_width + 2,
+                                data_width = bus.granularity,
                                 alignment = 0 )
     self.arb.add( bus )
     return bus
 
+  # Create a 64-bit bus which reads two words per transaction, for
+  # 64-bit instruction fetches. It has its own pair of read ports
+  # instead of sharing the arbiter's, so it never waits for the
+  # other buses. (Only one 64-bit bus can be created)
+  def wide_bus( self ):
+    self.wr = [ self.data.read_port(), self.data.read_port() ]
+    self.wbus = Interface( addr_width = self.arb.bus.addr_width - 1,
+                           data_width = 64,
+                           granularity = 8 )
+    self.wbus.memory_map = MemoryMap( addr_width = self.wbus.addr_width + 3,
+                                      data_width = self.wbus.granularity,
+                                      alignment = 0 )
+    return self.wbus
+
   def elaborate( self, platform ):
     # Core RAM module.
     m = Module()
@@ -53,57 +67,36 @@ class RAM( Elaboratable ):
     m.submodules.w = self.w
     m.submodules.arb = self.arb
 
-    # Ack two cycles after activation, for memory port access and
-    # synchronous read-out (to prevent combinatorial loops).
-    rws = Signal( 1, reset = 0 )
-    m.d.sync += rws.eq( self.arb.bus.cyc )
-    m.d.sync += self.arb.bus.ack.eq( self.arb.bus.cyc & rws )
+    # Ack one cycle after activation, once the read port's
+    # registered output holds the requested word. If 'cyc' stays
+    # asserted, the word at the new address is acked on the
+    # following cycle, so reads can complete once per cycle.
+    m.d.sync += self.arb.bus.ack.eq( self.arb.bus.cyc )
     m.d.comb += [
       # Set the RAM port addresses.
-      self.r.addr.eq( self.arb.bus.adr[ 2: ] ),
-      self.w.addr.eq( self.arb.bus.adr[ 2: ] ),
-      # Set the 'write enable' flag once the reads are valid.
-      self.w.en.eq( self.arb.bus.we )
+      self.r.addr.eq( self.arb.bus.adr ),
+      self.w.addr.eq( self.arb.bus.adr ),
+      # Read / Write logic. The read port's output is registered, so
+      # read data can be driven combinatorially without forming loops.
+      # Writes only update the bytes whose 'sel' lanes are set, so
+      # byte and halfword stores do not need to read the word first.
+      self.arb.bus.dat_r.eq( self.r.data ),
+      self.w.data.eq( self.arb.bus.dat_w ),
+      self.w.en.eq( Mux( self.arb.bus.cyc & self.arb.bus.we,
+                         self.arb.bus.sel, 0 ) )
     ]
 
-    # Read / Write logic: synchronous to avoid combinatorial loops.
-    m.d.comb += self.w.data.eq( self.r.data )
-    with m.Switch( self.arb.bus.adr[ :2 ] ):
-      with m.Case( 0b00 ):
-        m.d.sync += self.arb.bus.dat_r.eq( self.r.data )
-        with m.Switch( self.dw ):
-          with m.Case( RAM_DW_8 ):
-            m.d.comb += self.w.data.bit_select( 0, 8 ).eq(
-              self.arb.bus.dat_w[ :8 ] )
-          with m.Case( RAM_DW_16 ):
-            m.d.comb += self.w.data.bit_select( 0, 16 ).eq(
-              self.arb.bus.dat_w[ :16 ] )
-          with m.Case():
-            m.d.comb += self.w.data.eq( self.arb.bus.dat_w )
-      with m.Case( 0b01 ):
-        m.d.sync += self.arb.bus.dat_r.eq( self.r.data[ 8 : 32 ] )
-        with m.Switch( self.dw ):
-          with m.Case( RAM_DW_8 ):
-            m.d.comb += self.w.data.bit_select( 8, 8 ).eq(
-              self.arb.bus.dat_w[ :8 ] )
-          with m.Case( RAM_DW_16 ):
-            m.d.comb += self.w.data.bit_select( 8, 16 ).eq(
-              self.arb.bus.dat_w[ :16 ] )
-      with m.Case( 0b10 ):
-        m.d.sync += self.arb.bus.dat_r.eq( self.r.data[ 16 : 32 ] )
-        with m.Switch( self.dw ):
-          with m.Case( RAM_DW_8 ):
-            m.d.comb += self.w.data.bit_select( 16, 8 ).eq(
-              self.arb.bus.dat_w[ :8 ] )
-          with m.Case( RAM_DW_16 ):
-            m.d.comb += self.w.data.bit_select( 16, 16 ).eq(
-              self.arb.bus.dat_w[ :16 ] )
-      with m.Case( 0b11 ):
-        m.d.sync += self.arb.bus.dat_r.eq( self.r.data[ 24 : 32 ] )
-        with m.Switch( self.dw ):
-          with m.Case( RAM_DW_8 ):
-            m.d.comb += self.w.data.bit_select( 24, 8 ).eq(
-              self.arb.bus.dat_w[ :8 ] )
+    # 64-bit bus, if there is one: read both words of the requested
+    # doubleword, and 'ack' one cycle later like the other buses.
+    if self.wbus is not None:
+      m.submodules.wr0 = self.wr[ 0 ]
+      m.submodules.wr1 = self.wr[ 1 ]
+      m.d.sync += self.wbus.ack.eq( self.wbus.cyc )
+      m.d.comb += [
+        self.wr[ 0 ].addr.eq( Cat( Repl( 0, 1 ), self.wbus.adr ) ),
+        self.wr[ 1 ].addr.eq( Cat( Repl( 1, 1 ), self.wbus.adr ) ),
+        self.wbus.dat_r.eq( Cat( self.wr[ 0 ].data, self.wr[ 1 ].data ) )
+      ]
 
     # End of RAM module definition.
     return m
@@ -116,13 +109,14 @@ p = 0
 f = 0
 
 # Perform an individual RAM write unit test.
-def ram_write_ut( ram, address, data, dw, success ):
+# ('address' is a word address, and 'sel' selects the bytes to write)
+def ram_write_ut( ram, address, data, sel, success ):
   global p, f
-  # Set addres, 'din', and 'wen' signals.
+  # Set addres, 'din', 'sel', and 'wen' signals.
   yield ram.arb.bus.adr.eq( address )
   yield ram.arb.bus.dat_w.eq( data )
+  yield ram.arb.bus.sel.eq( sel )
   yield ram.arb.bus.we.eq( 1 )
-  yield ram.dw.eq( dw )
   # Wait three ticks, and un-set the 'wen' bit.
   yield Tick()
   yield Tick()
@@ -175,6 +169,25 @@ def ram_read_ut( ram, address, expected ):
     print( "\033[32mPASS:\033[0m RAM[ 0x%08X ] == 0x%08X"
            %( address, expected ) )
 
+# Perform an individual 64-bit bus read test.
+def ram_wide_ut( ram, address, expected ):
+  global p, f
+  yield ram.wbus.adr.eq( address )
+  yield ram.wbus.cyc.eq( 1 )
+  yield Tick()
+  yield Settle()
+  ack = yield ram.wbus.ack
+  actual = yield ram.wbus.dat_r
+  yield ram.wbus.cyc.eq( 0 )
+  if ( expected != actual ) or ( ack != 1 ):
+    f += 1
+    print( "\033[31mFAIL:\033[0m RAM64[ 0x%08X ] == 0x%016X "
+           "(got: 0x%016X, ack: %d)"%( address, expected, actual, ack ) )
+  else:
+    p += 1
+    print( "\033[32mPASS:\033[0m RAM64[ 0x%08X ] == 0x%016X"
+           %( address, expected ) )
+
 # Top-level RAM test method.
 def ram_test( ram ):
   global p, f
@@ -188,65 +201,73 @@ def ram_test( ram ):
   yield Settle()
 
   # Test writing data to RAM.
-  yield from ram_write_ut( ram, 0x00, 0x01234567, RAM_DW_32, 1 )
-  yield from ram_write_ut( ram, 0x0C, 0x89ABCDEF, RAM_DW_32, 1 )
+  yield from ram_write_ut( ram, 0x00, 0x01234567, 0b1111, 1 )
+  yield from ram_write_ut( ram, 0x03, 0x89ABCDEF, 0b1111, 1 )
   # Test reading data back out of RAM.
   yield from ram_read_ut( ram, 0x00, 0x01234567 )
-  yield from ram_read_ut( ram, 0x04, 0x00000000 )
-  yield from ram_read_ut( ram, 0x0C, 0x89ABCDEF )
-  # Test byte-aligned and halfword-aligend reads.
-  yield from ram_read_ut( ram, 0x01, 0x00012345 )
-  yield from ram_read_ut( ram, 0x02, 0x00000123 )
-  yield from ram_read_ut( ram, 0x03, 0x00000001 )
-  yield from ram_read_ut( ram, 0x07, 0x00000000 )
-  yield from ram_read_ut( ram, 0x0D, 0x0089ABCD )
-  yield from ram_read_ut( ram, 0x0E, 0x000089AB )
-  yield from ram_read_ut( ram, 0x0F, 0x00000089 )
-  # Test byte-aligned and halfword-aligned writes.
-  yield from ram_write_ut( ram, 0x01, 0xDEADBEEF, RAM_DW_32, 0 )
-  yield from ram_write_ut( ram, 0x02, 0xDEC0FFEE, RAM_DW_32, 0 )
-  yield from ram_write_ut( ram, 0x03, 0xFABFACEE, RAM_DW_32, 0 )
-  yield from ram_write_ut( ram, 0x00, 0xAAAAAAAA, RAM_DW_32, 1 )
-  yield from ram_write_ut( ram, 0x01, 0xDEADBEEF, RAM_DW_8, 0 )
-  yield from ram_read_ut( ram, 0x00, 0xAAAAEFAA )
-  yield from ram_write_ut( ram, 0x00, 0xAAAAAAAA, RAM_DW_32, 1 )
-  yield from ram_write_ut( ram, 0x02, 0xDEC0FFEE, RAM_DW_16, 0 )
-  yield from ram_read_ut( ram, 0x00, 0xFFEEAAAA )
-  yield from ram_write_ut( ram, 0x00, 0xAAAAAAAA, RAM_DW_32, 1 )
-  yield from ram_write_ut( ram, 0x01, 0xDEC0FFEE, RAM_DW_16, 0 )
-  yield from ram_read_ut( ram, 0x00, 0xAAFFEEAA )
-  yield from ram_write_ut( ram, 0x00, 0xAAAAAAAA, RAM_DW_32, 1 )
-  yield from ram_write_ut( ram, 0x03, 0xDEADBEEF, RAM_DW_8, 0 )
-  yield from ram_read_ut( ram, 0x00, 0xEFAAAAAA )
-  yield from ram_write_ut( ram, 0x03, 0xFABFACEE, RAM_DW_32, 0 )
-  # Test byte and halfword writes.
-  yield from ram_write_ut( ram, 0x00, 0x0F0A0B0C, RAM_DW_32, 1 )
-  yield from ram_write_ut( ram, 0x00, 0xDEADBEEF, RAM_DW_8, 0 )
-  yield from ram_read_ut( ram, 0x00, 0x0F0A0BEF )
-  yield from ram_write_ut( ram, 0x60, 0x00000000, RAM_DW_32, 1 )
-  yield from ram_write_ut( ram, 0x10, 0x0000BEEF, RAM_DW_8, 0 )
-  yield from ram_read_ut( ram, 0x10, 0x000000EF )
-  yield from ram_write_ut( ram, 0x20, 0x000000EF, RAM_DW_8, 1 )
-  yield from ram_write_ut( ram, 0x40, 0xDEADBEEF, RAM_DW_16, 0 )
-  yield from ram_read_ut( ram, 0x40, 0x0000BEEF )
-  yield from ram_write_ut( ram, 0x50, 0x0000BEEF, RAM_DW_16, 1 )
-  # Test reading from the last few bytes of RAM.
-  yield from ram_write_ut( ram, ram.size - 4, 0x01234567, RAM_DW_32, 1 )
-  yield from ram_read_ut( ram, ram.size - 4, 0x01234567 )
-  yield from ram_read_ut( ram, ram.size - 3, 0x00012345 )
-  yield from ram_read_ut( ram, ram.size - 2, 0x00000123 )
-  yield from ram_read_ut( ram, ram.size - 1, 0x00000001 )
-  # Test writing to the end of RAM.
-  yield from ram_write_ut( ram, ram.size - 4, 0xABCDEF89, RAM_DW_32, 1 )
-  yield from ram_write_ut( ram, ram.size - 3, 0x00000012, RAM_DW_8, 0 )
-  yield from ram_read_ut( ram, ram.size - 4, 0xABCD1289 )
-  yield from ram_write_ut( ram, ram.size - 4, 0xABCDEF89, RAM_DW_32, 1 )
-  yield from ram_write_ut( ram, ram.size - 3, 0x00003412, RAM_DW_16, 0 )
-  yield from ram_read_ut( ram, ram.size - 4, 0xAB341289 )
-  yield from ram_write_ut( ram, ram.size - 4, 0xABCDEF89, RAM_DW_32, 1 )
-  yield from ram_write_ut( ram, ram.size - 1, 0x00000012, RAM_DW_8, 1 )
-  yield from ram_read_ut( ram, ram.size - 4, 0x12CDEF89 )
-  yield from ram_write_ut( ram, ram.size - 4, 0xABCDEF89, RAM_DW_32, 1 )
+  yield from ram_read_ut( ram, 0x01, 0x00000000 )
+  yield from ram_read_ut( ram, 0x03, 0x89ABCDEF )
+  # Test byte writes, using each of the 'sel' lanes.
+  yield from ram_write_ut( ram, 0x00, 0xAAAAAAAA, 0b1111, 1 )
+  yield from ram_write_ut( ram, 0x00, 0xDEADBEEF, 0b0001, 0 )
+  yield from ram_read_ut( ram, 0x00, 0xAAAAAAEF )
+  yield from ram_write_ut( ram, 0x00, 0xAAAAAAAA, 0b1111, 1 )
+  yield from ram_write_ut( ram, 0x00, 0xDEADBEEF, 0b0010, 0 )
+  yield from ram_read_ut( ram, 0x00, 0xAAAABEAA )
+  yield from ram_write_ut( ram, 0x00, 0xAAAAAAAA, 0b1111, 1 )
+  yield from ram_write_ut( ram, 0x00, 0xDEADBEEF, 0b0100, 0 )
+  yield from ram_read_ut( ram, 0x00, 0xAAADAAAA )
+  yield from ram_write_ut( ram, 0x00, 0xAAAAAAAA, 0b1111, 1 )
+  yield from ram_write_ut( ram, 0x00, 0xDEADBEEF, 0b1000, 0 )
+  yield from ram_read_ut( ram, 0x00, 0xDEAAAAAA )
+  # Test halfword writes, including mis-aligned ones.
+  yield from ram_write_ut( ram, 0x00, 0xAAAAAAAA, 0b1111, 1 )
+  yield from ram_write_ut( ram, 0x00, 0xDEC0FFEE, 0b0011, 0 )
+  yield from ram_read_ut( ram, 0x00, 0xAAAAFFEE )
+  yield from ram_write_ut( ram, 0x00, 0xAAAAAAAA, 0b1111, 1 )
+  yield from ram_write_ut( ram, 0x00, 0xDEC0FFEE, 0b0110, 0 )
+  yield from ram_read_ut( ram, 0x00, 0xAAC0FFAA )
+  yield from ram_write_ut( ram, 0x00, 0xAAAAAAAA, 0b1111, 1 )
+  yield from ram_write_ut( ram, 0x00, 0xDEC0FFEE, 0b1100, 0 )
+  yield from ram_read_ut( ram, 0x00, 0xDEC0AAAA )
+  # Test 3-byte writes. (Used for halves of split mis-aligned words)
+  yield from ram_write_ut( ram, 0x00, 0xAAAAAAAA, 0b1111, 1 )
+  yield from ram_write_ut( ram, 0x00, 0xDEC0FFEE, 0b0111, 0 )
+  yield from ram_read_ut( ram, 0x00, 0xAAC0FFEE )
+  yield from ram_write_ut( ram, 0x00, 0xAAAAAAAA, 0b1111, 1 )
+  yield from ram_write_ut( ram, 0x00, 0xDEC0FFEE, 0b1110, 0 )
+  yield from ram_read_ut( ram, 0x00, 0xDEC0FFAA )
+  # Writes with no 'sel' lanes set should not change anything.
+  yield from ram_write_ut( ram, 0x00, 0xAAAAAAAA, 0b1111, 1 )
+  yield from ram_write_ut( ram, 0x00, 0x01234567, 0b0000, 0 )
+  yield from ram_read_ut( ram, 0x00, 0xAAAAAAAA )
+  # Test byte writes to other words.
+  yield from ram_write_ut( ram, 0x18, 0x00000000, 0b1111, 1 )
+  yield from ram_write_ut( ram, 0x04, 0x0000BEEF, 0b0001, 0 )
+  yield from ram_read_ut( ram, 0x04, 0x000000EF )
+  yield from ram_write_ut( ram, 0x08, 0x000000EF, 0b0001, 1 )
+  yield from ram_write_ut( ram, 0x10, 0xDEADBEEF, 0b0011, 0 )
+  yield from ram_read_ut( ram, 0x10, 0x0000BEEF )
+  yield from ram_write_ut( ram, 0x14, 0x0000BEEF, 0b0011, 1 )
+  # Test reading and writing the last word of RAM.
+  last = ( ram.size // 4 ) - 1
+  yield from ram_write_ut( ram, last, 0x01234567, 0b1111, 1 )
+  yield from ram_read_ut( ram, last, 0x01234567 )
+  yield from ram_write_ut( ram, last, 0xABCDEF89, 0b1111, 1 )
+  yield from ram_write_ut( ram, last, 0x00001200, 0b0010, 0 )
+  yield from ram_read_ut( ram, last, 0xABCD1289 )
+  yield from ram_write_ut( ram, last, 0xABCDEF89, 0b1111, 1 )
+  yield from ram_write_ut( ram, last, 0x00341200, 0b0110, 0 )
+  yield from ram_read_ut( ram, last, 0xAB341289 )
+  yield from ram_write_ut( ram, last, 0xABCDEF89, 0b1111, 1 )
+  yield from ram_write_ut( ram, last, 0x12000000, 0b1000, 0 )
+  yield from ram_read_ut( ram, last, 0x12CDEF89 )
+  yield from ram_write_ut( ram, last, 0xABCDEF89, 0b1111, 1 )
+  # Test reading doublewords from the 64-bit bus, if there is one.
+  if ram.wbus is not None:
+    yield from ram_write_ut( ram, last - 1, 0x01234567, 0b1111, 1 )
+    yield from ram_wide_ut( ram, last // 2, 0xABCDEF8901234567 )
+    yield from ram_wide_ut( ram, 0x04, 0x00000000000000EF )
 
   # Done.
   yield Tick()
@@ -254,8 +275,10 @@ def ram_test( ram ):
 
 # 'main' method to run a basic testbench.
 if __name__ == "__main__":
-  # Instantiate a test RAM module with 128 bytes of data.
+  # Instantiate a test RAM module with 128 bytes of data,
+  # and a 64-bit bus.
   dut = RAM( 32 )
+  dut.wide_bus()
   # Run the RAM tests.
   with Simulator( dut, vcd_file = open( 'ram.vcd', 'w' ) ) as sim:
     def proc():
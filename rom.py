@@ -11,56 +11,97 @@ from isa import *
 ###############
 
 class ROM( Elaboratable ):
-  def __init__( self, data ):
+  # The ROM can return one word per cycle.
+  pipelined = True
+
+  def __init__( self, data, predecode = False ):
     # Data storage.
     self.data = Memory( width = 32, depth = len( data ), init = data )
     # Memory read port.
     self.r = self.data.read_port()
+    # Optional predecoded instruction fields for each word, which
+    # are computed when the ROM image is built. ('pd' is read from
+    # the same address as 'dat_r', and it is valid at the same time.)
+    if predecode:
+      self.pdata = Memory( width = PD_W, depth = len( data ),
+        init = [ PREDECODE( LITTLE_END( w ) ) for w in data ] )
+      self.pr = self.pdata.read_port()
+      self.pd = self.pr.data
+    else:
+      self.pdata = None
+      self.pd = None
     # Record size.
     self.size = len( data ) * 4
-    # Initialize Wishbone bus arbiter.
-    self.arb = Arbiter( addr_width = ceil( log2( self.size + 1 ) ),
-                        data_width = 32 )
+    # Initialize Wishbone bus arbiter. Bus addresses are in words.
+    self.arb = Arbiter( addr_width = ceil( log2( len( data ) + 1 ) ),
+                        data_width = 32,
+                        granularity = 8 )
     self.arb.bus.memory_map = MemoryMap(
-      addr_width = self.arb.bus.addr_width,
-      data_width = self.arb.bus.data_width,
+      addr_width = self.arb.bus.addr_width + 2,
+      data_width = self.arb.bus.granularity,
       alignment = 0 )
+    # Optional 64-bit bus. (See 'wide_bus')
+    self.wbus = None
 
   def new_bus( self ):
     # Initialize a new Wishbone bus interface.
     bus = Interface( addr_width = self.arb.bus.addr_width,
-                     data_width = self.arb.bus.data_width )
-    bus.memory_map = MemoryMap( addr_width = bus.addr_width,
-                                data_width = bus.data_width,
+                     data_width = self.arb.bus.data_width,
+                     granularity = self.arb.bus.granularity )
+    bus.memory_map = MemoryMap( addr_width = bus.addr_width + 2,
+                                data_width = bus.granularity,
                                 alignment = 0 )
     self.arb.add( bus )
     return bus
 
+  # Create a 64-bit bus which reads two words per transaction, for
+  # 64-bit instruction fetches. It has its own pair of read ports
+  # instead of sharing the arbiter's, so it never waits for the
+  # other buses. (Only one 64-bit bus can be created)
+  def wide_bus( self ):
+    self.wr = [ self.data.read_port(), self.data.read_port() ]
+    self.wbus = Interface( addr_width = self.arb.bus.addr_width - 1,
+                           data_width = 64,
+                           granularity = 8 )
+    self.wbus.memory_map = MemoryMap( addr_width = self.wbus.addr_width + 3,
+                                      data_width = self.wbus.granularity,
+                                      alignment = 0 )
+    return self.wbus
+
   def elaborate( self, platform ):
     m = Module()
     m.submodules.arb = self.arb
     m.submodules.r = self.r
+    if self.pdata is not None:
+      m.submodules.pr = self.pr
 
-    # Ack two cycles after activation, for memory port access and
-    # synchronous read-out (to prevent combinatorial loops).
-    rws = Signal( 1, reset = 0 )
-    m.d.sync += [
-      rws.eq( self.arb.bus.cyc ),
-      self.arb.bus.ack.eq( self.arb.bus.cyc & rws )
-    ]
+    # Ack one cycle after activation, once the read port's
+    # registered output holds the requested word. If 'cyc' stays
+    # asserted, the word at the new address is acked on the
+    # following cycle, so reads can complete once per cycle.
+    m.d.sync += self.arb.bus.ack.eq( self.arb.bus.cyc )
 
     # Set read port address (in words).
-    m.d.comb += self.r.addr.eq( self.arb.bus.adr >> 2 )
+    m.d.comb += self.r.addr.eq( self.arb.bus.adr )
+    if self.pdata is not None:
+      m.d.comb += self.pr.addr.eq( self.arb.bus.adr )
     # Set the 'output' value to the requested 'data' array index.
-    # If a read would 'spill over' into an out-of-bounds data byte,
-    # set that byte to 0x00.
-    # Word-aligned reads
-    with m.If( ( self.arb.bus.adr & 0b11 ) == 0b00 ):
-      m.d.sync += self.arb.bus.dat_r.eq( LITTLE_END_L( self.r.data ) )
-    # Un-aligned reads
-    with m.Else():
-      m.d.sync += self.arb.bus.dat_r.eq(
-        LITTLE_END_L( self.r.data << ( ( self.arb.bus.adr & 0b11 ) << 3 ) ) )
+    # (The read port's output is already registered, so this does
+    #  not form a combinatorial loop.)
+    m.d.comb += self.arb.bus.dat_r.eq( LITTLE_END_L( self.r.data ) )
+
+    # 64-bit bus, if there is one: read both words of the requested
+    # doubleword, and 'ack' one cycle later like the other buses.
+    if self.wbus is not None:
+      m.submodules.wr0 = self.wr[ 0 ]
+      m.submodules.wr1 = self.wr[ 1 ]
+      m.d.sync += self.wbus.ack.eq( self.wbus.cyc )
+      m.d.comb += [
+        self.wr[ 0 ].addr.eq( Cat( Repl( 0, 1 ), self.wbus.adr ) ),
+        self.wr[ 1 ].addr.eq( Cat( Repl( 1, 1 ), self.wbus.adr ) ),
+        self.wbus.dat_r.eq( Cat( LITTLE_END_L( self.wr[ 0 ].data ),
+                                 LITTLE_END_L( self.wr[ 1 ].data ) ) )
+      ]
     # End of ROM module definition.
     return m
 
@@ -90,6 +131,42 @@ def rom_read_ut( rom, address, expected ):
     print( "\033[32mPASS:\033[0m ROM[ 0x%08X ] = 0x%08X"
            %( address, expected ) )
 
+# Perform an individual 64-bit bus read test.
+def rom_wide_ut( rom, address, expected ):
+  global p, f
+  yield rom.wbus.adr.eq( address )
+  yield rom.wbus.cyc.eq( 1 )
+  yield Tick()
+  yield Settle()
+  ack = yield rom.wbus.ack
+  actual = yield rom.wbus.dat_r
+  yield rom.wbus.cyc.eq( 0 )
+  if ( expected != actual ) or ( ack != 1 ):
+    f += 1
+    print( "\033[31mFAIL:\033[0m ROM64[ 0x%08X ] = 0x%016X "
+           "(got: 0x%016X, ack: %d)"%( address, expected, actual, ack ) )
+  else:
+    p += 1
+    print( "\033[32mPASS:\033[0m ROM64[ 0x%08X ] = 0x%016X"
+           %( address, expected ) )
+
+# Check the predecoded fields which are read along with a word.
+def rom_pd_ut( rom, address, expected ):
+  global p, f
+  yield rom.arb.bus.adr.eq( address )
+  yield Tick()
+  yield Tick()
+  yield Settle()
+  actual = yield rom.pd
+  if expected != actual:
+    f += 1
+    print( "\033[31mFAIL:\033[0m PD[ 0x%08X ] = 0x%011X (got: 0x%011X)"
+           %( address, expected, actual ) )
+  else:
+    p += 1
+    print( "\033[32mPASS:\033[0m PD[ 0x%08X ] = 0x%011X"
+           %( address, expected ) )
+
 # Top-level ROM test method.
 def rom_test( rom ):
   global p, f
@@ -103,21 +180,28 @@ def rom_test( rom ):
   # Test the ROM's "happy path" (reading valid data).
 
   yield from rom_read_ut( rom, 0x0, LITTLE_END( 0x01234567 ) )
-  yield from rom_read_ut( rom, 0x4, LITTLE_END( 0x89ABCDEF ) )
-  yield from rom_read_ut( rom, 0x8, LITTLE_END( 0x42424242 ) )
-  yield from rom_read_ut( rom, 0xC, LITTLE_END( 0xDEADBEEF ) )
-  # Test byte-aligned and halfword-aligned addresses.
-  yield from rom_read_ut( rom, 0x1, LITTLE_END( 0x23456700 ) )
-  yield from rom_read_ut( rom, 0x2, LITTLE_END( 0x45670000 ) )
-  yield from rom_read_ut( rom, 0x3, LITTLE_END( 0x67000000 ) )
-  yield from rom_read_ut( rom, 0x5, LITTLE_END( 0xABCDEF00 ) )
-  yield from rom_read_ut( rom, 0x6, LITTLE_END( 0xCDEF0000 ) )
-  yield from rom_read_ut( rom, 0x7, LITTLE_END( 0xEF000000 ) )
-  # Test reading the last few bytes of data.
-  yield from rom_read_ut( rom, rom.size - 4, LITTLE_END( 0xDEADBEEF ) )
-  yield from rom_read_ut( rom, rom.size - 3, LITTLE_END( 0xADBEEF00 ) )
-  yield from rom_read_ut( rom, rom.size - 2, LITTLE_END( 0xBEEF0000 ) )
-  yield from rom_read_ut( rom, rom.size - 1, LITTLE_END( 0xEF000000 ) )
+  yield from rom_read_ut( rom, 0x1, LITTLE_END( 0x89ABCDEF ) )
+  yield from rom_read_ut( rom, 0x2, LITTLE_END( 0x42424242 ) )
+  yield from rom_read_ut( rom, 0x3, LITTLE_END( 0xDEADBEEF ) )
+  # Test reading the words out of order.
+  yield from rom_read_ut( rom, 0x2, LITTLE_END( 0x42424242 ) )
+  yield from rom_read_ut( rom, 0x0, LITTLE_END( 0x01234567 ) )
+  # Test reading the last word of data.
+  yield from rom_read_ut( rom, ( rom.size // 4 ) - 1,
+                          LITTLE_END( 0xDEADBEEF ) )
+  # Test predecoded instruction fields, if they are stored.
+  if rom.pd is not None:
+    for i in range( rom.size // 4 ):
+      yield from rom_pd_ut( rom, i,
+                            PREDECODE( LITTLE_END( rom.data.init[ i ] ) ) )
+  # Test reading doublewords from the 64-bit bus, if there is one.
+  # It should return both words one cycle after a request.
+  if rom.wbus is not None:
+    yield rom.arb.bus.cyc.eq( 0 )
+    yield from rom_wide_ut( rom, 0x0, ( LITTLE_END( 0x89ABCDEF ) << 32 ) |
+                                      LITTLE_END( 0x01234567 ) )
+    yield from rom_wide_ut( rom, 0x1, ( LITTLE_END( 0xDEADBEEF ) << 32 ) |
+                                      LITTLE_END( 0x42424242 ) )
 
   # Done.
   yield Tick()
@@ -126,7 +210,11 @@ def rom_test( rom ):
 # 'main' method to run a basic testbench.
 if __name__ == "__main__":
   # Instantiate a test ROM module with 16 bytes of data.
-  dut = ROM( [ 0x01234567, 0x89ABCDEF, 0x42424242, 0xDEADBEEF ] )
+  # Store predecoded instruction fields along with the data, and
+  # add a 64-bit bus.
+  dut = ROM( [ 0x01234567, 0x89ABCDEF, 0x42424242, 0xDEADBEEF ],
+             predecode = True )
+  dut.wide_bus()
   # Run the ROM tests.
   with Simulator( dut, vcd_file = open( 'rom.vcd', 'w' ) ) as sim:
     def proc():
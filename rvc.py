@@ -0,0 +1,290 @@
+from nmigen import *
+from nmigen.back.pysim import *
+
+from isa import *
+
+import sys
+
+##############################################################
+# 'C' extension expander: converts a 16-bit compressed       #
+# instruction into the equivalent 32-bit RV32I instruction,  #
+# so that the rest of the CPU only needs to decode one set   #
+# of instruction formats. Instructions which do not exist in #
+# RV32C (or which need floating-point registers) expand to   #
+# an all-zero word, which the CPU does not execute.          #
+##############################################################
+
+# Helper methods to assemble 32-bit instructions from nMigen values.
+# Immediate values must be wide enough to hold every bit that is
+# used, and register numbers must be 5 bits wide.
+def R_L( op, f, ff, c, a, b ):
+  return Cat( Const( op, 7 ), c, Const( f, 3 ), a, b, Const( ff, 7 ) )
+def I_L( op, f, c, a, i ):
+  return Cat( Const( op, 7 ), c, Const( f, 3 ), a, i[ :12 ] )
+def S_L( op, f, a, b, i ):
+  return Cat( Const( op, 7 ), i[ :5 ], Const( f, 3 ), a, b, i[ 5 : 12 ] )
+def B_L( op, f, a, b, i ):
+  return Cat( Const( op, 7 ), i[ 11 ], i[ 1 : 5 ], Const( f, 3 ),
+              a, b, i[ 5 : 11 ], i[ 12 ] )
+def U_L( op, c, i ):
+  return Cat( Const( op, 7 ), c, i[ 12 : 32 ] )
+def J_L( op, c, i ):
+  return Cat( Const( op, 7 ), c, i[ 12 : 20 ], i[ 11 ],
+              i[ 1 : 11 ], i[ 20 ] )
+
+class RVC( Elaboratable ):
+  def __init__( self ):
+    # Compressed instruction input.
+    self.i = Signal( 16, reset = 0x0000 )
+    # Expanded instruction output.
+    self.o = Signal( 32, reset = 0x00000000 )
+
+  def elaborate( self, platform ):
+    m = Module()
+    i = self.i
+
+    # Register fields. 3-bit fields select registers r8-r15.
+    rd   = i[ 7 : 12 ]
+    rs2  = i[ 2 : 7 ]
+    rdp  = Cat( i[ 2 : 5 ], Const( 0b01, 2 ) )
+    rs1p = Cat( i[ 7 : 10 ], Const( 0b01, 2 ) )
+    # Immediate fields, sign-extended to 32 bits.
+    imm6 = Cat( i[ 2 : 7 ], Repl( i[ 12 ], 27 ) )
+    jimm = Cat( Const( 0, 1 ), i[ 3 : 6 ], i[ 11 ], i[ 2 ], i[ 7 ],
+                i[ 6 ], i[ 9 : 11 ], i[ 8 ], Repl( i[ 12 ], 21 ) )
+    bimm = Cat( Const( 0, 1 ), i[ 3 : 5 ], i[ 10 : 12 ], i[ 2 ],
+                i[ 5 : 7 ], Repl( i[ 12 ], 24 ) )
+    # Unsigned load / store offsets.
+    lwof = Cat( Const( 0, 2 ), i[ 6 ], i[ 10 : 13 ], i[ 5 ],
+                Const( 0, 5 ) )
+    spld = Cat( Const( 0, 2 ), i[ 4 : 7 ], i[ 12 ], i[ 2 : 4 ],
+                Const( 0, 4 ) )
+    spst = Cat( Const( 0, 2 ), i[ 9 : 13 ], i[ 7 : 9 ], Const( 0, 4 ) )
+
+    # Instructions expand to zero unless otherwise specified.
+    m.d.comb += self.o.eq( 0 )
+
+    # Decode the 2-bit opcode and 3-bit 'funct3' field.
+    with m.Switch( Cat( i[ 0 : 2 ], i[ 13 : 16 ] ) ):
+      # Quadrant 0:
+      # 'C.ADDI4SPN': addi rd', r2, nzuimm
+      with m.Case( 0b00000 ):
+        with m.If( i[ 5 : 13 ] != 0 ):
+          m.d.comb += self.o.eq( I_L( OP_IMM, F_ADDI, rdp, Const( 2, 5 ),
+            Cat( Const( 0, 2 ), i[ 6 ], i[ 5 ], i[ 11 : 13 ],
+                 i[ 7 : 11 ], Const( 0, 2 ) ) ) )
+      # 'C.LW': lw rd', offset( rs1' )
+      with m.Case( 0b01000 ):
+        m.d.comb += self.o.eq( I_L( OP_LOAD, F_LW, rdp, rs1p, lwof ) )
+      # 'C.SW': sw rs2', offset( rs1' )
+      with m.Case( 0b11000 ):
+        m.d.comb += self.o.eq( S_L( OP_STORE, F_SW, rs1p, rdp, lwof ) )
+
+      # Quadrant 1:
+      # 'C.ADDI' / 'C.NOP': addi rd, rd, imm
+      with m.Case( 0b00001 ):
+        m.d.comb += self.o.eq( I_L( OP_IMM, F_ADDI, rd, rd, imm6 ) )
+      # 'C.JAL': jal r1, offset
+      with m.Case( 0b00101 ):
+        m.d.comb += self.o.eq( J_L( OP_JAL, Const( 1, 5 ), jimm ) )
+      # 'C.LI': addi rd, r0, imm
+      with m.Case( 0b01001 ):
+        m.d.comb += self.o.eq( I_L( OP_IMM, F_ADDI, rd, Const( 0, 5 ),
+                                    imm6 ) )
+      # 'C.ADDI16SP': addi r2, r2, nzimm
+      # 'C.LUI': lui rd, nzimm
+      with m.Case( 0b01101 ):
+        with m.If( rd == 2 ):
+          m.d.comb += self.o.eq( I_L( OP_IMM, F_ADDI, rd, rd,
+            Cat( Const( 0, 4 ), i[ 6 ], i[ 2 ], i[ 5 ], i[ 3 : 5 ],
+                 Repl( i[ 12 ], 3 ) ) ) )
+        with m.Else():
+          m.d.comb += self.o.eq( U_L( OP_LUI, rd,
+            Cat( Const( 0, 12 ), imm6[ :20 ] ) ) )
+      # Arithmetic operations on r8-r15.
+      with m.Case( 0b10001 ):
+        with m.Switch( i[ 10 : 12 ] ):
+          # 'C.SRLI': srli rd', rd', shamt
+          with m.Case( 0b00 ):
+            m.d.comb += self.o.eq( R_L( OP_IMM, F_SRLI, FF_SRLI,
+                                        rs1p, rs1p, rs2 ) )
+          # 'C.SRAI': srai rd', rd', shamt
+          with m.Case( 0b01 ):
+            m.d.comb += self.o.eq( R_L( OP_IMM, F_SRAI, FF_SRAI,
+                                        rs1p, rs1p, rs2 ) )
+          # 'C.ANDI': andi rd', rd', imm
+          with m.Case( 0b10 ):
+            m.d.comb += self.o.eq( I_L( OP_IMM, F_ANDI,
+                                        rs1p, rs1p, imm6 ) )
+          # 'C.SUB' / 'C.XOR' / 'C.OR' / 'C.AND': op rd', rd', rs2'
+          with m.Case( 0b11 ):
+            with m.If( i[ 12 ] == 0 ):
+              with m.Switch( i[ 5 : 7 ] ):
+                with m.Case( 0b00 ):
+                  m.d.comb += self.o.eq( R_L( OP_REG, F_SUB, FF_SUB,
+                                              rs1p, rs1p, rdp ) )
+                with m.Case( 0b01 ):
+                  m.d.comb += self.o.eq( R_L( OP_REG, F_XOR, FF_XOR,
+                                              rs1p, rs1p, rdp ) )
+                with m.Case( 0b10 ):
+                  m.d.comb += self.o.eq( R_L( OP_REG, F_OR, FF_OR,
+                                              rs1p, rs1p, rdp ) )
+                with m.Case( 0b11 ):
+                  m.d.comb += self.o.eq( R_L( OP_REG, F_AND, FF_AND,
+                                              rs1p, rs1p, rdp ) )
+      # 'C.J': jal r0, offset
+      with m.Case( 0b10101 ):
+        m.d.comb += self.o.eq( J_L( OP_JAL, Const( 0, 5 ), jimm ) )
+      # 'C.BEQZ' / 'C.BNEZ': beq / bne rs1', r0, offset
+      with m.Case( 0b11001 ):
+        m.d.comb += self.o.eq( B_L( OP_BRANCH, F_BEQ,
+                                    rs1p, Const( 0, 5 ), bimm ) )
+      with m.Case( 0b11101 ):
+        m.d.comb += self.o.eq( B_L( OP_BRANCH, F_BNE,
+                                    rs1p, Const( 0, 5 ), bimm ) )
+
+      # Quadrant 2:
+      # 'C.SLLI': slli rd, rd, shamt
+      with m.Case( 0b00010 ):
+        m.d.comb += self.o.eq( R_L( OP_IMM, F_SLLI, FF_SLLI,
+                                    rd, rd, rs2 ) )
+      # 'C.LWSP': lw rd, offset( r2 )
+      with m.Case( 0b01010 ):
+        m.d.comb += self.o.eq( I_L( OP_LOAD, F_LW, rd, Const( 2, 5 ),
+                                    spld ) )
+      # Register-to-register operations and jumps.
+      with m.Case( 0b10010 ):
+        with m.If( i[ 12 ] == 0 ):
+          # 'C.JR': jalr r0, 0( rs1 )
+          with m.If( rs2 == 0 ):
+            m.d.comb += self.o.eq( I_L( OP_JALR, F_JALR, Const( 0, 5 ),
+                                        rd, Const( 0, 12 ) ) )
+          # 'C.MV': add rd, r0, rs2
+          with m.Else():
+            m.d.comb += self.o.eq( R_L( OP_REG, F_ADD, FF_ADD,
+                                        rd, Const( 0, 5 ), rs2 ) )
+        with m.Else():
+          with m.If( rs2 == 0 ):
+            # 'C.EBREAK'
+            with m.If( rd == 0 ):
+              m.d.comb += self.o.eq( I_L( OP_SYSTEM, F_TRAPS,
+                Const( 0, 5 ), Const( 0, 5 ), Const( 1, 12 ) ) )
+            # 'C.JALR': jalr r1, 0( rs1 )
+            with m.Else():
+              m.d.comb += self.o.eq( I_L( OP_JALR, F_JALR,
+                Const( 1, 5 ), rd, Const( 0, 12 ) ) )
+          # 'C.ADD': add rd, rd, rs2
+          with m.Else():
+            m.d.comb += self.o.eq( R_L( OP_REG, F_ADD, FF_ADD,
+                                        rd, rd, rs2 ) )
+      # 'C.SWSP': sw rs2, offset( r2 )
+      with m.Case( 0b11010 ):
+        m.d.comb += self.o.eq( S_L( OP_STORE, F_SW, Const( 2, 5 ),
+                                    rs2, spst ) )
+
+    # End of 'C' extension expander definition.
+    return m
+
+###############################
+# 'C' extension testbench:    #
+###############################
+# Keep track of test pass / fail rates.
+p = 0
+f = 0
+
+# Expand a compressed instruction, and check that the result matches
+# the equivalent 32-bit instruction.
+def rvc_ut( rvc, name, ci, expected ):
+  global p, f
+  yield rvc.i.eq( ci )
+  yield Settle()
+  actual = yield rvc.o
+  # (32-bit instruction encoders return little-endian words)
+  expected = LITTLE_END( expected )
+  if expected != actual:
+    f += 1
+    print( "\033[31mFAIL:\033[0m %s (0x%04X -> 0x%08X, got: 0x%08X)"
+           %( name, ci, expected, actual ) )
+  else:
+    p += 1
+    print( "\033[32mPASS:\033[0m %s (0x%04X -> 0x%08X)"
+           %( name, ci, expected ) )
+
+# Top-level 'C' extension test method.
+def rvc_test( rvc ):
+  # Let signals settle after reset.
+  yield Settle()
+
+  # Print a test header.
+  print( "--- 'C' Extension Expander Tests ---" )
+
+  # Quadrant 0.
+  yield from rvc_ut( rvc, "C.ADDI4SPN", C_ADDI4SPN( 9, 0x3FC ),
+                     ADDI( 9, 2, 0x3FC ) )
+  yield from rvc_ut( rvc, "C.LW", C_LW( 8, 15, 0x7C ),
+                     LW( 8, 15, 0x7C ) )
+  yield from rvc_ut( rvc, "C.SW", C_SW( 10, 11, 0x1C ),
+                     SW( 10, 11, 0x1C ) )
+  yield from rvc_ut( rvc, "C.SW", C_SW( 10, 11, 0x44 ),
+                     SW( 10, 11, 0x44 ) )
+  # Quadrant 1.
+  yield from rvc_ut( rvc, "C.NOP", C_NOP(), NOP() )
+  yield from rvc_ut( rvc, "C.ADDI", C_ADDI( 5, -32 ),
+                     ADDI( 5, 5, -32 ) )
+  yield from rvc_ut( rvc, "C.JAL", C_JAL( -1024 ), JAL( 1, -1024 ) )
+  yield from rvc_ut( rvc, "C.JAL", C_JAL( 0x2AA ), JAL( 1, 0x2AA ) )
+  yield from rvc_ut( rvc, "C.LI", C_LI( 31, 17 ), ADDI( 31, 0, 17 ) )
+  yield from rvc_ut( rvc, "C.ADDI16SP", C_ADDI16SP( -512 ),
+                     ADDI( 2, 2, -512 ) )
+  yield from rvc_ut( rvc, "C.ADDI16SP", C_ADDI16SP( 0x1F0 ),
+                     ADDI( 2, 2, 0x1F0 ) )
+  yield from rvc_ut( rvc, "C.LUI", C_LUI( 3, 0xFFFE0000 ),
+                     LUI( 3, 0xFFFE0000 ) )
+  yield from rvc_ut( rvc, "C.LUI", C_LUI( 3, 0x0001F000 ),
+                     LUI( 3, 0x0001F000 ) )
+  yield from rvc_ut( rvc, "C.SRLI", C_SRLI( 12, 31 ), SRLI( 12, 12, 31 ) )
+  yield from rvc_ut( rvc, "C.SRAI", C_SRAI( 13, 7 ), SRAI( 13, 13, 7 ) )
+  yield from rvc_ut( rvc, "C.ANDI", C_ANDI( 14, -2 ), ANDI( 14, 14, -2 ) )
+  yield from rvc_ut( rvc, "C.SUB", C_SUB( 8, 9 ), SUB( 8, 8, 9 ) )
+  yield from rvc_ut( rvc, "C.XOR", C_XOR( 10, 11 ), XOR( 10, 10, 11 ) )
+  yield from rvc_ut( rvc, "C.OR", C_OR( 12, 13 ), OR( 12, 12, 13 ) )
+  yield from rvc_ut( rvc, "C.AND", C_AND( 14, 15 ), AND( 14, 14, 15 ) )
+  yield from rvc_ut( rvc, "C.J", C_J( 0x3FF ), JAL( 0, 0x3FF ) )
+  yield from rvc_ut( rvc, "C.BEQZ", C_BEQZ( 8, -128 ), BEQ( 8, 0, -128 ) )
+  yield from rvc_ut( rvc, "C.BNEZ", C_BNEZ( 15, 0x55 ), BNE( 15, 0, 0x55 ) )
+  # Quadrant 2.
+  yield from rvc_ut( rvc, "C.SLLI", C_SLLI( 1, 1 ), SLLI( 1, 1, 1 ) )
+  yield from rvc_ut( rvc, "C.LWSP", C_LWSP( 1, 0xFC ), LW( 1, 2, 0xFC ) )
+  yield from rvc_ut( rvc, "C.JR", C_JR( 1 ), JALR( 0, 1, 0 ) )
+  yield from rvc_ut( rvc, "C.MV", C_MV( 10, 11 ), ADD( 10, 0, 11 ) )
+  yield from rvc_ut( rvc, "C.EBREAK", C_EBREAK(),
+                     RV32I_I( OP_SYSTEM, F_TRAPS, 0, 0, 1 ) )
+  yield from rvc_ut( rvc, "C.JALR", C_JALR( 5 ), JALR( 1, 5, 0 ) )
+  yield from rvc_ut( rvc, "C.ADD", C_ADD( 10, 11 ), ADD( 10, 10, 11 ) )
+  yield from rvc_ut( rvc, "C.SWSP", C_SWSP( 31, 0x14 ), SW( 2, 31, 0x14 ) )
+  yield from rvc_ut( rvc, "C.SWSP", C_SWSP( 31, 0xFC ),
+                     SW( 2, 31, 0xFC ) )
+  # Reserved encodings expand to zero.
+  yield from rvc_ut( rvc, "C.ADDI4SPN (reserved)", 0x0000, 0x00000000 )
+  yield from rvc_ut( rvc, "C.FLD (unsupported)", 0x2000, 0x00000000 )
+
+  # Done.
+  yield Tick()
+  print( "'C' Extension Expander Tests: %d Passed, %d Failed"%( p, f ) )
+
+# 'main' method to run a basic testbench.
+if __name__ == "__main__":
+  # Instantiate a 'C' extension expander module.
+  dut = RVC()
+  m = Module()
+  m.submodules.rvc = dut
+  # Dummy synchronous logic, so that the simulation has a clock.
+  ta = Signal()
+  m.d.sync += ta.eq( ~ta )
+  # Run the tests.
+  with Simulator( m, vcd_file = open( 'rvc.vcd', 'w' ) ) as sim:
+    def proc():
+      yield from rvc_test( dut )
+    sim.add_clock( 1e-6 )
+    sim.add_sync_process( proc )
+    sim.run()
@@ -3,36 +3,57 @@ from nmigen.back.pysim import *
 from nmigen_soc.wishbone import *
 from nmigen_soc.memory import *
 
+from accel import *
 from gpio import *
 from gpio_mux import *
+from icache import *
+from itcm import *
+from prefetch import *
 from pwm import *
 from ram import *
+from stbuf import *
 
 #############################################################
 # "RISC-V Memories" module.                                 #
 # This directs memory accesses to the appropriate submodule #
 # based on the memory space defined by the 3 MSbits.        #
 # (None of this is actually part of the RISC-V spec)        #
+# Bus addresses are in words, and the 'sel' signals select  #
+# which bytes of a word are accessed.                       #
 # Current memory spaces:                                    #
 # *  0x0------- = ROM                                       #
+# *  0x1------- = ITCM (if any)                             #
 # *  0x2------- = RAM                                       #
 # *  0x4------- = Peripherals                               #
 # ** 0x4000---- = GPIO pins                                 #
 # ** 0x4001---- = GPIO multiplexer                          #
 # ** 0x4002---- = PWM peripherals                           #
 # ** 0x40020x-- = PWM peripheral #(x-1)                     #
+# ** 0x4003---- = Memory-mapped accelerator (if any)        #
 #############################################################
 
 class RV_Memory( Elaboratable ):
-  def __init__( self, rom_module, ram_words ):
+  def __init__( self, rom_module, ram_words, prefetch = 0,
+                icache = None, stbuf = 0, accel = None,
+                fetch64 = False, itcm = 0, harts = 1 ):
+    # 64-bit instruction fetches: the instruction bus returns two
+    # words per transaction. The ROM and RAM provide separate 64-bit
+    # buses for it. (ROM modules which can't, like 'SPI_ROM', keep
+    # using 32-bit fetches. So do the instruction cache and the
+    # prefetch queue, which have their own buffers.)
+    self.fetch64 = fetch64 and ( icache is None ) and \
+                   ( prefetch == 0 ) and hasattr( rom_module, 'wide_bus' )
+
     # Memory multiplexers.
     # Data bus multiplexer.
-    self.dmux = Decoder( addr_width = 32,
+    self.dmux = Decoder( addr_width = 30,
                          data_width = 32,
+                         granularity = 8,
                          alignment = 0 )
     # Instruction bus multiplexer.
-    self.imux = Decoder( addr_width = 32,
-                         data_width = 32,
+    self.imux = Decoder( addr_width = 29 if self.fetch64 else 30,
+                         data_width = 64 if self.fetch64 else 32,
+                         granularity = 8,
                          alignment = 0 )
 
     # Add ROM and RAM buses to the data multiplexer.
@@ -42,6 +63,14 @@ class RV_Memory( Elaboratable ):
     self.ram_d = self.ram.new_bus()
     self.dmux.add( self.rom_d,    addr = 0x00000000 )
     self.dmux.add( self.ram_d,    addr = 0x20000000 )
+    # Optional tightly-coupled instruction memory. ('itcm' is its
+    # size in words) Its data bus port lets programs copy code into
+    # it, and its fetch port is wired to the instruction bus below.
+    if itcm > 0:
+      self.itcm = ITCM( itcm, self.fetch64 )
+      self.dmux.add( self.itcm.bus, addr = 0x10000000 )
+    else:
+      self.itcm = None
     # Add peripheral buses to the data multiplexer.
     self.gpio = GPIO()
     self.dmux.add( self.gpio,     addr = 0x40000000 )
@@ -55,14 +84,134 @@ class RV_Memory( Elaboratable ):
     gpio_mux_arr.extend( self.pwm )
     self.gpio_mux = GPIO_Mux( gpio_mux_arr )
     self.dmux.add( self.gpio_mux, addr = 0x40010000 )
+    # Optional memory-mapped accelerator. ('accel' is an
+    # 'Accelerator' subclass, so that it can be compared with the
+    # CPU's custom instruction port.)
+    if accel is not None:
+      self.acc = AccelPeriph( accel() )
+      self.dmux.add( self.acc,    addr = 0x40030000 )
+    else:
+      self.acc = None
 
     # Add ROM and RAM buses to the instruction multiplexer.
-    self.rom_i = self.rom.new_bus()
-    self.ram_i = self.ram.new_bus()
+    # If an instruction cache is used, ROM fetches go through it.
+    # ('icache' is a tuple: ( number of lines, words per line ) )
+    # (With multiple harts, each one has its own instruction cache)
+    if ( icache is not None ) and ( harts == 1 ):
+      self.ic = ICache( self.rom, icache[ 0 ], icache[ 1 ] )
+      self.rom_i = self.ic.bus
+    elif self.fetch64:
+      self.ic = None
+      self.rom_i = self.rom.wide_bus()
+    else:
+      self.ic = None
+      self.rom_i = self.rom.new_bus()
+    if self.fetch64:
+      self.ram_i = self.ram.wide_bus()
+    else:
+      self.ram_i = self.ram.new_bus()
     self.imux.add( self.rom_i,    addr = 0x00000000 )
     self.imux.add( self.ram_i,    addr = 0x20000000 )
     # (No peripherals on the instruction bus)
 
+    # Instruction fetch bus. If there is an ITCM, fetches from its
+    # address space skip the multiplexer and go to its fetch port.
+    if self.itcm is not None:
+      self.fbus = Interface( addr_width = self.imux.bus.addr_width,
+                             data_width = self.imux.bus.data_width,
+                             granularity = 8 )
+    else:
+      self.fbus = self.imux.bus
+
+    # 'FENCE.I' signal: invalidates any cached instructions.
+    self.fencei = Signal( reset = 0 )
+
+    # Optional instruction prefetch queue. If it is used, the CPU
+    # fetches instructions through it instead of the multiplexer.
+    if ( prefetch > 0 ) and ( harts == 1 ):
+      self.pf = Prefetch( self.fbus, prefetch, self.mpipe )
+      self.ibus = self.pf.bus
+    else:
+      self.pf = None
+      self.ibus = self.fbus
+
+    # Optional store buffer. If it is used, the CPU performs loads
+    # and stores through it instead of the data bus multiplexer.
+    if ( stbuf > 0 ) and ( harts == 1 ):
+      self.sb = StoreBuffer( self.dmux.bus, stbuf )
+      self.dbus = self.sb.bus
+    else:
+      self.sb = None
+      self.dbus = self.dmux.bus
+    # Every write to memory passes through the data bus multiplexer,
+    # so harts can watch it to cancel their 'LR.W' reservations.
+    self.snoop = self.dmux.bus
+
+    # Multiple harts: each one gets its own instruction and data
+    # buses, which share the memories through round-robin arbiters.
+    # Instruction caches, prefetch queues and store buffers belong
+    # to a single hart, so they are created in each 'RV_MemPort'.
+    self.harts = harts
+    if harts > 1:
+      self.iarb = Arbiter( addr_width = self.fbus.addr_width,
+                           data_width = self.fbus.data_width,
+                           granularity = 8 )
+      self.darb = Arbiter( addr_width = 30,
+                           data_width = 32,
+                           granularity = 8 )
+      self.ports = [ RV_MemPort( self, prefetch, stbuf, icache )
+                     for i in range( harts ) ]
+    else:
+      # (With a single hart, this module is its only port)
+      self.ports = [ self ]
+
+  # Helper method to select the instruction bus read data from the
+  # memory at a given (byte) address. Unlike the multiplexer's 'dat_r', this
+  # does not depend on the address which is currently on the bus.
+  def idat( self, adr ):
+    if self.pf is not None:
+      return self.pf.bus.dat_r
+    dat = Mux( adr[ 29 ], self.ram_i.dat_r, self.rom_i.dat_r )
+    if self.itcm is not None:
+      dat = Mux( adr[ 28 ], self.itcm.fdat, dat )
+    # (64-bit fetches return both words of the doubleword)
+    if self.fetch64:
+      return Mux( adr[ 2 ], dat[ 32 : ], dat[ :32 ] )
+    return dat
+
+  # Helper method to get the predecoded fields for the word which
+  # 'idat' returns. They are read from the ROM if it stores them and
+  # it is not behind a cache or prefetch queue, and decoded from the
+  # instruction word otherwise. (The ROM's 64-bit bus doesn't
+  # read them)
+  def ipd( self, adr ):
+    if ( self.pf is not None ) or ( self.ic is not None ) or \
+       ( self.rom.pd is None ) or self.fetch64:
+      return PREDECODE_L( self.idat( adr ) )
+    pd = Mux( adr[ 29 ], PREDECODE_L( self.ram_i.dat_r ), self.rom.pd )
+    if self.itcm is not None:
+      pd = Mux( adr[ 28 ], PREDECODE_L( self.itcm.fdat ), pd )
+    return pd
+
+  # Helper method to check whether the memory at a given (byte)
+  # address can return one word per cycle while 'cyc' is held.
+  def mpipe( self, adr ):
+    # (With multiple harts, fetches don't hold the shared bus, so
+    #  that the arbiter can hand it to the other harts)
+    if self.harts > 1:
+      return 0
+    rom_pipe = self.rom.pipelined if self.ic is None else ICache.pipelined
+    return ( ( ( adr[ 28 : 32 ] == 0b0000 ) & rom_pipe ) |
+             ( adr[ 28 : 32 ] == 0b0001 ) |
+             ( adr[ 29 : 32 ] == 0b001 ) )
+
+  # Helper method to check whether the CPU's instruction bus can
+  # return one word per cycle. The prefetch queue always can.
+  def ipipe( self, adr ):
+    if self.pf is not None:
+      return 1
+    return self.mpipe( adr )
+
   def elaborate( self, platform ):
     m = Module()
     # Register the multiplexers, peripherals, and memory submodules.
@@ -74,12 +223,177 @@ class RV_Memory( Elaboratable ):
     for i in range( PWM_PERIPHS ):
       setattr( m.submodules, "pwm%i"%i, self.pwm[ i ] )
     m.submodules.gpio_mux = self.gpio_mux
+    if self.acc is not None:
+      m.submodules.acc    = self.acc
+    if self.pf is not None:
+      m.submodules.pf     = self.pf
+    if self.ic is not None:
+      m.submodules.ic     = self.ic
+    if self.sb is not None:
+      m.submodules.sb     = self.sb
+    if self.itcm is not None:
+      m.submodules.itcm   = self.itcm
+
+    # Apply 'FENCE.I' to the instruction cache and prefetch queue.
+    if self.ic is not None:
+      m.d.comb += self.ic.inv.eq( self.fencei )
+    if self.pf is not None:
+      m.d.comb += self.pf.inv.eq( self.fencei )
+
+    # Register the harts' memory ports, and connect their arbiters
+    # to the instruction fetch bus and the data bus multiplexer.
+    if self.harts > 1:
+      m.submodules.iarb = self.iarb
+      m.submodules.darb = self.darb
+      for i in range( self.harts ):
+        setattr( m.submodules, "port%d"%i, self.ports[ i ] )
+      m.d.comb += [
+        self.fbus.adr.eq( self.iarb.bus.adr ),
+        self.fbus.sel.eq( self.iarb.bus.sel ),
+        self.fbus.cyc.eq( self.iarb.bus.cyc ),
+        self.iarb.bus.ack.eq( self.fbus.ack ),
+        self.iarb.bus.dat_r.eq( self.fbus.dat_r ),
+        self.dmux.bus.adr.eq( self.darb.bus.adr ),
+        self.dmux.bus.sel.eq( self.darb.bus.sel ),
+        self.dmux.bus.dat_w.eq( self.darb.bus.dat_w ),
+        self.dmux.bus.we.eq( self.darb.bus.we ),
+        self.dmux.bus.cyc.eq( self.darb.bus.cyc ),
+        self.darb.bus.ack.eq( self.dmux.bus.ack ),
+        self.darb.bus.dat_r.eq( self.dmux.bus.dat_r )
+      ]
 
     # Currently, all bus cycles are single-transaction.
     # So set the 'strobe' signals equal to the 'cycle' ones.
-    m.d.comb += [
-      self.dmux.bus.stb.eq( self.dmux.bus.cyc ),
-      self.imux.bus.stb.eq( self.imux.bus.cyc )
-    ]
+    # (The prefetch queue drives its own 'strobe' signal)
+    m.d.comb += self.dmux.bus.stb.eq( self.dmux.bus.cyc )
+    if ( self.pf is None ) or ( self.itcm is not None ):
+      m.d.comb += self.imux.bus.stb.eq( self.imux.bus.cyc )
+
+    # Route instruction fetches to the ITCM or the multiplexer,
+    # based on the 4 MSbits of the fetch address. Like the
+    # multiplexer, 'ack' and 'dat_r' follow the current address.
+    if self.itcm is not None:
+      t = ( self.fbus.adr[ -4 : ] == 0b0001 )
+      m.d.comb += [
+        self.itcm.fadr.eq( self.fbus.adr ),
+        self.itcm.freq.eq( self.fbus.cyc & t ),
+        self.imux.bus.adr.eq( self.fbus.adr ),
+        self.imux.bus.sel.eq( self.fbus.sel ),
+        self.imux.bus.cyc.eq( self.fbus.cyc & ~t ),
+        self.fbus.ack.eq( Mux( t, self.itcm.fack, self.imux.bus.ack ) ),
+        self.fbus.dat_r.eq( Mux( t, self.itcm.fdat,
+                                    self.imux.bus.dat_r ) )
+      ]
+
+    return m
+
+###########################################################
+# Memory port for one hart of a multi-hart system. It has #
+# the same bus signals and helper methods that the CPU    #
+# uses from a single-hart 'RV_Memory' module, but its     #
+# buses go through the shared memory's arbiters. If there #
+# is an instruction cache, ROM fetches go through this    #
+# hart's own cache instead, so that loops which hit in it #
+# don't wait for the other harts.                         #
+###########################################################
+
+class RV_MemPort( Elaboratable ):
+  def __init__( self, mem, prefetch, stbuf, icache ):
+    self.mem = mem
+    # Shared memories.
+    self.rom = mem.rom
+    self.ram = mem.ram
+    self.itcm = mem.itcm
+    self.fetch64 = mem.fetch64
+    # This hart's 'FENCE.I' signal.
+    self.fencei = Signal( reset = 0 )
+
+    # This hart's buses to the shared instruction and data arbiters.
+    self.abus = Interface( addr_width = mem.iarb.bus.addr_width,
+                           data_width = mem.iarb.bus.data_width,
+                           granularity = 8 )
+    mem.iarb.add( self.abus )
+    dbus = Interface( addr_width = 30, data_width = 32, granularity = 8 )
+    mem.darb.add( dbus )
+    # Optional instruction cache, with its own ROM bus. Fetches from
+    # the ROM's address space go to it, and others go to the arbiter.
+    if icache is not None:
+      self.ic = ICache( self.rom, icache[ 0 ], icache[ 1 ] )
+      self.fbus = Interface( addr_width = self.abus.addr_width,
+                             data_width = self.abus.data_width,
+                             granularity = 8 )
+    else:
+      self.ic = None
+      self.fbus = self.abus
+    # Optional prefetch queue and store buffer, like the ones in
+    # a single-hart 'RV_Memory' module.
+    if prefetch > 0:
+      self.pf = Prefetch( self.fbus, prefetch, self.mpipe )
+      self.ibus = self.pf.bus
+    else:
+      self.pf = None
+      self.ibus = self.fbus
+    if stbuf > 0:
+      self.sb = StoreBuffer( dbus, stbuf )
+      self.dbus = self.sb.bus
+    else:
+      self.sb = None
+      self.dbus = dbus
+    # The shared data bus, which carries every hart's writes.
+    self.snoop = mem.dmux.bus
+
+  # Helper methods which match the 'RV_Memory' ones. Without a
+  # prefetch queue, fetched words come from this hart's cache or
+  # the shared memories.
+  def idat( self, adr ):
+    if self.pf is not None:
+      return self.pf.bus.dat_r
+    dat = self.mem.idat( adr )
+    if self.ic is not None:
+      dat = Mux( adr[ 28 : 32 ] == 0b0000, self.ic.bus.dat_r, dat )
+    return dat
+
+  def ipd( self, adr ):
+    if ( self.pf is not None ) or ( self.ic is not None ):
+      return PREDECODE_L( self.idat( adr ) )
+    return self.mem.ipd( adr )
+
+  # Only this hart's instruction cache can return one word per
+  # cycle without holding the shared bus.
+  def mpipe( self, adr ):
+    if self.ic is not None:
+      return ( adr[ 28 : 32 ] == 0b0000 )
+    return 0
+
+  def ipipe( self, adr ):
+    if self.pf is not None:
+      return 1
+    return self.mpipe( adr )
+
+  def elaborate( self, platform ):
+    m = Module()
+    if self.pf is not None:
+      m.submodules.pf = self.pf
+      m.d.comb += self.pf.inv.eq( self.fencei )
+    if self.sb is not None:
+      m.submodules.sb = self.sb
+
+    # Route ROM fetches to the instruction cache, like the ITCM
+    # router in 'RV_Memory'.
+    if self.ic is not None:
+      m.submodules.ic = self.ic
+      t = ( self.fbus.adr[ -4 : ] == 0b0000 )
+      m.d.comb += [
+        self.ic.inv.eq( self.fencei ),
+        self.ic.bus.adr.eq( self.fbus.adr ),
+        self.ic.bus.cyc.eq( self.fbus.cyc & t ),
+        self.ic.bus.stb.eq( self.fbus.cyc & t ),
+        self.abus.adr.eq( self.fbus.adr ),
+        self.abus.sel.eq( self.fbus.sel ),
+        self.abus.cyc.eq( self.fbus.cyc & ~t ),
+        self.fbus.ack.eq( Mux( t, self.ic.bus.ack, self.abus.ack ) ),
+        self.fbus.dat_r.eq( Mux( t, self.ic.bus.dat_r,
+                                    self.abus.dat_r ) )
+      ]
 
     return m
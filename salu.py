@@ -0,0 +1,248 @@
+from nmigen import *
+from nmigen.back.pysim import *
+
+from isa import *
+
+import sys
+
+###############################################################
+# Serial ALU module: a smaller replacement for the 'ALU'      #
+# module, which processes 'width' bits of its operands per    #
+# cycle instead of all 32 at once. ('width' = 1 is bit-serial #
+# and 'width' = 4 is nibble-serial)                           #
+# * Logic, addition, and comparison operations take           #
+#   32 / width cycles. The operands are shifted through the   #
+#   'Y' register, low bits first, with one 'width'-bit adder  #
+#   and a carry flag.                                         #
+# * Shifts move 'Y' by up to 'width' bits per cycle, so they  #
+#   take ( shift amount / width ) cycles, rounded up.         #
+# The 'F' input takes the same function codes as the 'ALU'    #
+# module, and like the 'MulDiv' module, the inputs are        #
+# latched when 'start' is set. The bit-manipulation           #
+# operations are not supported. The 'CMP' branch condition    #
+# output is derived from the result once it is done.          #
+###############################################################
+
+class SerialALU( Elaboratable ):
+  def __init__( self, width = 1 ):
+    # Number of bits to process per cycle. (A power of 2)
+    if ( 32 % width ) != 0:
+      raise ValueError( "Serial ALU width must divide 32" )
+    self.width = width
+    # 'A' and 'B' data inputs.
+    self.a = Signal( 32, reset = 0x00000000 )
+    self.b = Signal( 32, reset = 0x00000000 )
+    # 'F' function select input. (The MSbit is ignored)
+    self.f = Signal( 5,  reset = 0b00000 )
+    # 'Start' input: latches the inputs and starts an operation.
+    self.start = Signal( reset = 0 )
+    # 'Y' data output, and a flag which is set for one cycle
+    # when it holds the result of the last operation.
+    self.y = Signal( 32, reset = 0x00000000 )
+    self.done = Signal( reset = 0 )
+    # 'CMP' comparison flag output, like the 'ALU' module's:
+    # A == B for 'SUB', or A < B for 'SLT' / 'SLTU'.
+    self.cmp = Signal( reset = 0 )
+
+  def elaborate( self, platform ):
+    # Core serial ALU module.
+    m = Module()
+    w = self.width
+
+    # Function bits of the operation in progress, the 'B' operand
+    # (shifted right by 'width' bits per cycle for arithmetic), the
+    # carry flag, and the number of bits left to process or shift.
+    fl  = Signal( 4, reset = 0b0000 )
+    bs  = Signal( 32, reset = 0x00000000 )
+    c   = Signal( reset = 0 )
+    cnt = Signal( range( 33 ), reset = 0 )
+    busy = Signal( reset = 0 )
+    # Flags which are set for shifts, and for operations which
+    # subtract 'B'. ('SUB', 'SLT', and 'SLTU')
+    shf = Signal( reset = 0 )
+    sub = Signal( reset = 0 )
+    # Current 'width'-bit slices of 'A' and 'B', their sum, and
+    # the result slice which is shifted into the top of 'Y'.
+    ac  = Signal( w, reset = 0 )
+    bc  = Signal( w, reset = 0 )
+    sc  = Signal( w + 1, reset = 0 )
+    rc  = Signal( w, reset = 0 )
+    # Number of bits to shift by on this cycle.
+    sn  = Signal( range( w + 1 ), reset = 0 )
+
+    m.d.comb += [
+      shf.eq( fl[ :3 ] == ( ALU_SRL & 0b111 ) ),
+      sub.eq( fl[ 3 ] | ( fl[ 1 : 3 ] == 0b01 ) ),
+      ac.eq( self.y[ :w ] ),
+      bc.eq( Mux( sub, ~bs[ :w ], bs[ :w ] ) ),
+      sc.eq( ac + bc + c ),
+      sn.eq( Mux( cnt >= w, w, cnt ) ),
+      self.cmp.eq( Mux( fl[ 1 ], self.y[ 0 ], self.y == 0 ) )
+    ]
+    m.d.sync += self.done.eq( 0 )
+
+    # Start a new operation: latch the inputs. Shifts by 0 bits
+    # finish immediately.
+    with m.If( self.start ):
+      m.d.sync += [
+        fl.eq( self.f[ :4 ] ),
+        self.y.eq( self.a ),
+        bs.eq( self.b ),
+        c.eq( self.f[ 3 ] | ( self.f[ 1 : 3 ] == 0b01 ) )
+      ]
+      with m.If( self.f[ :3 ] == ( ALU_SRL & 0b111 ) ):
+        m.d.sync += [
+          cnt.eq( self.b[ :5 ] ),
+          busy.eq( self.b[ :5 ] != 0 ),
+          self.done.eq( self.b[ :5 ] == 0 )
+        ]
+      with m.Else():
+        m.d.sync += [
+          cnt.eq( 32 ),
+          busy.eq( 1 )
+        ]
+
+    # Process the next 'width' bits.
+    with m.Elif( busy ):
+      m.d.sync += cnt.eq( cnt - sn )
+      with m.If( cnt == sn ):
+        m.d.sync += [
+          busy.eq( 0 ),
+          self.done.eq( 1 )
+        ]
+      # Shifts: move 'Y' right, filling with its sign bit for 'SRA'.
+      with m.If( shf ):
+        for i in range( 1, w + 1 ):
+          with m.If( sn == i ):
+            m.d.sync += self.y.eq( Cat( self.y[ i : ],
+              Repl( fl[ 3 ] & self.y[ 31 ], i ) ) )
+      # Other operations: shift the next result slice into 'Y',
+      # and keep the carry for the next slice.
+      with m.Else():
+        m.d.sync += [
+          self.y.eq( Cat( self.y[ w : ], rc ) ),
+          bs.eq( bs >> w ),
+          c.eq( sc[ w ] )
+        ]
+        with m.Switch( fl[ :3 ] ):
+          with m.Case( ALU_AND & 0b111 ):
+            m.d.comb += rc.eq( ac & bc )
+          with m.Case( ALU_OR & 0b111 ):
+            m.d.comb += rc.eq( ac | bc )
+          with m.Case( ALU_XOR & 0b111 ):
+            m.d.comb += rc.eq( ac ^ bc )
+          with m.Default():
+            m.d.comb += rc.eq( sc[ :w ] )
+        # Comparisons: once the subtraction is done, the result is
+        # 1 if there was a borrow ('SLTU'), or if the difference is
+        # negative with no overflow or the operands' signs differ
+        # and 'A' is negative. ('SLT')
+        with m.If( ( fl[ 1 : 3 ] == 0b01 ) & ( cnt == w ) ):
+          m.d.sync += self.y.eq( Mux( fl[ 0 ], sc[ w ] == 0,
+            Mux( ac[ -1 ] ^ bs[ w - 1 ], ac[ -1 ], sc[ w - 1 ] ) ) )
+
+    # End of serial ALU module definition.
+    return m
+
+#########################
+# Serial ALU testbench: #
+#########################
+# Keep track of test pass / fail rates.
+p = 0
+f = 0
+# Perform an individual serial ALU unit test, and check how many
+# cycles it takes.
+def salu_ut( alu, a, b, fn, expected, cycles ):
+  global p, f
+  # Set A, B, F, and start the operation.
+  yield alu.a.eq( a )
+  yield alu.b.eq( b )
+  yield alu.f.eq( fn )
+  yield alu.start.eq( 1 )
+  yield Tick()
+  yield alu.start.eq( 0 )
+  nc = 1
+  yield Settle()
+  # Wait for the result.
+  while ( yield alu.done ) == 0:
+    yield Tick()
+    nc += 1
+    yield Settle()
+  actual = yield alu.y
+  if ( hexs( expected ) != hexs( actual ) ) or ( nc != cycles ):
+    f += 1
+    print( "\033[31mFAIL:\033[0m %s %s %s = %s in %d cycles"
+           " (got: %s in %d cycles)"
+           %( hexs( a ), ALU_STRS[ fn ], hexs( b ),
+              hexs( expected ), cycles, hexs( actual ), nc ) )
+  else:
+    p += 1
+    print( "\033[32mPASS:\033[0m %s %s %s = %s in %d cycles"
+           %( hexs( a ), ALU_STRS[ fn ],
+              hexs( b ), hexs( expected ), cycles ) )
+
+# Top-level serial ALU test method.
+def salu_test( alu ):
+  # Let signals settle after reset.
+  yield Settle()
+
+  # Print a test header.
+  print( "--- Serial ALU Tests (%d bits per cycle) ---"%alu.width )
+  n = ( 32 // alu.width ) + 1
+
+  # Test the bitwise logic operations.
+  print( "Logic tests:" )
+  yield from salu_ut( alu, 0xCCCCCCCC, 0xCCCC0000, ALU_AND, 0xCCCC0000, n )
+  yield from salu_ut( alu, 0xCCCCCCCC, 0xCCCC0000, ALU_OR, 0xCCCCCCCC, n )
+  yield from salu_ut( alu, 0xCCCCCCCC, 0xCCCC0000, ALU_XOR, 0x0000CCCC, n )
+  yield from salu_ut( alu, 0x00000000, 0xFFFFFFFF, ALU_XOR, 0xFFFFFFFF, n )
+
+  # Test the addition and subtraction operations.
+  print( "ADD / SUB tests:" )
+  yield from salu_ut( alu, 0xFFFFFFFF, 1, ALU_ADD, 0, n )
+  yield from salu_ut( alu, 29, 71, ALU_ADD, 100, n )
+  yield from salu_ut( alu, 0x7FFFFFFF, 0x7FFFFFFF, ALU_ADD, 0xFFFFFFFE, n )
+  yield from salu_ut( alu, 0, 1, ALU_SUB, -1, n )
+  yield from salu_ut( alu, 29, 71, ALU_SUB, -42, n )
+  yield from salu_ut( alu, 0x80000000, 1, ALU_SUB, 0x7FFFFFFF, n )
+
+  # Test the comparison operations.
+  print( "SLT / SLTU tests:" )
+  yield from salu_ut( alu, 0, 0, ALU_SLT, 0, n )
+  yield from salu_ut( alu, 0, 1, ALU_SLT, 1, n )
+  yield from salu_ut( alu, -1, 0, ALU_SLT, 1, n )
+  yield from salu_ut( alu, -42, -10, ALU_SLT, 1, n )
+  yield from salu_ut( alu, -10, -42, ALU_SLT, 0, n )
+  yield from salu_ut( alu, 0x7FFFFFFF, 0x80000000, ALU_SLT, 0, n )
+  yield from salu_ut( alu, 0x80000000, 0x7FFFFFFF, ALU_SLT, 1, n )
+  yield from salu_ut( alu, 0, 1, ALU_SLTU, 1, n )
+  yield from salu_ut( alu, -1, 0, ALU_SLTU, 0, n )
+  yield from salu_ut( alu, -42, 42, ALU_SLTU, 0, n )
+  yield from salu_ut( alu, 42, -42, ALU_SLTU, 1, n )
+
+  # Test the shift operations. They take longer to shift further.
+  print( "SRL / SRA tests:" )
+  yield from salu_ut( alu, 0x80000000, 0, ALU_SRL, 0x80000000, 1 )
+  yield from salu_ut( alu, 0x80000000, 1, ALU_SRL, 0x40000000, 2 )
+  yield from salu_ut( alu, 0x80000000, 4, ALU_SRA, 0xF8000000,
+                      ( ( 4 + alu.width - 1 ) // alu.width ) + 1 )
+  yield from salu_ut( alu, 0x80000000, 31, ALU_SRL, 0x00000001,
+                      ( ( 31 + alu.width - 1 ) // alu.width ) + 1 )
+  yield from salu_ut( alu, 0x80000000, 31, ALU_SRA, 0xFFFFFFFF,
+                      ( ( 31 + alu.width - 1 ) // alu.width ) + 1 )
+
+  # Done.
+  yield Tick()
+  print( "Serial ALU Tests: %d Passed, %d Failed"%( p, f ) )
+
+# 'main' method to run a basic testbench.
+if __name__ == "__main__":
+  # Test bit-serial and nibble-serial ALUs.
+  for width in [ 1, 4 ]:
+    dut = SerialALU( width )
+    with Simulator( dut, vcd_file = open( 'salu_%d.vcd'%width, 'w' ) ) as sim:
+      def proc():
+        yield from salu_test( dut )
+      sim.add_clock( 1e-6 )
+      sim.add_sync_process( proc )
+      sim.run()
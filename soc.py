@@ -0,0 +1,197 @@
+from nmigen import *
+from nmigen.back.pysim import *
+
+from cpu import *
+
+import sys
+import warnings
+
+##################################################################
+# Multi-hart SoC module: N 'CPU' harts which share one memory    #
+# module. Each hart has its own register file, CSRs, and         #
+# 'MHARTID' value, and its own instruction and data buses, which #
+# reach the shared ROM / RAM / peripherals through round-robin   #
+# arbiters. (Instruction caches, prefetch queues, and store      #
+# buffers are per-hart)                                          #
+# Boot protocol: every hart starts at address 0 after reset.     #
+# Hart 0 boots normally, and the other harts wait for it to      #
+# write a non-zero start address to their word of the 'boot      #
+# mailbox' at 0x20000000 + ( 4 * MHARTID ), then jump to it.     #
+# This is done by the program, so the hardware doesn't need to   #
+# hold any harts in reset.                                       #
+##################################################################
+
+class SoC( Elaboratable ):
+  def __init__( self, rom_module, harts = 2, **cfg ):
+    # 'Reset' signal for clock domains.
+    self.clk_rst = Signal( reset = 0b0, reset_less = True )
+    # Shared memory module. The CPU options which change it are
+    # applied here instead of in each hart. (The harts check that
+    # the options can be used together)
+    self.mem = RV_Memory( rom_module, 1024,
+                          cfg.get( 'prefetch', 0 ),
+                          cfg.get( 'icache', None ),
+                          cfg.get( 'stbuf', 0 ),
+                          cfg.get( 'accel', None ),
+                          cfg.get( 'fetch64', False ),
+                          cfg.get( 'itcm', 0 ),
+                          harts )
+    # CPU harts.
+    self.harts = [ CPU( rom_module, hartid = i, mem = self.mem, **cfg )
+                   for i in range( harts ) ]
+
+  def elaborate( self, platform ):
+    m = Module()
+    # Register the shared memory module and the harts.
+    m.submodules.mem = self.mem
+    for i in range( len( self.harts ) ):
+      setattr( m.submodules, "hart%d"%i, self.harts[ i ] )
+    return m
+
+##################
+# SoC testbench: #
+##################
+
+# Keep track of test pass / fail rates, and how many cycles each
+# configuration takes to run the parallel workload.
+p = 0
+f = 0
+soc_cycles = {}
+
+# Helper method to run an SoC until every hart reaches the infinite
+# loop at the given address, and let any buffered stores finish.
+# Returns the number of cycles that it took.
+def soc_run( dut, end ):
+  nc = 0
+  while nc < 20000:
+    yield Settle()
+    pcs = []
+    for h in dut.harts:
+      pcs.append( ( yield h.pc ) )
+    if all( pc == end for pc in pcs ):
+      break
+    yield Tick()
+    nc += 1
+  for i in range( 16 ):
+    yield Tick()
+  yield Settle()
+  return nc
+
+# Helper method to simulate running the 'parallel sum' program on an
+# SoC with the given number of harts, and check each hart's result.
+def soc_sim( harts, n, cfg = {} ):
+  global p, f
+  print( "\033[33mSTART\033[0m running 'parallel sum' program"
+         " on %d hart(s) (%s core):"%( harts, cfg_str( cfg ) ) )
+  rom = smp_rom( harts, n )
+  dut = SoC( ROM( rom, predecode = cfg.get( 'predecode', False ) ),
+             harts, **cfg )
+  soc = ResetInserter( dut.clk_rst )( dut )
+  # Every hart ends up in the infinite loop at the end of the ROM.
+  end = ( len( rom ) - 1 ) * 4
+
+  with Simulator( soc, vcd_file = open( 'soc_%d.vcd'%harts, 'w' ) ) as sim:
+    def proc():
+      global p, f
+      # Run until every hart reaches the final loop, then check
+      # the partial sums.
+      nc = yield from soc_run( dut, end )
+      total = 0
+      ni = 0
+      for i in range( harts ):
+        part = yield dut.mem.ram.data[ 0x10 + i ]
+        total += part
+        ni += yield dut.harts[ i ].csr.minstret_instrs
+        exp = sum( range( i + 1, n + 1, harts ) )
+        if part == exp:
+          p += 1
+          print( "  \033[32mPASS:\033[0m hart %d sum == %d"%( i, exp ) )
+        else:
+          f += 1
+          print( "  \033[31mFAIL:\033[0m hart %d sum == %d (got: %d)"
+                 %( i, exp, part ) )
+      if total == ( n * ( n + 1 ) // 2 ):
+        p += 1
+      else:
+        f += 1
+        print( "  \033[31mFAIL:\033[0m total == %d (got: %d)"
+               %( n * ( n + 1 ) // 2, total ) )
+      soc_cycles[ ( cfg_str( cfg ), harts ) ] = nc
+      print( "\033[35mDONE\033[0m running parallel sum: %d harts"
+             " retired %d instructions in %d cycles (IPC: %.2f)"
+             %( harts, ni, nc, ( ni / max( nc, 1 ) ) ) )
+    sim.add_clock( 1 / 6000000 )
+    sim.add_sync_process( proc )
+    sim.run()
+
+# Helper method to simulate running the 'atomic counter' program on
+# an SoC with the given number of harts, and check that no increments
+# were lost while the harts competed for the same words.
+def soc_amo_sim( harts, n, cfg = {} ):
+  global p, f
+  print( "\033[33mSTART\033[0m running 'atomic counter' program"
+         " on %d hart(s) (%s core):"%( harts, cfg_str( cfg ) ) )
+  rom = amo_smp_rom( n )
+  dut = SoC( ROM( rom, predecode = cfg.get( 'predecode', False ) ),
+             harts, **cfg )
+  soc = ResetInserter( dut.clk_rst )( dut )
+  end = ( len( rom ) - 1 ) * 4
+
+  with Simulator( soc, vcd_file = open( 'soc_amo_%d.vcd'%harts, 'w' ) ) as sim:
+    def proc():
+      global p, f
+      nc = yield from soc_run( dut, end )
+      for name, i in [ ( 'AMOADD.W', 0x10 ), ( 'LR.W / SC.W', 0x11 ) ]:
+        count = yield dut.mem.ram.data[ i ]
+        if count == ( harts * n ):
+          p += 1
+          print( "  \033[32mPASS:\033[0m %s count == %d"%( name, count ) )
+        else:
+          f += 1
+          print( "  \033[31mFAIL:\033[0m %s count == %d (got: %d)"
+                 %( name, harts * n, count ) )
+      print( "\033[35mDONE\033[0m running atomic counter: %d harts"
+             " took %d cycles"%( harts, nc ) )
+    sim.add_clock( 1 / 6000000 )
+    sim.add_sync_process( proc )
+    sim.run()
+
+# Core configurations to run the parallel workload on.
+# (Every hart fetches through the same bus unless it has its own
+#  instruction cache, so those configurations scale better)
+soc_cfgs = [
+  {},
+  { 'fast': True, 'icache': ( 16, 4 ) },
+  { 'pipeline': True, 'predict': True, 'icache': ( 16, 4 ) },
+  { 'pipeline': True, 'predict': True, 'prefetch': 2, 'stbuf': 2 },
+  { 'serial': 4, 'icache': ( 16, 4 ) }
+]
+# Core configurations to run the atomic counter on.
+soc_amo_cfgs = [
+  { 'atomic': True },
+  { 'pipeline': True, 'predict': True, 'icache': ( 16, 4 ),
+    'atomic': True },
+  { 'pipeline': True, 'predict': True, 'prefetch': 2, 'stbuf': 2,
+    'nbload': True, 'atomic': True }
+]
+
+# 'main' method to run a basic testbench.
+if __name__ == "__main__":
+  with warnings.catch_warnings():
+    warnings.filterwarnings( "ignore", category = DriverConflict )
+    # Run the same amount of work on 1, 2, and 4 harts.
+    for cfg in soc_cfgs:
+      print( '--- SoC Tests (%s core) ---'%cfg_str( cfg ) )
+      for harts in [ 1, 2, 4 ]:
+        soc_sim( harts, 96, cfg )
+    # Make the harts compete for the same words of RAM.
+    for cfg in soc_amo_cfgs:
+      print( '--- SoC Atomic Tests (%s core) ---'%cfg_str( cfg ) )
+      for harts in [ 2, 4 ]:
+        soc_amo_sim( harts, 16, cfg )
+
+    # Done; print results and throughput scaling.
+    print( "SoC Tests: %d Passed, %d Failed"%( p, f ) )
+    for ( cfg, harts ), nc in soc_cycles.items():
+      print( "Parallel sum (%s, %d harts): %d cycles (speedup: %.2fx)"
+             %( cfg, harts, nc, soc_cycles[ ( cfg, 1 ) ] / max( nc, 1 ) ) )
@@ -25,6 +25,13 @@ class DummySPI():
 
 # Core SPI Flash "ROM" module.
 class SPI_ROM( Elaboratable ):
+  # SPI Flash reads take dozens of cycles, and 'ack' is held until
+  # 'cyc' is released, so reads cannot be pipelined. Releasing 'cyc'
+  # or changing the address aborts a read which is in progress.
+  pipelined = False
+  # Predecoded instruction fields are not stored in SPI Flash.
+  pd = None
+
   def __init__( self, dat_start, dat_end, data ):
     # Starting address in the Flash chip. This probably won't
     # be zero, because many FPGA boards use their external SPI
@@ -46,20 +53,24 @@ class SPI_ROM( Elaboratable ):
     else:
       self.data = None
 
-    # Initialize Wishbone bus arbiter.
-    self.arb = Arbiter( addr_width = ceil( log2( self.dlen + 1 ) ),
-                        data_width = 32 )
+    # Initialize Wishbone bus arbiter. Bus addresses are in words.
+    self.arb = Arbiter( addr_width = ceil( log2( ( self.dlen // 4 ) + 1 ) ),
+                        data_width = 32,
+                        granularity = 8 )
     self.arb.bus.memory_map = MemoryMap(
-      addr_width = self.arb.bus.addr_width,
-      data_width = self.arb.bus.data_width,
+      addr_width = self.arb.bus.addr_width + 2,
+      data_width = self.arb.bus.granularity,
       alignment = 0 )
+    # Bus address of the current read.
+    self.sadr = Signal( self.arb.bus.addr_width, reset = 0 )
 
   def new_bus( self ):
     # Initialize a new Wishbone bus interface.
     bus = Interface( addr_width = self.arb.bus.addr_width,
-                     data_width = self.arb.bus.data_width )
-    bus.memory_map = MemoryMap( addr_width = bus.addr_width,
-                                data_width = bus.data_width,
+                     data_width = self.arb.bus.data_width,
+                     granularity = self.arb.bus.granularity )
+    bus.memory_map = MemoryMap( addr_width = bus.addr_width + 2,
+                                data_width = bus.granularity,
                                 alignment = 0 )
     self.arb.add( bus )
     return bus
@@ -127,7 +138,8 @@ class SPI_ROM( Elaboratable ):
                    ( self.arb.bus.ack == 0 ) ):
           m.d.sync += [
             self.spi.cs.o.eq( 1 ),
-            self.spio.eq( ( 0x03000000 | ( ( self.arb.bus.adr + self.dstart ) & 0x00FFFFFF ) ) ),
+            self.spio.eq( ( 0x03000000 | ( ( Cat( Repl( 0, 2 ), self.arb.bus.adr ) + self.dstart ) & 0x00FFFFFF ) ) ),
+            self.sadr.eq( self.arb.bus.adr ),
             self.arb.bus.ack.eq( 0 ),
             self.dc.eq( 31 )
           ]
@@ -144,9 +156,15 @@ class SPI_ROM( Elaboratable ):
           self.spi.clk.o.eq( ~ClockSignal( "sync" ) ),
           self.spi.mosi.o.eq( self.spio[ 31 ] )
         ]
+        # Abort the read if 'cyc' is released or the bus address
+        # changes, so that a new address can be read sooner.
+        with m.If( ( self.arb.bus.cyc == 0 ) |
+                   ( self.arb.bus.adr != self.sadr ) ):
+          m.d.sync += self.spi.cs.o.eq( 0 )
+          m.next = "SPI_WAITING"
         # Move to 'receive data' state once 32 bits have elapsed.
         # Also clear 'dat_r' and 'dc' before doing so.
-        with m.If( self.dc == 0 ):
+        with m.Elif( self.dc == 0 ):
           m.d.sync += [
             self.dc.eq( 7 ),
             self.arb.bus.dat_r.eq( 0 )
@@ -159,28 +177,31 @@ class SPI_ROM( Elaboratable ):
       # You can keep the clock signal going to receive as many bytes
       # as you want, but this implementation only fetches one word.
       with m.State( "SPI_RX" ):
-        # Simulate the 'miso' pin value for tests.
+        # Simulate the 'miso' pin value for tests. Each byte comes
+        # from the address after the previous one, like on a real
+        # Flash chip. (The test ROM image's words are stored
+        # MSbyte-first)
         if platform is None:
-          with m.If( self.dc < 8 ):
-            m.d.comb += self.spi.miso.i.eq( ( self.data[ self.arb.bus.adr >> 2 ] >> ( self.dc + 24 ) ) & 0b1 )
-          with m.Elif( self.dc < 16 ):
-            m.d.comb += self.spi.miso.i.eq( ( self.data[ self.arb.bus.adr >> 2 ] >> ( self.dc + 8 ) ) & 0b1 )
-          with m.Elif( self.dc < 24 ):
-            m.d.comb += self.spi.miso.i.eq( ( self.data[ self.arb.bus.adr >> 2 ] >> ( self.dc - 8 ) ) & 0b1 )
-          with m.Else():
-            m.d.comb += self.spi.miso.i.eq( ( self.data[ self.arb.bus.adr >> 2 ] >> ( self.dc - 24 ) ) & 0b1 )
+          m.d.comb += self.spi.miso.i.eq( ( self.data[ self.sadr ] >>
+            Cat( self.dc[ :3 ], ~self.dc[ 3 : 5 ] ) ) & 0b1 )
         m.d.sync += [
           self.dc.eq( self.dc - 1 ),
           self.arb.bus.dat_r.bit_select( self.dc, 1 ).eq( self.spi.miso.i )
         ]
         m.d.comb += self.spi.clk.o.eq( ~ClockSignal( "sync" ) )
+        # Abort the read if 'cyc' is released or the bus address
+        # changes; the new address will be read from 'waiting' state.
+        with m.If( ( self.arb.bus.cyc == 0 ) |
+                   ( self.arb.bus.adr != self.sadr ) ):
+          m.d.sync += self.spi.cs.o.eq( 0 )
+          m.next = "SPI_WAITING"
         # Assert 'ack' signal and move back to 'waiting' state
         # once a whole word of data has been received.
-        with m.If( self.dc[ :3 ] == 0 ):
+        with m.Elif( self.dc[ :3 ] == 0 ):
           with m.If( self.dc[ 3 : 5 ] == 0b11 ):
             m.d.sync += [
               self.spi.cs.o.eq( 0 ),
-              self.arb.bus.ack.eq( self.arb.bus.cyc )
+              self.arb.bus.ack.eq( 1 )
             ]
             m.next = "SPI_WAITING"
           with m.Else():
@@ -262,6 +283,27 @@ def spi_read_word( srom, virt_addr, phys_addr, simword, end_wait ):
   yield Tick()
   yield Settle()
 
+# Helper method to test aborting a read by releasing 'cyc'
+# partway through the read command.
+def spi_abort_read( srom, virt_addr, ticks ):
+  yield srom.arb.bus.adr.eq( virt_addr )
+  yield srom.arb.bus.stb.eq( 1 )
+  yield srom.arb.bus.cyc.eq( 1 )
+  for i in range( ticks ):
+    yield Tick()
+  yield srom.arb.bus.stb.eq( 0 )
+  yield srom.arb.bus.cyc.eq( 0 )
+  # The CS pin should be de-asserted on the next tick,
+  # and the read should not be acknowledged.
+  yield Tick()
+  yield Settle()
+  csa = yield srom.spi.cs.o
+  ack = yield srom.arb.bus.ack
+  spi_rom_ut( "CS High (Aborted)", csa, 0 )
+  spi_rom_ut( "No 'ack' (Aborted)", ack, 0 )
+  yield Tick()
+  yield Settle()
+
 # Top-level SPI ROM test method.
 def spi_rom_tests( srom ):
   global p, f
@@ -272,15 +314,19 @@ def spi_rom_tests( srom ):
   print( "--- SPI Flash 'ROM' Tests ---" )
   # Test basic behavior by reading a few consecutive words.
   yield from spi_read_word( srom, 0x00, 0x200000, LITTLE_END( 0x89ABCDEF ), 0 )
-  yield from spi_read_word( srom, 0x04, 0x200004, LITTLE_END( 0x0C0FFEE0 ), 4 )
+  yield from spi_read_word( srom, 0x01, 0x200004, LITTLE_END( 0x0C0FFEE0 ), 4 )
   # Make sure the CS pin stays de-asserted while waiting.
   for i in range( 4 ):
     yield Tick()
     yield Settle()
     csa = yield srom.spi.cs.o
     spi_rom_ut( "CS High (Waiting)", csa, 0 )
-  yield from spi_read_word( srom, 0x10, 0x200010, LITTLE_END( 0xDEADFACE ), 1 )
-  yield from spi_read_word( srom, 0x0C, 0x20000C, LITTLE_END( 0xABACADAB ), 1 )
+  yield from spi_read_word( srom, 0x04, 0x200010, LITTLE_END( 0xDEADFACE ), 1 )
+  yield from spi_read_word( srom, 0x03, 0x20000C, LITTLE_END( 0xABACADAB ), 1 )
+  # Test aborting reads during the command and data phases.
+  yield from spi_abort_read( srom, 0x02, 10 )
+  yield from spi_abort_read( srom, 0x05, 40 )
+  yield from spi_read_word( srom, 0x02, 0x200008, LITTLE_END( 0xBABABABA ), 1 )
   # Done. Print the number of passed and failed unit tests.
   yield Tick()
   print( "SPI 'ROM' Tests: %d Passed, %d Failed"%( p, f ) )
@@ -0,0 +1,260 @@
+from nmigen import *
+from nmigen.back.pysim import *
+from nmigen_soc.wishbone import *
+from nmigen_soc.memory import *
+
+from isa import *
+from ram import *
+
+################################################################
+# Store buffer: sits between the CPU and the data bus, and     #
+# accepts stores in a single cycle. Buffered stores are        #
+# written to memory in the background, when the data bus is    #
+# not being used by a load.                                    #
+# * Loads from an address which has a buffered store get the   #
+#   stored value forwarded to them, if the newest store to     #
+#   that word covers every byte that the load reads. Other     #
+#   loads which overlap a buffered store wait for it to drain. #
+# * Loads from peripherals wait for the whole buffer to drain, #
+#   so that I/O accesses are not re-ordered.                   #
+# * The CPU waits for the buffer to drain on 'FENCE' and       #
+#   before entering a trap handler, using the 'empty' flag.    #
+# * Writes which use 'cyc' / 'we' instead of 'push' go         #
+#   straight to the data bus once the buffer is empty. (Atomic #
+#   operations use this to write while they hold the bus)      #
+################################################################
+
+class StoreBuffer( Elaboratable ):
+  def __init__( self, dbus, depth ):
+    # Memory-side bus.
+    self.dbus = dbus
+    # Number of stores which can be buffered.
+    self.depth = depth
+    # Buffered stores' word addresses, data, and byte lanes. Entry 0
+    # holds the oldest store, and entries shift down when it is written.
+    self.adr = Array( Signal( 30, reset = 0, name = "sb_adr_%d"%i )
+                      for i in range( depth ) )
+    self.dat = Array( Signal( 32, reset = 0, name = "sb_dat_%d"%i )
+                      for i in range( depth ) )
+    self.sel = Array( Signal( 4, reset = 0, name = "sb_sel_%d"%i )
+                      for i in range( depth ) )
+    self.count = Signal( range( depth + 1 ), reset = 0 )
+    # Flag which is set while a buffered store is on the data bus.
+    self.dbusy = Signal( reset = 0 )
+    # Flag which is set while a load is on the data bus.
+    self.lbusy = Signal( reset = 0 )
+    # CPU-side bus. Loads use the usual 'cyc' / 'ack' signals, but
+    # stores are buffered by setting 'push' while 'rdy' is set.
+    # ('adr', 'dat_w', and 'sel' are sampled when 'push' is set)
+    # Unbuffered writes use 'cyc' / 'we' / 'ack'.
+    self.bus = Interface( addr_width = 30, data_width = 32,
+                          granularity = 8 )
+    self.push = Signal( reset = 0 )
+    self.rdy = Signal( reset = 0 )
+    # Flag which is set when the buffer is empty.
+    self.empty = Signal( reset = 0 )
+
+  def elaborate( self, platform ):
+    m = Module()
+
+    # Load control signals.
+    lreq  = Signal( reset = 0 )
+    match = Signal( reset = 0 )
+    cover = Signal( reset = 0 )
+    fdat  = Signal( 32, reset = 0x00000000 )
+    fack  = Signal( reset = 0 )
+    fwd_r = Signal( 32, reset = 0x00000000 )
+    ld_go = Signal( reset = 0 )
+    # Store control signals.
+    pop   = Signal( reset = 0 )
+    dcyc  = Signal( reset = 0 )
+
+    m.d.comb += [
+      self.rdy.eq( self.count < self.depth ),
+      self.empty.eq( self.count == 0 ),
+      lreq.eq( self.bus.cyc & ~self.bus.we )
+    ]
+
+    # Find the newest buffered store to the word that is being
+    # loaded from, and check whether it covers the load: that is,
+    # whether it wrote every byte lane which the load reads.
+    for i in range( self.depth ):
+      with m.If( ( i < self.count ) &
+                 ( self.adr[ i ] == self.bus.adr ) ):
+        m.d.comb += [
+          match.eq( 1 ),
+          cover.eq( ( self.sel[ i ] & self.bus.sel ) == self.bus.sel ),
+          fdat.eq( self.dat[ i ] )
+        ]
+
+    # CPU-side load logic: forward covered loads, and send other loads
+    # to the data bus once it is free. Loads from peripherals
+    # (0x4-------) and unbuffered writes wait until the buffer is empty.
+    m.d.comb += ld_go.eq( self.bus.cyc & ~match & ~self.dbusy &
+      ( self.empty | ( lreq & ( self.bus.adr[ 27 : 30 ] != 0b010 ) ) ) )
+    m.d.sync += [
+      fack.eq( lreq & match & cover ),
+      fwd_r.eq( fdat ),
+      self.lbusy.eq( ld_go )
+    ]
+    m.d.comb += [
+      self.bus.ack.eq( fack | ( self.dbus.ack & self.lbusy ) ),
+      self.bus.dat_r.eq( Mux( fack, fwd_r, self.dbus.dat_r ) )
+    ]
+
+    # Memory-side logic: write the oldest buffered store to the data
+    # bus whenever a load isn't using it. 'cyc' is released on 'ack'.
+    m.d.comb += dcyc.eq( ( self.dbusy | ~ld_go ) & ~self.empty &
+                         ~self.dbus.ack )
+    m.d.sync += self.dbusy.eq( dcyc )
+    m.d.comb += pop.eq( self.dbusy & self.dbus.ack )
+    with m.If( dcyc | self.dbusy ):
+      m.d.comb += [
+        self.dbus.adr.eq( self.adr[ 0 ] ),
+        self.dbus.dat_w.eq( self.dat[ 0 ] ),
+        self.dbus.sel.eq( self.sel[ 0 ] ),
+        self.dbus.we.eq( 1 ),
+        self.dbus.cyc.eq( dcyc )
+      ]
+    with m.Else():
+      m.d.comb += [
+        self.dbus.adr.eq( self.bus.adr ),
+        self.dbus.dat_w.eq( self.bus.dat_w ),
+        self.dbus.sel.eq( self.bus.sel ),
+        self.dbus.we.eq( self.bus.we ),
+        self.dbus.cyc.eq( ld_go )
+      ]
+
+    # Buffer updates: shift the entries down when the oldest store is
+    # written, and add new stores after the newest one.
+    with m.If( pop ):
+      for i in range( self.depth - 1 ):
+        m.d.sync += [
+          self.adr[ i ].eq( self.adr[ i + 1 ] ),
+          self.dat[ i ].eq( self.dat[ i + 1 ] ),
+          self.sel[ i ].eq( self.sel[ i + 1 ] )
+        ]
+    with m.If( self.push & self.rdy ):
+      m.d.sync += [
+        self.adr[ self.count - pop ].eq( self.bus.adr ),
+        self.dat[ self.count - pop ].eq( self.bus.dat_w ),
+        self.sel[ self.count - pop ].eq( self.bus.sel )
+      ]
+      with m.If( ~pop ):
+        m.d.sync += self.count.eq( self.count + 1 )
+    with m.Elif( pop ):
+      m.d.sync += self.count.eq( self.count - 1 )
+
+    # End of store buffer module definition.
+    return m
+
+###########################
+# Store buffer testbench: #
+###########################
+# Keep track of test pass / fail rates.
+p = 0
+f = 0
+
+# Helper method to record unit test pass/fails.
+def sb_ut( name, actual, expected ):
+  global p, f
+  if expected != actual:
+    f += 1
+    print( "\033[31mFAIL:\033[0m %s (0x%08X != 0x%08X)"
+           %( name, actual, expected ) )
+  else:
+    p += 1
+    print( "\033[32mPASS:\033[0m %s (0x%08X == 0x%08X)"
+           %( name, actual, expected ) )
+
+# Buffer a store. It should be accepted in a single cycle.
+# ('address' is a word address, and 'sel' selects the bytes to write)
+def sb_store( sb, address, data, sel ):
+  yield sb.bus.adr.eq( address )
+  yield sb.bus.dat_w.eq( data )
+  yield sb.bus.sel.eq( sel )
+  yield sb.push.eq( 1 )
+  yield Settle()
+  rdy = yield sb.rdy
+  sb_ut( "Store buffer ready", rdy, 1 )
+  yield Tick()
+  yield sb.push.eq( 0 )
+
+# Perform a load, and check the returned data and number of cycles.
+def sb_load( sb, address, sel, expected, cycles ):
+  yield sb.bus.adr.eq( address )
+  yield sb.bus.sel.eq( sel )
+  yield sb.bus.cyc.eq( 1 )
+  yield Tick()
+  nc = 1
+  yield Settle()
+  while ( yield sb.bus.ack ) == 0:
+    yield Tick()
+    nc += 1
+    yield Settle()
+  yield sb.bus.cyc.eq( 0 )
+  actual = yield sb.bus.dat_r
+  sb_ut( "Load [0x%08X] data"%address, actual & 0xFFFFFFFF, expected )
+  sb_ut( "Load [0x%08X] cycles"%address, nc, cycles )
+
+# Top-level store buffer test method.
+def sb_test( sb, ram ):
+  global p, f
+
+  # Let signals settle after reset.
+  yield Settle()
+  # Print a test header.
+  print( "--- Store Buffer Tests ---" )
+
+  # Buffer two stores, and check that loads are forwarded from them.
+  # (Word address 0x08000000 = byte address 0x20000000)
+  yield from sb_store( sb, 0x08000000, 0x01234567, 0b1111 )
+  yield from sb_store( sb, 0x08000001, 0x89ABCDEF, 0b1111 )
+  yield from sb_load( sb, 0x08000001, 0b1111, 0x89ABCDEF, 1 )
+  yield from sb_load( sb, 0x08000001, 0b0100, 0x89ABCDEF, 1 )
+  # A load from a different word is read from the RAM, once
+  # the store which is being written has finished.
+  yield from sb_load( sb, 0x08000004, 0b1111, 0x00000000, 2 )
+  # Let the buffer drain, and check that the stores reached the RAM.
+  for i in range( 6 ):
+    yield Tick()
+  yield Settle()
+  sb_ut( "Store buffer empty", ( yield sb.empty ), 1 )
+  sb_ut( "RAM[ 0x00 ]", ( yield ram.data[ 0 ] ), 0x01234567 )
+  sb_ut( "RAM[ 0x04 ]", ( yield ram.data[ 1 ] ), 0x89ABCDEF )
+  # A byte store only covers loads from the same byte lane; a wider
+  # load from the same word waits for the store to drain.
+  yield from sb_store( sb, 0x08000000, 0x0000AA00, 0b0010 )
+  yield from sb_load( sb, 0x08000000, 0b0010, 0x0000AA00, 1 )
+  yield from sb_store( sb, 0x08000000, 0x00BB0000, 0b0100 )
+  yield from sb_load( sb, 0x08000000, 0b1111, 0x01BBAA67, 3 )
+  # Fill the buffer; it shouldn't accept another store until
+  # the oldest one has been written.
+  for i in range( sb.depth ):
+    yield from sb_store( sb, 0x08000008 + i, i, 0b1111 )
+  yield Settle()
+  sb_ut( "Store buffer full", ( yield sb.rdy ), 0 )
+  yield Tick()
+  yield Tick()
+  yield Settle()
+  sb_ut( "Store buffer ready", ( yield sb.rdy ), 1 )
+
+  # Done.
+  yield Tick()
+  print( "Store Buffer Tests: %d Passed, %d Failed"%( p, f ) )
+
+# 'main' method to run a basic testbench.
+if __name__ == "__main__":
+  # Instantiate a 16-word RAM module and a 2-entry store buffer.
+  ram = RAM( 16 )
+  dut = StoreBuffer( ram.new_bus(), 2 )
+  m = Module()
+  m.submodules.ram = ram
+  m.submodules.sb  = dut
+  # Run the store buffer tests.
+  with Simulator( m, vcd_file = open( 'stbuf.vcd', 'w' ) ) as sim:
+    def proc():
+      yield from sb_test( dut, ram )
+    sim.add_clock( 1e-6 )
+    sim.add_sync_process( proc )
+    sim.run()
@@ -0,0 +1,189 @@
+from nmigen import *
+from nmigen.back import rtlil
+
+import importlib
+import json
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import warnings
+
+#################################################################
+# Synthesis measurement script:                                 #
+# Synthesize one module for an iCE40 FPGA with yosys and        #
+# nextpnr-ice40, and print its cell counts and maximum          #
+# frequency with a few placement seeds. The CPU is placed on    #
+# the UPduino's iCE40UP5K-SG48; the ALU and CSRs have too many  #
+# I/O pins for it, so they are placed on an iCE40HX8K-CT256.    #
+# Their inputs and outputs are registered, so the timing        #
+# covers the logic.                                             #
+#                                                               #
+# Usage: python synth.py [-r <git rev>] <alu|csr|cpu> [options] #
+# - 'options' is a JSON dictionary of constructor arguments,    #
+#   for example '{"registered": true}' for the CSR module.      #
+# - '-r <git rev>' synthesizes the modules from an earlier      #
+#   revision instead of the working tree, to compare them.      #
+# The 'YOSYS' and 'NEXTPNR_ICE40' environment variables select  #
+# the tools, and 'SEEDS' sets how many seeds to place with.     #
+#################################################################
+
+# Placeholder platform: most modules only check that it is not
+# 'None', which would add simulation-only logic. I/O pins are not
+# connected to anything, like they are in simulations.
+class SynthPlatform():
+  def request( self, name, number = 0 ):
+    return importlib.import_module( 'gpio_mux' ).DummyGPIO(
+             "%s_%d"%( name, number ) )
+
+# Wrapper module for the ALU: register its inputs and its outputs.
+# (The 'CMP' flag is registered the way that branches use it; older
+#  ALUs without it used a zero test on the result instead)
+class ALUSynth( Elaboratable ):
+  device = [ '--hx8k', '--package', 'ct256' ]
+  def __init__( self, mods, cfg ):
+    self.alu = mods[ 'alu' ].ALU( **cfg )
+    self.a   = Signal( 32 )
+    self.b   = Signal( 32 )
+    self.f   = Signal( 5 )
+    self.y   = Signal( 32 )
+    self.cmp = Signal( 1 )
+    self.ports = [ self.a, self.b, self.f, self.y, self.cmp ]
+
+  def elaborate( self, platform ):
+    m = Module()
+    m.submodules.alu = self.alu
+    m.d.sync += [
+      self.alu.a.eq( self.a ),
+      self.alu.b.eq( self.b ),
+      self.alu.f.eq( self.f ),
+      self.y.eq( self.alu.y ),
+      self.cmp.eq( getattr( self.alu, 'cmp', self.alu.y == 0 ) )
+    ]
+    return m
+
+# Wrapper module for the CSRs: register the bus inputs and the
+# read data output.
+class CSRSynth( Elaboratable ):
+  device = [ '--hx8k', '--package', 'ct256' ]
+  def __init__( self, mods, cfg ):
+    self.csr   = mods[ 'csr' ].CSR( **cfg )
+    self.adr   = Signal( 12 )
+    self.dat_w = Signal( 32 )
+    self.f     = Signal( 3 )
+    self.we    = Signal( 1 )
+    self.dat_r = Signal( 32 )
+    self.ports = [ self.adr, self.dat_w, self.f, self.we, self.dat_r ]
+
+  def elaborate( self, platform ):
+    m = Module()
+    m.submodules.csr = self.csr
+    m.d.sync += [
+      self.csr.adr.eq( self.adr ),
+      self.csr.dat_w.eq( self.dat_w ),
+      self.csr.f.eq( self.f ),
+      self.csr.we.eq( self.we ),
+      self.dat_r.eq( self.csr.dat_r )
+    ]
+    return m
+
+# Wrapper module for the CPU: run the 'load latency' test program
+# from ROM, and bring the PC out so that the logic is kept.
+class CPUSynth( Elaboratable ):
+  device = [ '--up5k', '--package', 'sg48' ]
+  def __init__( self, mods, cfg ):
+    self.cpu = mods[ 'cpu' ].CPU( mods[ 'rom' ].ROM(
+                 mods[ 'programs' ].load_rom,
+                 predecode = cfg.get( 'predecode', False ) ), **cfg )
+    self.pc  = Signal( 32 )
+    self.irq = Signal( 1 )
+    self.ports = [ self.pc, self.irq ]
+
+  def elaborate( self, platform ):
+    m = Module()
+    m.submodules.cpu = self.cpu
+    m.d.comb += [
+      self.pc.eq( self.cpu.pc ),
+      self.cpu.irq.eq( self.irq ),
+      self.cpu.clk_rst.eq( 0 )
+    ]
+    return m
+
+targets = { 'alu': ALUSynth, 'csr': CSRSynth, 'cpu': CPUSynth }
+
+# Helper method to run yosys and nextpnr-ice40 on a design, and
+# return its cell counts and the maximum frequency for each seed.
+def synth( top, wd, seeds ):
+  yosys = os.environ.get( 'YOSYS', 'yosys' )
+  nextpnr = os.environ.get( 'NEXTPNR_ICE40', 'nextpnr-ice40' )
+  with warnings.catch_warnings():
+    warnings.simplefilter( "ignore" )
+    with open( os.path.join( wd, 'top.il' ), 'w' ) as f:
+      f.write( rtlil.convert( top, name = 'top',
+                              platform = SynthPlatform(),
+                              ports = top.ports ) )
+  # (The tools run in the work directory, with relative paths)
+  subprocess.run( [ yosys, '-q', '-p',
+                    "read_rtlil top.il; synth_ice40 -top top "
+                    "-json top.json; tee -q -o top.stat stat" ],
+                  cwd = wd, check = True )
+  cells = {}
+  with open( os.path.join( wd, 'top.stat' ), 'r' ) as f:
+    # (Newer versions of yosys print the count before the name)
+    for cm in re.finditer( r'^\s+(SB_\w+|\d+)\s+(SB_\w+|\d+)\s*$',
+                           f.read(), re.M ):
+      c, n = sorted( cm.groups(), key = lambda g: g.isdigit() )
+      cells[ c ] = int( n )
+  fmax = []
+  for seed in range( 1, seeds + 1 ):
+    r = subprocess.run( [ nextpnr ] + top.device + [
+                          '--json', 'top.json', '--freq', '12',
+                          '--seed', str( seed ) ], cwd = wd,
+                        stdout = subprocess.PIPE, stderr = subprocess.STDOUT,
+                        universal_newlines = True )
+    fm = re.findall( r'Max frequency for clock [^:]*: ([\d.]+) MHz',
+                     r.stdout )
+    fmax.append( float( fm[ -1 ] ) if fm else None )
+  return cells, fmax
+
+if __name__ == "__main__":
+  args = sys.argv[ 1 : ]
+  rev = None
+  if ( len( args ) > 1 ) and ( args[ 0 ] == '-r' ):
+    rev = args[ 1 ]
+    args = args[ 2 : ]
+  if ( len( args ) < 1 ) or ( args[ 0 ] not in targets ):
+    print( "Usage: python synth.py [-r <git rev>] <%s> [options]"
+           %"|".join( targets ) )
+    sys.exit( 1 )
+  cfg = json.loads( args[ 1 ] ) if len( args ) > 1 else {}
+  # Constructor arguments which are tuples in Python.
+  for k, v in cfg.items():
+    if isinstance( v, list ):
+      cfg[ k ] = tuple( v )
+  seeds = int( os.environ.get( 'SEEDS', 3 ) )
+
+  with tempfile.TemporaryDirectory() as wd:
+    # Import the modules from the requested revision, if any.
+    # (The generated compliance test ROMs still come from here)
+    if rev is not None:
+      src = os.path.join( wd, 'src' )
+      os.mkdir( src )
+      arc = subprocess.run( [ 'git', 'archive', rev ], check = True,
+                            stdout = subprocess.PIPE ).stdout
+      subprocess.run( [ 'tar', '-x', '-C', src ], input = arc,
+                      check = True )
+      sys.path.insert( 0, src )
+    with warnings.catch_warnings():
+      warnings.simplefilter( "ignore" )
+      mods = { n: importlib.import_module( n )
+               for n in [ 'alu', 'csr', 'rom', 'programs', 'cpu' ] }
+    cells, fmax = synth( targets[ args[ 0 ] ]( mods, cfg ), wd, seeds )
+
+  print( "%s %s (%s):"%( args[ 0 ], json.dumps( cfg ),
+                         rev if rev is not None else "working tree" ) )
+  for c in sorted( cells ):
+    print( "  %-14s %d"%( c, cells[ c ] ) )
+  print( "  Fmax (MHz):    %s"%", ".join(
+         ( "%.2f"%fm if fm is not None else "failed" ) for fm in fmax ) )
@@ -31,13 +31,15 @@ def get_section_hex( op, sect, in_dir ):
 
 # Helper method to write a Python file containing a simulated ROM
 # test image and testbench condition to verify that it ran correclty.
-def write_py_tests( op, hext, hexd, out_dir ):
+# The 'ext' argument is the ISA extension that the test is for,
+# e.g. 'i' for the base RV32I ISA or 'm' for the 'M' extension.
+def write_py_tests( ext, op, hext, hexd, out_dir ):
   instrs = len( hext )
   opp = ''
   opn = op.upper() + ' compliance'
   while len( opp ) < ( 13 - len( op ) ):
     opp = opp + ' '
-  py_fn = './%s/%s/rv32i_%s.py'%( test_path, out_dir, op )
+  py_fn = './%s/%s/rv32%s_%s.py'%( test_path, out_dir, ext, op )
   with open( py_fn, 'w' ) as py:
     print( 'Generating %s tests...'%op, end = '' )
     # Write imports and headers.
@@ -45,9 +47,9 @@ def write_py_tests( op, hext, hexd, out_dir ):
               'from rom import *\r\n'
               '\r\n'
               '###########################################\r\n'
-              '# rv32ui %s instruction tests: %s#\r\n'
+              '# rv32u%s %s instruction tests: %s#\r\n'
               '###########################################\r\n'
-              '\r\n'%( op.upper(), opp ) )
+              '\r\n'%( ext, op.upper(), opp ) )
     # Write the ROM image.
     py.write( '# Simulated ROM image:\r\n'
               '%s_rom = rom_img( ['%op )
@@ -101,4 +103,5 @@ for fn in os.listdir( './%s/rv32i_compliance'%test_path ):
     # Get initialized RAM data for the operation's tests.
     hexd = get_section_hex( '%s.o'%op, '.data', 'rv32i_compliance' )
     # Write a Python file with the test program image.
-    write_py_tests( op[ 2 : -3 ].lower(), hext, hexd, 'test_roms' )
+    write_py_tests( op[ 0 ].lower(), op[ 2 : -3 ].lower(),
+                    hext, hexd, 'test_roms' )